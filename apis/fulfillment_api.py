@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import uuid
 import mysql.connector  # Changed from pymysql
@@ -10,9 +11,14 @@ from pydantic import BaseModel, EmailStr
 from dotenv import load_dotenv
 import uvicorn
 
+# Shared modules (metrics) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import instrument_fastapi_app
+
 load_dotenv()
 
 app = FastAPI()
+instrument_fastapi_app(app, 'fulfillment_api')
 
 def get_database_connection():
     """Get database connection using mysql.connector"""
@@ -1,4 +1,5 @@
 import os
+import sys
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -7,9 +8,14 @@ from pydantic import BaseModel, EmailStr
 from dotenv import load_dotenv
 import uvicorn
 
+# Shared modules (metrics) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import instrument_fastapi_app
+
 load_dotenv()
 
 app = FastAPI()
+instrument_fastapi_app(app, 'mail_service')
 
 class MailRequest(BaseModel):
     mail_id: EmailStr
@@ -1,4 +1,5 @@
 import os
+import sys
 import mysql.connector  # Changed from pymysql
 from mysql.connector import Error
 from fastapi import FastAPI, HTTPException
@@ -8,9 +9,14 @@ from datetime import datetime, date
 from dotenv import load_dotenv
 import uvicorn
 
+# Shared modules (metrics) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import instrument_fastapi_app
+
 load_dotenv()
 
 app = FastAPI()
+instrument_fastapi_app(app, 'user_validator')
 
 class UserCreateRequest(BaseModel):
     mail_id: EmailStr
@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from mysql.connector import Error
+from dotenv import load_dotenv
+from attachment_store import attachment_digest
+from metrics import counter
+
+load_dotenv()
+
+CACHE_LOOKUPS = counter(
+    'llm_cache_lookups_total',
+    'LLM assessment cache lookups by result (hit, miss, error)',
+    label_names=('result',)
+)
+CACHE_EVICTIONS = counter(
+    'llm_cache_evictions_total',
+    'LLM assessment cache entries removed, by reason',
+    label_names=('reason',)
+)
+
+# Bump when the key layout or the prompt inputs change so old entries stop matching
+# (2: PDF text is part of the prompt; 3: attachment names and preprocessing settings,
+# sender and claim ID no longer in the prompt)
+KEY_VERSION = 3
+
+
+def normalize_text(text):
+    """Collapse whitespace so re-wrapped or re-sent mail bodies hash the same."""
+    return re.sub(r'\s+', ' ', text or '').strip()
+
+
+def assessment_cache_key(email_data, prompt_version, model_id, input_settings):
+    """
+    SHA-256 over everything the LLM is shown: the normalized subject and body,
+    the attachment names and contents, the settings that shape the attachments
+    in the prompt (`input_settings`: image size, PDF text budgets), the system
+    prompt version and the model. The prompt holds no sender or claim ID, so a
+    resubmission hits the cache.
+    """
+    attachments = []
+    for path in email_data.get('attachment_paths', []):
+        filename = os.path.basename(path)
+        try:
+            attachments.append([filename, attachment_digest(path)])
+        except OSError:
+            attachments.append([filename, 'missing'])
+    key = {
+        'version': KEY_VERSION,
+        'model': model_id,
+        'prompt': prompt_version,
+        'settings': input_settings,
+        'subject': normalize_text(email_data.get('subject')),
+        'content': normalize_text(email_data.get('content')),
+        'attachments': attachments,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class AssessmentCache:
+    """
+    LLM assessments stored in the llm_assessment_cache table, so identical inputs
+    skip Bedrock. Entries expire after LLM_CACHE_TTL_SECONDS and the table is
+    trimmed to LLM_CACHE_MAX_ENTRIES (least recently used first). Callers pass
+    their own DB connection; cache errors count as misses and never fail a job.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+        self.ttl_seconds = int(os.getenv('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+        self.max_entries = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 10000))
+        self.evict_interval = int(os.getenv('LLM_CACHE_EVICT_SECONDS', 300))
+        self.last_evicted = 0
+        self.evict_lock = threading.Lock()
+
+    def get(self, connection, cache_key):
+        """The cached LLM response for `cache_key`, or None."""
+        if not self.enabled:
+            return None
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT response FROM llm_assessment_cache
+                    WHERE cache_key = %s AND created_at >= %s
+                """, (cache_key, datetime.now() - timedelta(seconds=self.ttl_seconds)))
+                row = cursor.fetchone()
+                if row:
+                    cursor.execute("""
+                        UPDATE llm_assessment_cache SET hits = hits + 1, last_used_at = %s
+                        WHERE cache_key = %s
+                    """, (datetime.now(), cache_key))
+            connection.commit()
+        except Error as e:
+            print(f"[WARN] LLM cache lookup failed: {e}")
+            connection.rollback()
+            CACHE_LOOKUPS.inc(result='error')
+            return None
+
+        CACHE_LOOKUPS.inc(result='hit' if row else 'miss')
+        return row[0] if row else None
+
+    def put(self, connection, cache_key, model_id, prompt_version, response):
+        """Store an LLM response, then evict if it is time to."""
+        if not self.enabled:
+            return
+        now = datetime.now()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO llm_assessment_cache
+                    (cache_key, model_id, prompt_version, response, hits, created_at, last_used_at)
+                    VALUES (%s, %s, %s, %s, 0, %s, %s)
+                    ON DUPLICATE KEY UPDATE response = VALUES(response),
+                        created_at = VALUES(created_at), last_used_at = VALUES(last_used_at)
+                """, (cache_key, model_id, prompt_version, response, now, now))
+            connection.commit()
+        except Error as e:
+            print(f"[WARN] Could not store LLM response in cache: {e}")
+            connection.rollback()
+            return
+        self.evict(connection)
+
+    def discard(self, connection, cache_key):
+        """Remove an entry whose response turned out to be unusable."""
+        if not self.enabled:
+            return
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM llm_assessment_cache WHERE cache_key = %s", (cache_key,))
+                CACHE_EVICTIONS.inc(max(cursor.rowcount, 0), reason='unparseable')
+            connection.commit()
+        except Error as e:
+            print(f"[WARN] Could not remove LLM cache entry: {e}")
+            connection.rollback()
+
+    def evict(self, connection, force=False):
+        """Delete expired entries and trim to max_entries, at most every evict_interval seconds."""
+        with self.evict_lock:
+            if not force and time.monotonic() - self.last_evicted < self.evict_interval:
+                return
+            self.last_evicted = time.monotonic()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM llm_assessment_cache WHERE created_at < %s",
+                    (datetime.now() - timedelta(seconds=self.ttl_seconds),)
+                )
+                CACHE_EVICTIONS.inc(max(cursor.rowcount, 0), reason='expired')
+
+                cursor.execute("SELECT COUNT(*) FROM llm_assessment_cache")
+                excess = cursor.fetchone()[0] - self.max_entries
+                if excess > 0:
+                    cursor.execute(
+                        "DELETE FROM llm_assessment_cache ORDER BY last_used_at ASC LIMIT %s",
+                        (excess,)
+                    )
+                    CACHE_EVICTIONS.inc(max(cursor.rowcount, 0), reason='size')
+            connection.commit()
+        except Error as e:
+            print(f"[WARN] LLM cache eviction failed: {e}")
+            connection.rollback()
@@ -0,0 +1,245 @@
+import os
+import uuid
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from metrics import counter
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; the store is then only locked within one process
+    fcntl = None
+
+load_dotenv()
+
+ATTACHMENTS_STORED = counter(
+    'attachment_store_writes_total',
+    'Attachments stored, by whether the content was already in the store',
+    label_names=('result',)
+)
+ATTACHMENT_BYTES_DEDUPLICATED = counter(
+    'attachment_store_deduplicated_bytes_total',
+    'Attachment bytes not written to disk because the content was already stored'
+)
+
+# Attachments are stored once per content, keyed by SHA-256:
+#   <folder>/store/<sha[:2]>/<sha>/<filename>      the content (hard links if it arrived under several names)
+#   <folder>/store/<sha[:2]>/<sha>/.refs/<claim_id> one marker per claim referencing it
+#   <folder>/store/<sha[:2]>/<sha>/.derived/        cached conversions (resized images, ...)
+REFS_FOLDER = '.refs'
+DERIVED_FOLDER = '.derived'
+LOCK_FILE = '.lock'
+
+_store_lock = threading.Lock()
+
+
+def get_attachments_folder():
+    return os.getenv('LOCAL_ATTACHMENTS_FOLDER', 'attachments')
+
+
+def get_attachment_limits():
+    """(per-attachment, per-message) limits on decoded attachment bytes."""
+    return (
+        int(os.getenv('MAX_ATTACHMENT_BYTES', 25 * 1024 * 1024)),
+        int(os.getenv('MAX_MESSAGE_ATTACHMENT_BYTES', 50 * 1024 * 1024)),
+    )
+
+
+def estimated_size(item):
+    """Decoded size of an attachment_manifest item, from its encoded BODYSTRUCTURE size."""
+    if item.get('encoding') == 'base64':
+        return item['size'] * 3 // 4
+    return item['size']
+
+
+def apply_size_limits(manifest):
+    """
+    Mark manifest items that would break the per-attachment limit, or the
+    per-message budget (in message order), as skipped. Returns the skipped items.
+    """
+    max_attachment_bytes, max_message_bytes = get_attachment_limits()
+    remaining = max_message_bytes
+    skipped = []
+    for item in manifest:
+        size = estimated_size(item)
+        if size > max_attachment_bytes or size > remaining:
+            item['skipped'] = 'size_limit'
+            skipped.append(item)
+        else:
+            remaining -= size
+    return skipped
+
+
+def _store_folder():
+    return os.path.join(get_attachments_folder(), 'store')
+
+
+def _content_folder(digest):
+    return os.path.join(_store_folder(), digest[:2], digest)
+
+
+def _safe_filename(filename):
+    filename = os.path.basename(filename or '') or 'attachment'
+    return '_' + filename if filename in (REFS_FOLDER, DERIVED_FOLDER) else filename
+
+
+@contextmanager
+def _locked_store():
+    """
+    Hold the store lock (a thread lock plus flock on <store>/.lock, shared by the
+    monitor and worker processes) while adding or dropping references, so content
+    is never deleted between another claim's reference and its link.
+    """
+    os.makedirs(_store_folder(), exist_ok=True)
+    with _store_lock, open(os.path.join(_store_folder(), LOCK_FILE), 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _stored_digest(path):
+    """The SHA-256 in a store path, or None for files outside the store."""
+    content_folder = os.path.dirname(os.path.abspath(path))
+    digest = os.path.basename(content_folder)
+    if len(digest) == 64 and os.path.dirname(os.path.dirname(content_folder)) == os.path.abspath(_store_folder()):
+        return digest
+    return None
+
+
+def attachment_digest(path):
+    """SHA-256 of an attachment: read from a store path, or computed for older per-claim files."""
+    digest = _stored_digest(path)
+    if digest:
+        return digest
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def derived_folder(digest):
+    """Folder for files computed from this content; removed with the content."""
+    return os.path.join(_content_folder(digest), DERIVED_FOLDER)
+
+
+def reference_count(digest):
+    """Number of claims referencing this content."""
+    try:
+        return len(os.listdir(os.path.join(_content_folder(digest), REFS_FOLDER)))
+    except FileNotFoundError:
+        return 0
+
+
+def _commit(claim_id, filename, digest, size, partial_path):
+    """Reference the content for this claim, then move the temp file into the store unless it is there already."""
+    content_folder = _content_folder(digest)
+    file_path = os.path.join(content_folder, _safe_filename(filename))
+    ref_path = os.path.join(content_folder, REFS_FOLDER, claim_id)
+    with _locked_store():
+        os.makedirs(os.path.join(content_folder, REFS_FOLDER), exist_ok=True)
+        existing = [name for name in os.listdir(content_folder) if name not in (REFS_FOLDER, DERIVED_FOLDER)]
+        # Reference marker for this claim, written first so release_claim keeps the content
+        open(ref_path, 'a').close()
+        try:
+            if os.path.exists(file_path):
+                os.remove(partial_path)
+            elif existing:
+                # Same content under another name: link instead of writing the bytes again
+                try:
+                    os.link(os.path.join(content_folder, existing[0]), file_path)
+                    os.remove(partial_path)
+                except FileExistsError:
+                    os.remove(partial_path)
+                except OSError:
+                    os.replace(partial_path, file_path)
+            else:
+                os.replace(partial_path, file_path)
+        except OSError:
+            os.remove(ref_path)
+            raise
+
+    if existing:
+        ATTACHMENTS_STORED.inc(result='duplicate')
+        ATTACHMENT_BYTES_DEDUPLICATED.inc(size)
+        print(f"[FILE] Attachment {os.path.basename(file_path)} already stored ({digest[:12]})")
+    else:
+        ATTACHMENTS_STORED.inc(result='new')
+        print(f"[FILE] Saved attachment: {os.path.basename(file_path)} ({digest[:12]})")
+    return file_path
+
+
+class _HashingWriter:
+    """Binary file wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self.file = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.path = None # Set once the attachment is committed to the store
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+
+@contextmanager
+def open_attachment(claim_id, filename):
+    """
+    Write an attachment incrementally into the store. Yields a writer with a
+    write() method; its `path` is set after the block succeeds. Content that is
+    already stored is not kept twice.
+    """
+    tmp_folder = os.path.join(_store_folder(), 'tmp')
+    os.makedirs(tmp_folder, exist_ok=True)
+    partial_path = os.path.join(tmp_folder, f"{uuid.uuid4().hex}.part")
+    try:
+        with open(partial_path, "wb") as f:
+            writer = _HashingWriter(f)
+            yield writer
+        writer.path = _commit(claim_id, filename, writer.sha256.hexdigest(), writer.size, partial_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+def save_attachment(claim_id, filename, data):
+    """Store an in-memory attachment for a claim and return its path."""
+    with open_attachment(claim_id, filename) as writer:
+        writer.write(data)
+    return writer.path
+
+
+def release_claim(claim_id, paths):
+    """
+    Drop a claim's references to the given stored attachments, deleting content
+    (and its .derived/ conversions) no other claim references. Older per-claim
+    files outside the store are deleted, with their folder once it is empty.
+    Returns the number of files deleted from disk.
+    """
+    deleted = 0
+    for path in paths:
+        try:
+            digest = attachment_digest(path)
+        except OSError:
+            continue
+        if not _stored_digest(path):
+            os.remove(path)
+            deleted += 1
+            claim_folder = os.path.dirname(path)
+            if not os.listdir(claim_folder):
+                os.rmdir(claim_folder)
+        content_folder = _content_folder(digest)
+        ref_path = os.path.join(content_folder, REFS_FOLDER, claim_id)
+        with _locked_store():
+            if os.path.exists(ref_path):
+                os.remove(ref_path)
+            if os.path.isdir(content_folder) and reference_count(digest) == 0:
+                shutil.rmtree(content_folder, ignore_errors=True)
+                deleted += 1
+    return deleted
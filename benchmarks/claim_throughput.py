@@ -0,0 +1,113 @@
+"""
+Benchmark: job claims/sec against queue depth for different claim batch sizes.
+
+Runs against a SCRATCH database (BENCH_MYSQL_DB) on the configured MySQL server,
+because it fills and truncates its own `mail_jobs` table.
+
+Usage:
+    BENCH_MYSQL_DB=claims_bench python benchmarks/claim_throughput.py
+    BENCH_MYSQL_DB=claims_bench python benchmarks/claim_throughput.py --depths 100 1000 --batch-sizes 1 25
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+load_dotenv()
+
+MAIL_JOBS_DDL = """
+CREATE TABLE IF NOT EXISTS `mail_jobs` (
+  `id` INT NOT NULL AUTO_INCREMENT,
+  `claim_id` VARCHAR(100) NOT NULL,
+  `sender_email` VARCHAR(255) NOT NULL,
+  `subject` TEXT NULL,
+  `content` LONGTEXT NULL,
+  `local_attachment_paths` JSON NULL,
+  `status` VARCHAR(45) NOT NULL DEFAULT 'PENDING',
+  `error_message` TEXT NULL,
+  `created_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `last_processed_at` DATETIME NULL,
+  `current_stage` VARCHAR(45) NULL,
+  `stage_updated_at` DATETIME NULL,
+  `worker_id` VARCHAR(100) NULL,
+  `lease_expires_at` DATETIME NULL,
+  `attempt_count` INT NOT NULL DEFAULT 0,
+  `checkpoint` JSON NULL,
+  `next_attempt_at` DATETIME NULL,
+  `stage_timings` JSON NULL,
+  PRIMARY KEY (`id`),
+  INDEX `idx_status_last_processed_at` (`status` ASC, `last_processed_at` ASC),
+  INDEX `idx_status_lease_expires_at` (`status` ASC, `lease_expires_at` ASC),
+  INDEX `idx_status_next_attempt_at` (`status` ASC, `next_attempt_at` ASC)
+) ENGINE = InnoDB
+"""
+
+
+def fill_queue(connection, depth):
+    """Reset mail_jobs and insert `depth` PENDING jobs."""
+    with connection.cursor() as cursor:
+        # Recreate rather than truncate so the scratch table tracks the current schema
+        cursor.execute("DROP TABLE IF EXISTS mail_jobs")
+        cursor.execute(MAIL_JOBS_DDL)
+        now = datetime.now()
+        rows = [
+            (f"CLAIM_BENCH{i:06d}", "bench@example.com", "Benchmark claim", "Benchmark body", "[]", now)
+            for i in range(depth)
+        ]
+        cursor.executemany("""
+            INSERT INTO mail_jobs
+            (claim_id, sender_email, subject, content, local_attachment_paths, status, created_at)
+            VALUES (%s, %s, %s, %s, %s, 'PENDING', %s)
+        """, rows)
+    connection.commit()
+
+
+def drain_queue(worker, batch_size):
+    """Claim every job in the queue and return (claimed, seconds)."""
+    worker.claim_batch_size = batch_size
+    worker.job_buffer.clear()
+    
+    claimed = 0
+    start = time.perf_counter()
+    while worker.get_next_pending_job():
+        claimed += 1
+    return claimed, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depths', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+    
+    bench_db = os.getenv('BENCH_MYSQL_DB')
+    if not bench_db or bench_db == os.getenv('mysql_db'):
+        print("[ERROR] Set BENCH_MYSQL_DB to a scratch database (it must differ from mysql_db).")
+        return 1
+    os.environ['mysql_db'] = bench_db
+    
+    from worker import MailWorker
+    worker = MailWorker()
+    if not worker.db_connection:
+        return 1
+    
+    print(f"\n{'depth':>8} {'batch':>6} {'claimed':>8} {'seconds':>9} {'claims/sec':>11}")
+    print("-" * 46)
+    for depth in args.depths:
+        for batch_size in args.batch_sizes:
+            fill_queue(worker.db_connection, depth)
+            claimed, seconds = drain_queue(worker, batch_size)
+            rate = claimed / seconds if seconds else 0.0
+            print(f"{depth:>8} {batch_size:>6} {claimed:>8} {seconds:>9.3f} {rate:>11.1f}")
+    
+    with worker.db_connection.cursor() as cursor:
+        cursor.execute("TRUNCATE TABLE mail_jobs")
+    worker.db_connection.commit()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
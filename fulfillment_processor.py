@@ -5,14 +5,42 @@ import base64
 import uuid
 import requests
 import re
+import time
+import threading
 from dotenv import load_dotenv
 from langchain_aws import ChatBedrockConverse
 from langchain_core.messages import HumanMessage, SystemMessage
 from datetime import datetime
 from s3_uploader import S3Uploader
+from attachment_store import attachment_digest, release_claim
+from assessment_cache import assessment_cache_key
+from prompt_templates import get_prompt_registry
+from image_preprocessor import ImagePreprocessor, is_image
+from pdf_extractor import PdfTextExtractor, is_pdf, CHARS_PER_TOKEN
+from prescreen import has_monetary_amount
+from http_client import get_service_client
+from resilience import NonRetryableError, is_rejected
+from metrics import histogram, counter
 
 load_dotenv()
 
+BEDROCK_REQUEST_SECONDS = histogram(
+    'bedrock_request_seconds',
+    'Latency of Bedrock LLM calls',
+    label_names=('model', 'outcome')
+)
+BEDROCK_TOKENS = counter(
+    'bedrock_tokens_total',
+    'Tokens reported by Bedrock',
+    label_names=('model', 'type')
+)
+# Base64 image bytes per LLM request; compare with bedrock_request_seconds when tuning IMAGE_MAX_DIMENSION
+LLM_IMAGE_PAYLOAD_BYTES = histogram(
+    'llm_image_payload_bytes',
+    'Encoded image bytes sent in one LLM request',
+    buckets=(0, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+)
+
 class FulfillmentProcessor:
     def __init__(self):
         # ... (all existing __init__ code is unchanged) ...
@@ -23,42 +51,47 @@ class FulfillmentProcessor:
             os.environ["AWS_BEARER_TOKEN_BEDROCK"] = _bedrock_token
         
         self.bedrock_client = boto3.client(service_name="bedrock-runtime", region_name=self.aws_region)
+        self.model_id = os.getenv("BEDROCK_MODEL_ID", "amazon.nova-pro-v1:0")
         self.llm = ChatBedrockConverse(
-            model_id=os.getenv("BEDROCK_MODEL_ID", "amazon.nova-pro-v1:0"),
+            model_id=self.model_id,
             temperature=float(os.getenv("BEDROCK_TEMPERATURE", "0.3")),
             max_tokens=int(os.getenv("BEDROCK_MAX_TOKENS", "1500")),
             client=self.bedrock_client,
         )
         
-        # Mail service configuration
-        self.mail_service_url = os.getenv('MAIL_SERVICE_URL', 'http://localhost:8001')
-        
-        # Fulfillment API configuration
-        self.fulfillment_api_url = os.getenv('FULFILLMENT_API_URL', 'http://localhost:8002')
+        # Mail service and Fulfillment API clients (pooled, with per-service timeouts)
+        self.mail_service_client = get_service_client('mail_service')
+        self.fulfillment_api_client = get_service_client('fulfillment_api')
         
         # S3 Uploader for completed fulfillments
         self.s3_uploader = S3Uploader()
+        # boto3 client creation is not thread-safe; workers may run several jobs at once
+        self.s3_lock = threading.Lock()
         
-        # Load prompts from files
-        self.prompts_folder = os.path.join(os.path.dirname(__file__), 'prompts')
+        # Parsed, cached prompt templates; raises at startup if one is missing
+        self.prompts = get_prompt_registry()
+        
+        # Downscales and re-encodes images before they go to the LLM
+        self.image_preprocessor = ImagePreprocessor()
+        # PDF text for the prompt, read page by page within a token budget
+        self.pdf_extractor = PdfTextExtractor()
+        self.pdf_claim_max_tokens = int(os.getenv('PDF_TEXT_MAX_TOKENS_PER_CLAIM', 6000))
     
     def load_prompt_file(self, filename):
-        # ... (all existing load_prompt_file code is unchanged) ...
-        """Load content from prompt file"""
+        """Load content from prompt file (cached; re-read when the file changes)"""
         try:
-            file_path = os.path.join(self.prompts_folder, filename)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read().strip()
+            return self.prompts.get(filename).text
         except Exception as e:
             print(f"[ERROR] Error loading prompt file {filename}: {e}")
             return None
     
     def encode_image(self, image_path):
-        # ... (all existing encode_image code is unchanged) ...
-        """Encode image file to base64"""
+        """Image as a base64 data URL with its real MIME type, downscaled by the image preprocessor"""
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            image = self.image_preprocessor.prepare(image_path)
+            if image is None:
+                return None
+            return f"data:{image.mime_type};base64,{base64.b64encode(image.data).decode('utf-8')}"
         except Exception as e:
             print(f"[ERROR] Error encoding image {image_path}: {e}")
             return None
@@ -75,11 +108,7 @@ class FulfillmentProcessor:
                 "mail_content": content
             }
             
-            response = requests.post(
-                f"{self.mail_service_url}/send-mail",
-                json=mail_request,
-                timeout=30
-            )
+            response = self.mail_service_client.post("/send-mail", json=mail_request)
             
             if response.status_code == 200:
                 print(f"[OK] Email sent successfully via mail service to {to_email}")
@@ -94,6 +123,61 @@ class FulfillmentProcessor:
         except Exception as e:
             raise e # Re-raise any other unexpected error
     
+    def invoke_llm(self, messages):
+        """Invoke the Bedrock model, recording latency and token usage."""
+        outcome = 'error'
+        start = time.perf_counter()
+        try:
+            response = self.llm.invoke(messages)
+            outcome = 'ok'
+        finally:
+            BEDROCK_REQUEST_SECONDS.observe(time.perf_counter() - start, model=self.model_id, outcome=outcome)
+        
+        usage = getattr(response, 'usage_metadata', None) or {}
+        for token_type in ('input_tokens', 'output_tokens'):
+            if usage.get(token_type):
+                BEDROCK_TOKENS.inc(usage[token_type], model=self.model_id, type=token_type.replace('_tokens', ''))
+        return response
+
+    def pdf_text_section(self, attachment_paths, duplicate_paths=()):
+        """Prompt section with the extracted text of PDF attachments, capped at PDF_TEXT_MAX_TOKENS_PER_CLAIM"""
+        remaining = self.pdf_claim_max_tokens * CHARS_PER_TOKEN
+        sections = []
+        for i, path in enumerate(attachment_paths, 1):
+            if not is_pdf(path) or path in duplicate_paths or not os.path.exists(path):
+                continue
+            filename = os.path.basename(path)
+            if remaining <= 0:
+                sections.append(f"--- #{i} {filename}: not included (text budget used up) ---")
+                continue
+            pdf_text = self.pdf_extractor.extract(path)
+            if pdf_text is None or not pdf_text.text:
+                sections.append(f"--- #{i} {filename}: no extractable text (scanned or protected) ---")
+                continue
+            text = pdf_text.text[:remaining]
+            remaining -= len(text)
+            truncated = pdf_text.truncated or len(text) < len(pdf_text.text)
+            sections.append(
+                f"--- #{i} {filename} (pages 1-{pdf_text.pages_read} of {pdf_text.page_count}"
+                f"{', truncated' if truncated else ''}) ---\n{text}"
+            )
+        if not sections:
+            return ""
+        return "\n\nTEXT EXTRACTED FROM PDF ATTACHMENTS:\n" + "\n\n".join(sections)
+    
+    def assessment_cache_key(self, email_data):
+        """Cache key for the LLM assessment of `email_data`, and the system prompt version it uses."""
+        prompt_version = self.prompts.get('fulfillment_system_prompt.txt').version
+        input_settings = {
+            'image_preprocess': self.image_preprocessor.enabled,
+            'image_max_dimension': self.image_preprocessor.max_dimension,
+            'image_jpeg_quality': self.image_preprocessor.jpeg_quality,
+            'pdf_max_tokens_per_file': self.pdf_extractor.max_tokens,
+            'pdf_max_pages': self.pdf_extractor.max_pages,
+            'pdf_max_tokens_per_claim': self.pdf_claim_max_tokens,
+        }
+        return assessment_cache_key(email_data, prompt_version, self.model_id, input_settings), prompt_version
+    
     def assess_fulfillment_with_llm(self, email_data):
         """
         Use LLM to assess if customer has provided all required fulfillment details.
@@ -118,10 +202,9 @@ class FulfillmentProcessor:
                     "type": "text",
                     "text": (
                         f"CLAIM FULFILLMENT ASSESSMENT\n\n"
-                        f"CUSTOMER DETAILS:\n"
-                        f"Email: {email_data['sender_email']}\n"
-                        f"Subject: {email_data['subject']}\n"
-                        f"Claim ID: {email_data['claim_id']}\n\n"
+                        # No sender or claim ID: they do not change the assessment, and
+                        # leaving them out lets the assessment cache match resubmissions
+                        f"Subject: {email_data['subject']}\n\n"
                         
                         f"EMAIL CONTENT TO ANALYZE:\n"
                         f"{email_data['content']}\n\n"
@@ -131,19 +214,34 @@ class FulfillmentProcessor:
                 }
             ]
             
-            # Add detailed attachment information
+            # Add detailed attachment information; identical files are listed but sent once
+            first_with_digest = {}
+            duplicate_paths = set()
             if email_data['attachment_paths']:
                 attachment_details = []
                 for i, path in enumerate(email_data['attachment_paths'], 1):
                     filename = os.path.basename(path)
                     file_size = os.path.getsize(path) if os.path.exists(path) else 0
                     file_ext = os.path.splitext(filename)[1].lower()
+                    try:
+                        digest = attachment_digest(path)
+                    except OSError:
+                        digest = None
+                    if digest and digest in first_with_digest:
+                        duplicate_paths.add(path)
+                        attachment_details.append(f"{i}. {filename} (same file as #{first_with_digest[digest]})")
+                        continue
+                    if digest:
+                        first_with_digest[digest] = i
                     attachment_details.append(f"{i}. {filename} ({file_ext}, {file_size} bytes)")
                 
                 user_content_parts[0]["text"] += "\n".join(attachment_details)
             else:
                 user_content_parts[0]["text"] += "No attachments provided"
             
+            # Text of PDF attachments (bills, reports), within the claim's token budget
+            user_content_parts[0]["text"] += self.pdf_text_section(email_data['attachment_paths'], duplicate_paths)
+            
             user_content_parts[0]["text"] += (
                 f"\n\nPLEASE ASSESS:\n"
                 f"- REASON FOR CLAIM: Is there a clear description of what happened?\n"
@@ -157,23 +255,29 @@ class FulfillmentProcessor:
             )
             
             # Add images to LLM analysis for visual proof validation
+            image_payload_bytes = 0
             for attachment_path in email_data['attachment_paths']:
-                if attachment_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    encoded_image = self.encode_image(attachment_path)
-                    if encoded_image:
+                if is_image(attachment_path):
+                    if attachment_path in duplicate_paths:
+                        print(f"[IMAGE] Skipped duplicate image: {os.path.basename(attachment_path)}")
+                        continue
+                    image_url = self.encode_image(attachment_path)
+                    if image_url:
                         user_content_parts.append({
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{encoded_image}"
+                                "url": image_url
                             }
                         })
+                        image_payload_bytes += len(image_url)
                         print(f"[IMAGE] Added image for analysis: {os.path.basename(attachment_path)}")
+            LLM_IMAGE_PAYLOAD_BYTES.observe(image_payload_bytes)
             
             user_prompt = HumanMessage(content=user_content_parts)
             
             # Invoke LLM
             print(f"[AI] Analyzing fulfillment requirements for {email_data['claim_id']}...")
-            response = self.llm.invoke([system_prompt, user_prompt])
+            response = self.invoke_llm([system_prompt, user_prompt])
             
             print(f"[AI] LLM Fulfillment Assessment:")
             print(response.content)
@@ -204,28 +308,8 @@ class FulfillmentProcessor:
         # Check for claim amount (enhanced detection)
         amount_keywords = ["amount", "dollar", "cost", "money", "price", "value", "sum", "total", "claim", "damage", "bill", "specific claim amount", "currency"]
         
-        # Also check if email content contains monetary values
-        email_content = email_data.get('content', '').lower()
-        has_monetary_value = False
-        
-        # Look for common monetary patterns
-        monetary_patterns = [
-            r'\$\s*[\d,]+',  # $2500, $2,500
-            r'rs\.?\s*[\d,]+',  # Rs 25000, Rs. 2,50,000
-            r'inr\s*[\d,]+',  # INR 25000
-            r'usd\s*[\d,]+',  # USD 2500
-            r'amount:?\s*[\d,]+',  # amount: 25000
-            r'cost:?\s*[\d,]+',  # cost: 25000
-            r'claim:?\s*[\d,]+',  # claim: 25000
-            r'damage:?\s*[\d,]+',  # damage: 25000
-            r'total:?\s*[\d,]+',  # total: 25000
-            r'[\d,]{3,}',  # Any number with 3+ digits (with commas)
-        ]
-        
-        for pattern in monetary_patterns:
-            if re.search(pattern, email_content):
-                has_monetary_value = True
-                break
+        # Also check if email content contains monetary values (patterns shared with the pre-screen)
+        has_monetary_value = has_monetary_amount(email_data.get('content', ''))
         
         # Only consider satisfied if LLM doesn't mention it as missing
         # Don't add to satisfied if amount keywords are found in missing items
@@ -247,8 +331,6 @@ class FulfillmentProcessor:
         # ... (all existing parse_fulfillment_response code is unchanged) ...
         """Parse LLM response to extract fulfillment status and details"""
         try:
-            import re
-            
             print(f"[AI] Raw LLM Response:")
             print(f"{llm_response}")
             print("-" * 60)
@@ -302,15 +384,15 @@ class FulfillmentProcessor:
             email_content = ""
             if status == "PENDING":
                 # Always use our template to ensure consistent formatting with both satisfied and missing items
-                email_template = self.load_prompt_file('fulfillment_pending_email.txt')
+                try:
+                    email_template = self.prompts.get('fulfillment_pending_email.txt')
+                except OSError as e:
+                    print(f"[ERROR] Error loading prompt file fulfillment_pending_email.txt: {e}")
+                    email_template = None
                 if email_template:
-                    # Parse subject and content from template
-                    lines = email_template.split('\n')
-                    subject = lines[0].replace('Subject: ', '') if lines[0].startswith('Subject: ') else "Insurance Claim - Additional Information Required"
-                    
-                    # Get content after subject line and empty line
-                    content_start = 2 if len(lines) > 1 and lines[1] == '' else 1
-                    template_content = '\n'.join(lines[content_start:])
+                    # Subject and body were split out when the template was loaded
+                    subject = email_template.subject or "Insurance Claim - Additional Information Required"
+                    template_content = email_template.body
                     
                     # Format template with satisfied and missing items
                     satisfied_items_text = "\n".join(satisfied_items) if satisfied_items else "None identified"
@@ -404,11 +486,7 @@ class FulfillmentProcessor:
             print(f"[PROCESS] Calling fulfillment API...")
             
             # Make API call
-            response = requests.post(
-                f"{self.fulfillment_api_url}/add-fulfillment",
-                json=api_data,
-                headers={"Content-Type": "application/json"}
-            )
+            response = self.fulfillment_api_client.post("/add-fulfillment", json=api_data)
             
             if response.status_code == 200:
                 result = response.json()
@@ -422,10 +500,15 @@ class FulfillmentProcessor:
                     print(f"[DATA] Record includes: Local content + {attachment_count} local attachments")
                     
                 return fulfillment_id
+            elif is_rejected(response.status_code):
+                # The API refused this record; sending it again would get the same answer
+                raise NonRetryableError(f"Fulfillment API rejected the request: {response.status_code} - {response.text}")
             else:
                 # Raise an error with the details
                 raise Exception(f"Fulfillment API call failed: {response.status_code} - {response.text}")
                 
+        except NonRetryableError:
+            raise
         except Exception as e:
             # Re-raise the exception for the worker to catch
             raise Exception(f"Error calling fulfillment API: {e}")
@@ -472,7 +555,9 @@ class FulfillmentProcessor:
                     raise Exception("No AWS credentials provided")
             
             # Authenticate S3 uploader
-            if not self.s3_uploader.authenticate_aws_session(aws_credentials):
+            with self.s3_lock:
+                authenticated = self.s3_uploader.authenticate_aws_session(aws_credentials)
+            if not authenticated:
                 print(f"[ERROR] S3 authentication failed")
                 raise Exception("S3 authentication failed")
             
@@ -493,57 +578,11 @@ class FulfillmentProcessor:
             raise Exception(f"Error during S3 upload: {e}")
     
     def cleanup_local_files_after_s3_upload(self, email_data):
-        # ... (all existing cleanup_local_files_after_s3_upload code is unchanged) ...
-        """Delete local attachment files and claim folder after successful S3 upload"""
+        """Release the claim's attachments after a successful S3 upload; content other claims still use is kept"""
         try:
-            print(f"[CLEANUP] Starting cleanup of local files for claim: {email_data['claim_id']}")
-            
-            deleted_files = 0
-            failed_deletions = 0
-            
-            # Delete individual attachment files
-            if email_data.get('attachment_paths'):
-                for attachment_path in email_data['attachment_paths']:
-                    try:
-                        if os.path.exists(attachment_path):
-                            os.remove(attachment_path)
-                            deleted_files += 1
-                            print(f"[DELETE] Deleted: {os.path.basename(attachment_path)}")
-                        else:
-                            print(f"[WARN] File not found (already deleted?): {os.path.basename(attachment_path)}")
-                    except Exception as e:
-                        failed_deletions += 1
-                        print(f"[ERROR] Failed to delete {os.path.basename(attachment_path)}: {e}")
-            
-            # Try to delete the claim folder if it's empty
-            try:
-                # Extract the claim folder path from the first attachment
-                if email_data.get('attachment_paths') and len(email_data['attachment_paths']) > 0:
-                    first_attachment = email_data['attachment_paths'][0]
-                    claim_folder = os.path.dirname(first_attachment)
-                    
-                    # Check if folder exists and is empty
-                    if os.path.exists(claim_folder) and not os.listdir(claim_folder):
-                        os.rmdir(claim_folder)
-                        print(f"[FOLDER] Deleted empty claim folder: {os.path.basename(claim_folder)}")
-                    elif os.path.exists(claim_folder):
-                        remaining_files = os.listdir(claim_folder)
-                        print(f"[FOLDER] Claim folder not deleted (contains {len(remaining_files)} files): {remaining_files}")
-                    else:
-                        print(f"[FOLDER] Claim folder already deleted: {claim_folder}")
-                        
-            except Exception as e:
-                print(f"[ERROR] Error deleting claim folder: {e}")
-            
-            # Summary
-            if deleted_files > 0:
-                print(f"[OK] Cleanup completed: {deleted_files} files deleted")
-            if failed_deletions > 0:
-                print(f"[WARN] Cleanup issues: {failed_deletions} files failed to delete")
-            
-            if deleted_files > 0 and failed_deletions == 0:
-                print(f"[OK] All local files successfully cleaned up - space saved!")
-                
+            attachment_paths = email_data.get('attachment_paths') or []
+            print(f"[CLEANUP] Releasing {len(attachment_paths)} attachments of claim: {email_data['claim_id']}")
+            deleted = release_claim(email_data['claim_id'], attachment_paths)
+            print(f"[OK] Cleanup completed: {deleted} files deleted (content still used by other claims is kept)")
         except Exception as e:
             print(f"[ERROR] Error during local file cleanup: {e}")
-    
@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+from metrics import histogram
+
+load_dotenv()
+
+# The local FastAPI services: name -> (base URL env var, default URL, default timeout seconds)
+SERVICES = {
+    'user_validator': ('FASTAPI_BASE_URL', 'http://localhost:8000', 10),
+    'mail_service': ('MAIL_SERVICE_URL', 'http://localhost:8001', 30),
+    'fulfillment_api': ('FULFILLMENT_API_URL', 'http://localhost:8002', 30),
+}
+
+HTTP_REQUEST_SECONDS = histogram(
+    'http_client_request_seconds',
+    'Latency of calls to the local API services',
+    label_names=('service', 'endpoint', 'method', 'status')
+)
+
+
+class ServiceClient:
+    """
+    Keep-alive HTTP client for one local service. Connections are pooled and
+    reused across calls and threads. Connection failures are retried for every
+    method; 502/503/504 responses are retried only for idempotent methods.
+    """
+
+    def __init__(self, name, base_url, timeout, retries=2, pool_size=10):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS'}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, endpoint=None, **kwargs):
+        """
+        Send a request to `path` on this service. `endpoint` is the label used for
+        latency metrics (defaults to `path`; pass a template such as '/user/{email}'
+        when the path contains identifiers). Raises requests.exceptions.RequestException.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        status = 'error'
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                service=self.name, endpoint=endpoint or path, method=method, status=status
+            )
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_service_client(name):
+    """Shared, lazily created client for one of the local services in SERVICES."""
+    with _clients_lock:
+        if name not in _clients:
+            url_env, default_url, default_timeout = SERVICES[name]
+            prefix = name.upper()
+            _clients[name] = ServiceClient(
+                name,
+                os.getenv(url_env, default_url),
+                timeout=float(os.getenv(f'{prefix}_TIMEOUT_SECONDS', default_timeout)),
+                retries=int(os.getenv(f'{prefix}_RETRIES', 2)),
+                pool_size=int(os.getenv('HTTP_POOL_SIZE', 10))
+            )
+        return _clients[name]
@@ -0,0 +1,185 @@
+import io
+import os
+import time
+import uuid
+import shutil
+import mimetypes
+from dotenv import load_dotenv
+from attachment_store import attachment_digest, derived_folder
+from metrics import counter, histogram
+
+try:
+    from PIL import Image, ImageOps
+except ImportError: # Pillow is optional; without it images are sent unchanged
+    Image = None
+
+load_dotenv()
+
+IMAGES_PREPARED = counter(
+    'images_prepared_total',
+    'Images prepared for the LLM, by result (resized, reencoded, original, cached, unsupported, error)',
+    label_names=('result',)
+)
+IMAGE_BYTES_IN = counter('image_preprocess_input_bytes_total', 'Size of the original images prepared for the LLM')
+IMAGE_BYTES_SAVED = counter('image_preprocess_saved_bytes_total', 'Bytes removed from images before sending them to the LLM')
+IMAGE_PREPROCESS_SECONDS = histogram(
+    'image_preprocess_seconds',
+    'Time to prepare one image for the LLM',
+    label_names=('cache',)
+)
+
+# Formats the Bedrock vision models accept as-is; anything else must be converted
+SUPPORTED_MIME_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/gif': 'gif', 'image/webp': 'webp'}
+MIME_TYPES_BY_EXTENSION = {extension: mime_type for mime_type, extension in EXTENSIONS.items()}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+
+
+def sniff_mime_type(path):
+    """MIME type from the file's magic bytes (attachment names are not trustworthy), else its extension."""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.startswith(b'BM'):
+        return 'image/bmp'
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'image/tiff'
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def is_image(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+class PreparedImage:
+    """An image ready for the LLM: `data` (bytes) and its `mime_type`."""
+
+    def __init__(self, data, mime_type):
+        self.data = data
+        self.mime_type = mime_type
+
+
+class ImagePreprocessor:
+    """
+    Shrinks attachment images before they are sent to the LLM: downscaled to
+    IMAGE_MAX_DIMENSION, EXIF-rotated and re-encoded as JPEG (PNG if the image
+    has transparency), keeping the original when that is smaller. Results are
+    cached next to the stored attachment, per content hash and settings.
+    """
+
+    def __init__(self):
+        self.max_dimension = int(os.getenv('IMAGE_MAX_DIMENSION', 1568))
+        self.jpeg_quality = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+        self.enabled = os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+        if self.enabled and Image is None:
+            print("[WARN] Pillow is not installed; images are sent to the LLM at full size")
+            self.enabled = False
+
+    def _cache_name(self):
+        return f"image-{self.max_dimension}-q{self.jpeg_quality}"
+
+    def _cached(self, digest):
+        folder = derived_folder(digest)
+        prefix = self._cache_name() + '.'
+        try:
+            names = [name for name in os.listdir(folder) if name.startswith(prefix)]
+        except FileNotFoundError:
+            return None
+        if not names:
+            return None
+        mime_type = MIME_TYPES_BY_EXTENSION[os.path.splitext(names[0])[1][1:]]
+        with open(os.path.join(folder, names[0]), 'rb') as f:
+            return PreparedImage(f.read(), mime_type)
+
+    def _store(self, digest, image, source_path=None):
+        """Cache a prepared image (hard-linking the original when it was kept unchanged)."""
+        folder = derived_folder(digest)
+        os.makedirs(folder, exist_ok=True)
+        final_path = os.path.join(folder, f"{self._cache_name()}.{EXTENSIONS[image.mime_type]}")
+        partial_path = os.path.join(folder, f"{uuid.uuid4().hex}.part")
+        try:
+            if source_path:
+                try:
+                    os.link(source_path, partial_path)
+                except OSError:
+                    shutil.copyfile(source_path, partial_path)
+            else:
+                with open(partial_path, 'wb') as f:
+                    f.write(image.data)
+            os.replace(partial_path, final_path)
+        except OSError as e:
+            print(f"[WARN] Could not cache prepared image {digest[:12]}: {e}")
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def _convert(self, path):
+        """Downscale and re-encode with Pillow. Returns (PreparedImage, resized)."""
+        with Image.open(path) as img:
+            img.seek(0) # First frame of animated GIFs
+            img = ImageOps.exif_transpose(img)
+            resized = max(img.size) > self.max_dimension
+            if resized:
+                img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+
+            out = io.BytesIO()
+            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+            if has_alpha:
+                img.convert('RGBA').save(out, format='PNG', optimize=True)
+                return PreparedImage(out.getvalue(), 'image/png'), resized
+            img.convert('RGB').save(out, format='JPEG', quality=self.jpeg_quality, optimize=True)
+            return PreparedImage(out.getvalue(), 'image/jpeg'), resized
+
+    def prepare(self, path):
+        """The image at `path` as a PreparedImage, or None if it cannot be sent to the LLM."""
+        start = time.perf_counter()
+        filename = os.path.basename(path)
+        digest = attachment_digest(path)
+        if self.enabled:
+            cached = self._cached(digest)
+            if cached:
+                IMAGES_PREPARED.inc(result='cached')
+                IMAGE_PREPROCESS_SECONDS.observe(time.perf_counter() - start, cache='hit')
+                return cached
+
+        original_size = os.path.getsize(path)
+        original_mime = sniff_mime_type(path)
+        prepared, result, source_path = None, 'original', path
+        if self.enabled:
+            try:
+                converted, resized = self._convert(path)
+                # Re-encoding a small, already compressed image can make it bigger
+                if resized or original_mime not in SUPPORTED_MIME_TYPES or len(converted.data) < original_size:
+                    prepared, source_path = converted, None
+                    result = 'resized' if resized else 'reencoded'
+            except Exception as e:
+                # Fall back to the original image
+                print(f"[WARN] Could not preprocess image {filename}: {e}")
+                result = 'error'
+
+        if prepared is None:
+            if original_mime not in SUPPORTED_MIME_TYPES:
+                print(f"[WARN] Skipping image {filename}: {original_mime} is not supported by the LLM")
+                IMAGES_PREPARED.inc(result='unsupported')
+                return None
+            with open(path, 'rb') as f:
+                prepared = PreparedImage(f.read(), original_mime)
+
+        if self.enabled:
+            self._store(digest, prepared, source_path)
+        elapsed = time.perf_counter() - start
+        IMAGES_PREPARED.inc(result=result)
+        IMAGE_BYTES_IN.inc(original_size)
+        IMAGE_BYTES_SAVED.inc(max(original_size - len(prepared.data), 0))
+        IMAGE_PREPROCESS_SECONDS.observe(elapsed, cache='miss')
+        print(
+            f"[IMAGE] Prepared {filename}: {original_size // 1024} KB {original_mime} -> "
+            f"{len(prepared.data) // 1024} KB {prepared.mime_type} ({result}, {elapsed * 1000:.0f} ms)"
+        )
+        return prepared
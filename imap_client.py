@@ -0,0 +1,396 @@
+import os
+import re
+import json
+import ssl
+import base64
+import quopri
+import imaplib
+import threading
+from email.header import decode_header, make_header
+from urllib.parse import unquote
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def get_imap_config():
+    """IMAP connection settings shared by the mail monitor and the worker."""
+    return {
+        'server': os.getenv("IMAP_SERVER", "imap.gmail.com"),
+        'port': int(os.getenv("IMAP_PORT", 993)),
+        'ssl': os.getenv("IMAP_SSL", "true").lower() == "true",
+        'username': os.getenv("EMAIL_USERNAME"),
+        'password': os.getenv("EMAIL_APP_PASSWORD"),
+        'mailbox': os.getenv("IMAP_MAILBOX", "inbox"),
+    }
+
+
+DEFAULT_SOURCE = 'default'
+
+
+def get_mail_sources():
+    """
+    Account/folder sources to ingest from. MAIL_SOURCES is a JSON list of
+    objects with a unique "name" and any of server, port, ssl, username,
+    password (or password_env, the variable holding it) and mailbox; missing
+    keys fall back to the IMAP_* settings. Without MAIL_SOURCES there is a
+    single source, "default", configured by the IMAP_* settings alone.
+    """
+    defaults = get_imap_config()
+    raw = os.getenv("MAIL_SOURCES", "").strip()
+    if not raw:
+        return [{**defaults, 'name': DEFAULT_SOURCE}]
+
+    sources = []
+    for entry in json.loads(raw):
+        source = {**defaults, **{key: value for key, value in entry.items() if key != 'password_env'}}
+        if entry.get('password_env'):
+            source['password'] = os.getenv(entry['password_env'])
+        source['port'] = int(source['port'])
+        if isinstance(source['ssl'], str):
+            source['ssl'] = source['ssl'].lower() == 'true'
+        if not source.get('name'):
+            raise ValueError("Every MAIL_SOURCES entry needs a name")
+        if any(other['name'] == source['name'] for other in sources):
+            raise ValueError(f"Duplicate mail source name: {source['name']}")
+        sources.append(source)
+    return sources
+
+
+def connect_imap(config):
+    """Open and log in to an IMAP connection. Raises imaplib.IMAP4.error or OSError."""
+    if config['ssl']:
+        connection = imaplib.IMAP4_SSL(config['server'], config['port'], ssl_context=ssl.create_default_context())
+    else:
+        connection = imaplib.IMAP4(config['server'], config['port'])
+    connection.login(config['username'], config['password'])
+    return connection
+
+
+# --- FETCH response parsing ---
+
+class _Open:
+    pass
+
+
+class _Close:
+    pass
+
+
+OPEN, CLOSE = _Open(), _Close()
+
+
+def _decode(value):
+    return value.decode('utf-8', errors='replace')
+
+
+def _tokenize(data):
+    """
+    Tokens of an untagged FETCH response as returned by imaplib: a list of
+    bytes and (bytes ending in '{n}', literal bytes) tuples. Literals are
+    yielded as bytes, quoted strings and atoms as str, NIL as None.
+    """
+    for piece in data:
+        literal = None
+        if isinstance(piece, tuple):
+            text, literal = piece
+            text = text[:text.rfind(b'{')]
+        else:
+            text = piece
+        if text is None:
+            continue
+
+        i = 0
+        while i < len(text):
+            char = text[i:i + 1]
+            if char in b' \r\n':
+                i += 1
+            elif char == b'(':
+                yield OPEN
+                i += 1
+            elif char == b')':
+                yield CLOSE
+                i += 1
+            elif char == b'"':
+                value = bytearray()
+                i += 1
+                while i < len(text) and text[i:i + 1] != b'"':
+                    if text[i:i + 1] == b'\\':
+                        i += 1
+                    value += text[i:i + 1]
+                    i += 1
+                yield _decode(bytes(value))
+                i += 1
+            else:
+                # Atom; section specifiers like BODY[HEADER.FIELDS (FROM)] are kept whole
+                start = i
+                depth = 0
+                while i < len(text):
+                    char = text[i:i + 1]
+                    if char == b'[':
+                        depth += 1
+                    elif char == b']':
+                        depth -= 1
+                    elif depth == 0 and char in b' ()\r\n':
+                        break
+                    i += 1
+                atom = _decode(text[start:i])
+                yield None if atom.upper() == 'NIL' else atom
+        if literal is not None:
+            yield literal
+
+
+def _parse(tokens):
+    """Nest a token stream into lists."""
+    stack = [[]]
+    for token in tokens:
+        if token is OPEN:
+            stack.append([])
+        elif token is CLOSE:
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def parse_fetch_response(data):
+    """
+    Parse the data of a UID FETCH into {uid: {ITEM: value}}, e.g.
+    {12: {'UID': '12', 'BODYSTRUCTURE': [...], 'BODY[1]': b'...'}}.
+    Requests must include UID so responses can be matched to messages.
+    """
+    messages = {}
+    items = _parse(_tokenize(data))
+    for item in items:
+        if not isinstance(item, list):
+            continue # Message sequence number
+        fields = {}
+        for key, value in zip(item[0::2], item[1::2]):
+            if isinstance(key, str):
+                fields[key.upper()] = value
+        if 'UID' in fields:
+            messages[int(fields['UID'])] = fields
+    return messages
+
+
+def find_section(fields, section, offset=None):
+    """
+    Body of BODY[<section>] from parsed FETCH fields (servers may echo BODY.PEEK
+    as BODY). Pass `offset` for a partial fetch, which comes back as BODY[<section>]<offset>.
+    """
+    key = f'BODY[{section}]'.upper()
+    if offset is not None:
+        key += f'<{offset}>'
+    value = fields.get(key)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return value
+
+
+# --- BODYSTRUCTURE ---
+
+def _pairs(values):
+    """('name' 'value' ...) parameter list -> dict with lowercase keys."""
+    if not isinstance(values, list):
+        return {}
+    return {
+        str(key).lower(): value
+        for key, value in zip(values[0::2], values[1::2])
+        if key is not None
+    }
+
+
+def _decode_filename(params):
+    if 'filename*' in params:
+        # RFC 2231: charset'language'percent-encoded
+        charset, _, value = str(params['filename*']).split("'", 2)
+        return unquote(value, encoding=charset or 'utf-8', errors='replace')
+    filename = params.get('filename') or params.get('name')
+    if isinstance(filename, bytes):
+        filename = _decode(filename)
+    if filename:
+        # RFC 2047 encoded-words
+        return str(make_header(decode_header(filename)))
+    return None
+
+
+def list_parts(structure, section=''):
+    """
+    Flatten a parsed BODYSTRUCTURE into leaf parts:
+    [{'section', 'content_type', 'charset', 'encoding', 'size', 'disposition', 'filename'}, ...]
+    """
+    if structure and isinstance(structure[0], list):
+        # Multipart: child bodies come first, then the subtype and extensions
+        parts = []
+        for number, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            parts.extend(list_parts(child, f"{section}.{number}" if section else str(number)))
+        return parts
+
+    main_type = str(structure[0] or 'text').lower()
+    sub_type = str(structure[1] or 'plain').lower()
+    params = _pairs(structure[2])
+
+    # Extension data starts after the type-specific fields
+    extension_index = 7
+    if main_type == 'text':
+        extension_index = 8
+    elif main_type == 'message' and sub_type == 'rfc822':
+        extension_index = 10
+
+    disposition = None
+    disposition_params = {}
+    if len(structure) > extension_index + 1 and isinstance(structure[extension_index + 1], list):
+        disposition_field = structure[extension_index + 1]
+        disposition = str(disposition_field[0] or '').lower()
+        disposition_params = _pairs(disposition_field[1] if len(disposition_field) > 1 else None)
+
+    return [{
+        'section': section or '1',
+        'content_type': f"{main_type}/{sub_type}",
+        'charset': params.get('charset') or 'utf-8',
+        'encoding': str(structure[5] or '7bit').lower(),
+        'size': int(structure[6] or 0),
+        'disposition': disposition,
+        'filename': _decode_filename({**params, **disposition_params}),
+    }]
+
+
+class StreamDecoder:
+    """
+    Incremental Content-Transfer-Encoding decoder: feed() encoded chunks of any
+    size and get back the decoded bytes that are complete so far.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.pending = b''
+
+    def feed(self, data):
+        if self.encoding == 'base64':
+            # Decode whole 4-character groups; keep the remainder for the next chunk
+            data = self.pending + re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+            usable = len(data) - len(data) % 4
+            self.pending = data[usable:]
+            return base64.b64decode(data[:usable])
+        if self.encoding == 'quoted-printable':
+            # Decode whole lines so soft breaks and =XX escapes are never split
+            data = self.pending + data
+            cut = data.rfind(b'\n') + 1
+            self.pending = data[cut:]
+            return quopri.decodestring(data[:cut])
+        return data
+
+    def flush(self):
+        pending, self.pending = self.pending, b''
+        if self.encoding == 'base64':
+            return base64.b64decode(pending + b'=' * (-len(pending) % 4)) if pending else b''
+        if self.encoding == 'quoted-printable':
+            return quopri.decodestring(pending)
+        return pending
+
+
+def decode_part(data, encoding):
+    """Undo a part's Content-Transfer-Encoding."""
+    decoder = StreamDecoder(encoding)
+    return decoder.feed(data) + decoder.flush()
+
+
+class AttachmentTooLarge(ValueError):
+    """A part decoded to more bytes than the caller allowed."""
+
+
+# --- Worker-side attachment download ---
+
+class AttachmentFetcher:
+    """
+    Downloads single MIME parts of a message still in the mailbox, for
+    attachments the monitor recorded but did not download. Each thread keeps
+    its own IMAP connection per mail source.
+    """
+
+    def __init__(self):
+        self.sources = {source['name']: source for source in get_mail_sources()}
+        # Jobs queued before mail sources existed have no source name
+        self.default_source = next(iter(self.sources))
+        # Large parts are fetched in slices of this many (encoded) bytes
+        self.chunk_bytes = max(4096, int(os.getenv("IMAP_FETCH_CHUNK_BYTES", 1024 * 1024)))
+        self._local = threading.local()
+
+    def _connection(self, source_name):
+        """(connection, state) for this thread and source; state['selected'] is the open mailbox."""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if source_name not in connections:
+            if source_name not in self.sources:
+                raise LookupError(f"Unknown mail source {source_name}")
+            connections[source_name] = (connect_imap(self.sources[source_name]), {'selected': None})
+        return connections[source_name]
+
+    def _select(self, connection, state, mailbox, uid_validity):
+        if state['selected'] != (mailbox, uid_validity):
+            status, _ = connection.select(mailbox, readonly=True)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"Could not open mailbox {mailbox}")
+            _, data = connection.response('UIDVALIDITY')
+            if uid_validity is not None and data and data[-1] is not None and int(data[-1]) != int(uid_validity):
+                raise LookupError(f"Mailbox {mailbox} was rebuilt (UIDVALIDITY changed); the message is gone")
+            state['selected'] = (mailbox, uid_validity)
+
+    def _fetch(self, source_name, mailbox, uid_validity, uid, section, offset=None):
+        source_name = source_name or self.default_source
+        item = f"BODY.PEEK[{section}]"
+        if offset is not None:
+            item += f"<{offset}.{self.chunk_bytes}>"
+        try:
+            connection, state = self._connection(source_name)
+            self._select(connection, state, mailbox, uid_validity)
+            status, data = connection.uid('FETCH', str(uid), f"(UID {item})")
+        except (imaplib.IMAP4.abort, OSError):
+            # Stale connection: drop it so the next attempt reconnects
+            self._local.connections.pop(source_name, None)
+            raise
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH {uid} {item} failed")
+
+        fields = parse_fetch_response(data).get(int(uid))
+        if not fields:
+            raise LookupError(f"Message UID {uid} is no longer in {mailbox}")
+        return find_section(fields, section, offset)
+
+    def fetch_part(self, source_name, mailbox, uid_validity, uid, section):
+        """
+        Raw (still transfer-encoded) body of one part.
+        Raises LookupError if the message is no longer in the mailbox.
+        """
+        body = self._fetch(source_name, mailbox, uid_validity, uid, section)
+        if body is None:
+            raise LookupError(f"Message UID {uid} has no part {section}")
+        return body
+
+    def stream_part(self, source_name, mailbox, uid_validity, uid, section, encoding, out, max_bytes=None):
+        """
+        Download one part in IMAP_FETCH_CHUNK_BYTES slices (partial FETCH),
+        decoding each slice straight into the binary file `out`, so memory use
+        does not grow with the attachment. Returns the decoded size.
+        Raises AttachmentTooLarge past `max_bytes`, LookupError if the message is gone.
+        """
+        decoder = StreamDecoder(encoding)
+        offset = 0
+        written = 0
+        while True:
+            chunk = self._fetch(source_name, mailbox, uid_validity, uid, section, offset) or b''
+            offset += len(chunk)
+            decoded = decoder.feed(chunk)
+            if len(chunk) < self.chunk_bytes:
+                decoded += decoder.flush()
+            written += len(decoded)
+            if max_bytes is not None and written > max_bytes:
+                raise AttachmentTooLarge(f"Part {section} of UID {uid} exceeds {max_bytes} bytes")
+            out.write(decoded)
+            if len(chunk) < self.chunk_bytes:
+                return written
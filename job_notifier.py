@@ -0,0 +1,78 @@
+import os
+import socket
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Workers bind this UDP port on loopback; the mail monitor sends a datagram to the
+# loopback broadcast address after inserting jobs, so every idle worker process
+# wakes up at once. This is only a latency hint: workers still poll with backoff.
+WAKEUP_MESSAGE = b"mail_jobs:new"
+
+
+def get_wakeup_config():
+    """Return (address, port) for the wakeup channel."""
+    address = os.getenv('WORKER_WAKEUP_ADDRESS', '127.255.255.255')
+    port = int(os.getenv('WORKER_WAKEUP_PORT', 8765))
+    return address, port
+
+
+def notify_workers():
+    """Tell idle workers that new jobs are waiting. Best effort, never raises."""
+    address, port = get_wakeup_config()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(WAKEUP_MESSAGE, (address, port))
+        return True
+    except OSError as e:
+        print(f"[WARN] Could not signal workers: {e}")
+        return False
+
+
+class JobWakeupListener:
+    """Receives wakeup datagrams on a background thread and releases waiting slots."""
+
+    def __init__(self):
+        self.address, self.port = get_wakeup_config()
+        self.sock = None
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def start(self):
+        """Bind the wakeup socket. Returns False if the channel is unavailable."""
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Several worker processes share the port; broadcasts reach all of them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Bound to the wakeup address, not all interfaces, so nothing off the host can send wakeups
+            self.sock.bind((self.address, self.port))
+        except OSError as e:
+            print(f"[WARN] Wakeup channel unavailable on port {self.port}: {e}. Falling back to polling.")
+            self.sock = None
+            return False
+
+        threading.Thread(target=self._listen, name="job-wakeup", daemon=True).start()
+        print(f"[OK] Listening for new-job signals on UDP port {self.port}")
+        return True
+
+    def _listen(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(64)
+            except OSError as e:
+                print(f"[ERROR] Wakeup channel stopped: {e}")
+                return
+            if data == WAKEUP_MESSAGE:
+                with self.condition:
+                    self.generation += 1
+                    self.condition.notify_all()
+
+    def wait(self, seen_generation, timeout):
+        """
+        Block until a signal newer than `seen_generation` arrives or `timeout` expires.
+        Returns True if woken by a signal.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.generation != seen_generation, timeout)
@@ -0,0 +1,66 @@
+import json
+import math
+from datetime import datetime, timedelta
+
+# Order used when presenting per-stage statistics
+STAGE_ORDER = [
+    'queue_wait',
+    'USER_VALIDATION',
+    'ATTACHMENT_FETCH',
+    'ATTACHMENT_PREPROCESS',
+    'LLM_ASSESSMENT',
+    'LLM_PARSE',
+    'S3_UPLOAD',
+    'FULFILLMENT_API',
+    'MAIL_SERVICE',
+    'FINALIZE',
+]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def get_stage_percentiles(connection, since_hours=24, max_jobs=10000):
+    """
+    p50/p95/p99 seconds per stage for jobs processed in the last `since_hours`,
+    from mail_jobs.stage_timings. Returns a list of dicts ordered by pipeline stage:
+    [{'stage', 'jobs', 'p50', 'p95', 'p99', 'max'}, ...]
+    """
+    since = datetime.now() - timedelta(hours=since_hours)
+    with connection.cursor(dictionary=True) as cursor:
+        cursor.execute("""
+            SELECT stage_timings FROM mail_jobs
+            WHERE stage_timings IS NOT NULL AND last_processed_at >= %s
+            ORDER BY last_processed_at DESC
+            LIMIT %s
+        """, (since, max_jobs))
+        rows = cursor.fetchall()
+
+    samples = {}
+    for row in rows:
+        try:
+            timings = json.loads(row['stage_timings'])
+        except (TypeError, json.JSONDecodeError):
+            continue
+        for stage, seconds in timings.items():
+            if isinstance(seconds, (int, float)):
+                samples.setdefault(stage, []).append(seconds)
+
+    ordered = [s for s in STAGE_ORDER if s in samples] + sorted(s for s in samples if s not in STAGE_ORDER)
+    results = []
+    for stage in ordered:
+        values = sorted(samples[stage])
+        results.append({
+            'stage': stage,
+            'jobs': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'max': values[-1],
+        })
+    return results
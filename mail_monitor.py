@@ -1,27 +1,121 @@
 import os
+import sys
 import imaplib
 import email
-import ssl
 import time
+import select
 import mysql.connector
 from mysql.connector import Error
 import uuid
+import hashlib
 import json # Added for storing attachment paths
-from datetime import datetime
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 # from queue import Queue  <- No longer needed
 # from threading import Lock <- No longer needed
 from email.header import decode_header
 from dotenv import load_dotenv
+from job_notifier import notify_workers
+from imap_client import DEFAULT_SOURCE, get_mail_sources, connect_imap, parse_fetch_response, find_section, list_parts, decode_part
+from attachment_store import save_attachment, release_claim, get_attachment_limits, apply_size_limits, estimated_size
+from metrics import counter, gauge, histogram, start_metrics_server
 # from fulfillment_processor import FulfillmentProcessor <- No longer needed
 
 load_dotenv()
 
+IMAP_REQUEST_SECONDS = histogram('imap_request_seconds', 'Latency of IMAP commands', label_names=('command',))
+MAILS_INGESTED = counter('monitor_mails_ingested_total', 'Mails added to mail_jobs', label_names=('source',))
+MAIL_ERRORS = counter('monitor_mail_errors_total', 'Mails that could not be ingested', label_names=('source',))
+MAILS_HEADERS_ONLY = counter('monitor_headers_only_mails_total', 'Mails queued as headers only under backpressure', label_names=('source',))
+MAILS_HYDRATED = counter('monitor_hydrated_mails_total', 'Header-only jobs completed and released to the workers', label_names=('source',))
+BACKPRESSURE = gauge('monitor_backpressure', '1 while ingestion is limited to headers because the queue is too deep', label_names=('source',))
+MAIL_DUPLICATES = counter('monitor_duplicate_mails_total', 'Mails skipped because they were already in mail_jobs', label_names=('source',))
+SOURCE_RESTARTS = counter('monitor_source_restarts_total', 'Mail source loops restarted after they stopped', label_names=('source',))
+DB_QUERY_SECONDS = histogram('db_query_seconds', 'Latency of MySQL queries', label_names=('query',))
+
+def message_key(job):
+    """
+    Deduplication key of a parsed mail: SHA-256 of its Message-ID, or of
+    sender, date, subject and body text when it has none.
+    """
+    if job.get('message_id'):
+        return hashlib.sha256(b'message-id:' + job['message_id'].encode('utf-8', errors='replace')).hexdigest()
+    body = '\n'.join([job['sender_email'], job['date'], job['subject'], job['content']])
+    return hashlib.sha256(b'body:' + body.encode('utf-8', errors='replace')).hexdigest()
+
+class IngestScheduler:
+    """
+    Hands out ingestion turns (one fetch-and-insert batch each) to the mail
+    sources in request order, at most `concurrency` at a time. A source with a
+    backlog queues again after every batch, so a busy mailbox cannot starve
+    the others of queue positions.
+    """
+    
+    def __init__(self, concurrency):
+        self.concurrency = max(1, concurrency)
+        self.active = 0
+        self.waiting = deque()
+        self.condition = threading.Condition()
+    
+    @contextmanager
+    def turn(self):
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or self.active >= self.concurrency:
+                self.condition.wait()
+            self.waiting.popleft()
+            self.active += 1
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
 class MailMonitor:
-    def __init__(self):
-        self.username = os.getenv("EMAIL_USERNAME")
-        self.app_password = os.getenv("EMAIL_APP_PASSWORD")
-        self.imap_server = "imap.gmail.com"
-        self.imap_port = 993
+    def __init__(self, source=None, scheduler=None):
+        # One account/folder (see MAIL_SOURCES); point IMAP_SERVER/IMAP_PORT at a
+        # local stand-in (IMAP_SSL=false) for testing
+        self.imap_config = source or get_mail_sources()[0]
+        self.source_name = self.imap_config['name']
+        self.mailbox = self.imap_config['mailbox']
+        # Shared by the monitors of all sources
+        self.scheduler = scheduler or IngestScheduler(1)
+        
+        # 'idle' waits for the server to push new mail (when it supports IDLE); 'poll' sleeps between checks
+        self.monitor_mode = os.getenv("MAIL_MONITOR_MODE", "idle").lower()
+        self.poll_seconds = int(os.getenv("MAIL_POLL_SECONDS", 30))
+        # Servers may drop an IDLE after 30 minutes, so re-issue it well before that
+        self.idle_timeout_seconds = int(os.getenv("IMAP_IDLE_TIMEOUT_SECONDS", 25 * 60))
+        self.idle_supported = False
+        
+        # New mail is fetched and inserted in batches; attachments are written in parallel
+        self.fetch_batch_size = max(1, int(os.getenv("MAIL_FETCH_BATCH_SIZE", 50)))
+        # Attachments larger than this are only recorded in attachment_manifest;
+        # the worker downloads them if the claim gets that far
+        self.eager_attachment_bytes = int(os.getenv("MAIL_EAGER_ATTACHMENT_BYTES", 256 * 1024))
+        # Backpressure: past either threshold (0 = off) new mail is queued as headers
+        # only ('HEADERS_ONLY'); full downloads resume below RESUME_RATIO of the threshold
+        self.backpressure_pending_jobs = int(os.getenv("MAIL_BACKPRESSURE_PENDING_JOBS", 1000))
+        self.backpressure_pending_bytes = int(os.getenv("MAIL_BACKPRESSURE_PENDING_BYTES", 5 * 1024 ** 3))
+        self.backpressure_resume_ratio = float(os.getenv("MAIL_BACKPRESSURE_RESUME_RATIO", 0.8))
+        self.backpressure = False
+        # Unknown at startup; cleared once no header-only jobs are left for this source
+        self.has_headers_only = True
+        self.attachment_writers = ThreadPoolExecutor(
+            max_workers=int(os.getenv("MAIL_ATTACHMENT_WRITERS", 4)),
+            thread_name_prefix="attachment-writer"
+        )
+        # Checks are rolled up per hour in mail_poll_history and kept this long
+        self.poll_history_days = int(os.getenv("MAIL_POLL_HISTORY_DAYS", 30))
+        self.history_hour = None
+        self.jobs_added_since_poll = 0
         self.mail_connection = None
         self.db_connection = None
         # self.email_queue = Queue() <- REPLACED with mail_jobs table
@@ -32,19 +126,10 @@ class MailMonitor:
         # self.fastapi_base_url = os.getenv('FASTAPI_BASE_URL', 'http://localhost:8000') <- MOVED to worker.py
         # self.mail_service_url = os.getenv('MAIL_SERVICE_URL', 'http://localhost:8001') <- MOVED to worker.py
         
-        # Prompts folder
-        self.prompts_folder = os.path.join(os.path.dirname(__file__), 'prompts')
-        
-    def load_prompt_file(self, filename):
-        """Load content from prompt file"""
-        # ... existing code ...
-        try:
-            file_path = os.path.join(self.prompts_folder, filename)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read().strip()
-        except Exception as e:
-            print(f"[ERROR] Error loading prompt file {filename}: {e}")
-            return None
+        # self.prompts_folder = ... <- Templates are only used by worker.py (see prompt_templates.py)
+    
+    # --- REMOVED load_prompt_file ---
+    # (Prompt templates now come from prompt_templates.get_prompt_registry)
             
     def connect_to_database(self):
         """Connect to MySQL database using mysql.connector"""
@@ -70,19 +155,22 @@ class MailMonitor:
             return False
     
     def connect_to_mail_server(self):
-        """Connect to Gmail IMAP server"""
-        # ... existing code ...
+        """Connect to the IMAP server (Gmail by default)"""
         try:
-            context = ssl.create_default_context()
-            self.mail_connection = imaplib.IMAP4_SSL(self.imap_server, self.imap_port, ssl_context=context)
-            self.mail_connection.login(self.username, self.app_password)
+            self.mail_connection = connect_imap(self.imap_config)
+            
+            # Capabilities can change after login, so ask again
+            status, data = self.mail_connection.capability()
+            capabilities = data[0].decode().upper().split() if status == 'OK' and data and data[0] else []
+            self.idle_supported = 'IDLE' in capabilities
             
-            status, messages = self.mail_connection.select("inbox")
+            with IMAP_REQUEST_SECONDS.time(command='select'):
+                status, messages = self.mail_connection.select(self.mailbox)
             if status != 'OK':
-                print("[ERROR] Failed to select inbox")
+                print(f"[ERROR] Failed to select {self.mailbox}")
                 return False
             
-            print("[OK] Mail server connection established")
+            print(f"[OK] Mail server connection established for {self.source_name} ({self.imap_config['server']}:{self.imap_config['port']}/{self.mailbox}, IDLE {'supported' if self.idle_supported else 'not supported'})")
             return True
         except Exception as e:
             print(f"[ERROR] Mail server connection failed: {e}")
@@ -92,70 +180,148 @@ class MailMonitor:
     # --- REMOVED send_unregistered_user_email_via_service ---
     # (This logic is now in worker.py)
 
-    def get_current_mail_count(self):
-        """Get current mail count from mail server"""
-        # ... existing code ...
+    def _untagged_int(self, name):
+        """Integer value of an untagged response (e.g. UIDNEXT) to the last command, or None."""
+        _, data = self.mail_connection.response(name)
+        if data and data[-1] is not None:
+            return int(data[-1])
+        return None
+
+    def get_mailbox_state(self):
+        """
+        Select the mailbox and return {'mail_count', 'uid_validity', 'uid_next'}, or None.
+        One round trip, however large the mailbox is.
+        """
         try:
-            status, messages = self.mail_connection.select("inbox")
-            if status == 'OK':
-                mail_count = int(messages[0])
-                print(f"[EMAIL] Current mail count: {mail_count}")
-                return mail_count
-            return 0
+            with IMAP_REQUEST_SECONDS.time(command='select'):
+                status, messages = self.mail_connection.select(self.mailbox)
+            if status != 'OK':
+                return None
+            
+            state = {
+                'mail_count': int(messages[0]),
+                'uid_validity': self._untagged_int('UIDVALIDITY'),
+                'uid_next': self._untagged_int('UIDNEXT'),
+            }
+            if state['uid_validity'] is None or state['uid_next'] is None:
+                # Not every server sends these with SELECT; STATUS always reports them
+                with IMAP_REQUEST_SECONDS.time(command='status'):
+                    status, data = self.mail_connection.status(self.mailbox, "(UIDVALIDITY UIDNEXT)")
+                if status != 'OK':
+                    return None
+                response = data[0].decode() if isinstance(data[0], bytes) else str(data[0])
+                state['uid_validity'] = int(re.search(r'UIDVALIDITY (\d+)', response).group(1))
+                state['uid_next'] = int(re.search(r'UIDNEXT (\d+)', response).group(1))
+            
+            print(f"[EMAIL] {self.source_name} - Count: {state['mail_count']}, UIDVALIDITY: {state['uid_validity']}, UIDNEXT: {state['uid_next']}")
+            return state
         except Exception as e:
-            print(f"[ERROR] Error getting mail count: {e}")
-            return 0
+            print(f"[ERROR] Error getting mailbox state: {e}")
+            return None
     
     def get_stored_mail_details(self):
-        """Get last mail count and connection time from database"""
-        # ... existing code ...
+        """Get this source's sync checkpoint from database: {'uid_validity', 'last_uid', 'last_connection_time', ...} or None"""
         try:
             # Use dictionary=True to get dict results
-            with self.db_connection.cursor(dictionary=True) as cursor:
-                # Fixed table name to 'last_mail_details_vv' to match schema
-                cursor.execute("SELECT mail_count, last_connection_time FROM last_mail_details ORDER BY id DESC LIMIT 1")
+            with self.db_connection.cursor(dictionary=True) as cursor, DB_QUERY_SECONDS.time(query='get_checkpoint'):
+                cursor.execute("""
+                    SELECT mail_count, last_connection_time, uid_validity, last_uid
+                    FROM mail_checkpoints WHERE source_name = %s
+                """, (self.source_name,))
                 result = cursor.fetchone()
-                
-                if result:
-                    print(f"[DATA] Stored mail details - Count: {result['mail_count']}, Last connection: {result['last_connection_time']}")
-                    return result['mail_count'], result['last_connection_time']
-                else:
-                    print("[DATA] No previous mail details found in database")
-                    return 0, None
+            
+            if result is None:
+                result = self.get_legacy_mail_details()
+                if result and result['uid_validity'] is not None:
+                    # Carry the old checkpoint over so the legacy table is read only once
+                    self.update_mail_details(result['mail_count'], result['uid_validity'], result['last_uid'])
+            
+            if result:
+                print(f"[DATA] Stored checkpoint for {self.source_name} - UIDVALIDITY: {result['uid_validity']}, Last UID: {result['last_uid']}, Last connection: {result['last_connection_time']}")
+                return result
+            else:
+                print(f"[DATA] No previous mail details found in database for {self.source_name}")
+                return None
         except Exception as e:
             print(f"[ERROR] Error getting stored mail details: {e}")
-            return 0, None
+            return None
     
-    def update_mail_details(self, mail_count):
-        """Update mail count and connection time in database"""
-        # ... existing code ...
+    def get_legacy_mail_details(self):
+        """Latest row of the old append-only last_mail_details table, so upgrading keeps the checkpoint"""
         try:
-            current_time = datetime.now()
-            # Use dictionary=True for cursor
             with self.db_connection.cursor(dictionary=True) as cursor:
-                cursor.execute(
-                    "INSERT INTO last_mail_details (mail_count, last_connection_time) VALUES (%s, %s)",
-                    (mail_count, current_time)
-                )
-                self.db_connection.commit()
-                print(f"[OK] Updated database - Mail count: {mail_count}, Time: {current_time}")
-                return True
+                # Rows written before mail sources existed belong to the default source
+                cursor.execute("""
+                    SELECT mail_count, last_connection_time, uid_validity, last_uid
+                    FROM last_mail_details
+                    WHERE source_name = %s OR (source_name IS NULL AND %s)
+                    ORDER BY id DESC LIMIT 1
+                """, (self.source_name, self.source_name == DEFAULT_SOURCE))
+                return cursor.fetchone()
+        except Error:
+            return None # Table already dropped
+    
+    def update_mail_details(self, mail_count, uid_validity, last_uid):
+        """Upsert this source's sync checkpoint (highest UID handled) and connection time"""
+        try:
+            current_time = datetime.now()
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='update_checkpoint'):
+                cursor.execute("""
+                    INSERT INTO mail_checkpoints (source_name, mail_count, last_connection_time, uid_validity, last_uid)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        mail_count = VALUES(mail_count),
+                        last_connection_time = VALUES(last_connection_time),
+                        uid_validity = VALUES(uid_validity),
+                        last_uid = VALUES(last_uid)
+                """, (self.source_name, mail_count, current_time, uid_validity, last_uid))
+            self.db_connection.commit()
+            print(f"[OK] Updated checkpoint for {self.source_name} - Last UID: {last_uid}, Time: {current_time}")
+            return True
         except Exception as e:
             print(f"[ERROR] Error updating mail details: {e}")
+            self.db_connection.rollback()
             return False
     
+    def record_poll(self, mail_count):
+        """
+        Note a completed check: refresh the checkpoint's connection time and add
+        it to this hour's row of mail_poll_history (one row per source per hour).
+        """
+        jobs_added, self.jobs_added_since_poll = self.jobs_added_since_poll, 0
+        current_time = datetime.now()
+        hour = current_time.replace(minute=0, second=0, microsecond=0)
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='record_poll'):
+                cursor.execute("""
+                    UPDATE mail_checkpoints SET last_connection_time = %s, mail_count = %s
+                    WHERE source_name = %s
+                """, (current_time, mail_count, self.source_name))
+                cursor.execute("""
+                    INSERT INTO mail_poll_history (source_name, hour, polls, mails_ingested, last_poll_time, last_mail_count)
+                    VALUES (%s, %s, 1, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        polls = polls + 1,
+                        mails_ingested = mails_ingested + VALUES(mails_ingested),
+                        last_poll_time = VALUES(last_poll_time),
+                        last_mail_count = VALUES(last_mail_count)
+                """, (self.source_name, hour, jobs_added, current_time, mail_count))
+                if hour != self.history_hour:
+                    # Once an hour, drop rolled-up history past the retention window
+                    cursor.execute(
+                        "DELETE FROM mail_poll_history WHERE source_name = %s AND hour < %s",
+                        (self.source_name, hour - timedelta(days=self.poll_history_days))
+                    )
+            self.db_connection.commit()
+            self.history_hour = hour
+        except Error as e:
+            print(f"[WARN] Could not record poll for {self.source_name}: {e}")
+            self.db_connection.rollback()
+    
     def process_email_attachments(self, msg, claim_id):
-        """Extract and save email attachments"""
-        # ... existing code ...
+        """Extract and save the attachments of a fully downloaded message"""
         attachment_paths = []
-        save_path = os.getenv('LOCAL_ATTACHMENTS_FOLDER', 'attachments')
-        
-        # Create claim-specific folder
-        claim_folder = os.path.join(save_path, claim_id)
-        if not os.path.exists(claim_folder):
-            os.makedirs(claim_folder)
-            print(f"[FILE] Created folder: {claim_folder}")
-        
+        max_attachment_bytes, remaining = get_attachment_limits()
         if msg.is_multipart():
             for part in msg.walk():
                 content_disposition = str(part.get('Content-Disposition'))
@@ -171,17 +337,12 @@ class MailMonitor:
                             else:
                                 filename = str(decoded_filename)
                             
-                            # Create unique filename with timestamp
-                            timestamp = str(int(time.time() * 1000))
-                            unique_filename = f"{timestamp}_{filename}"
-                            file_path = os.path.join(claim_folder, unique_filename)
-                            
-                            # Save attachment
-                            with open(file_path, "wb") as f:
-                                f.write(part.get_payload(decode=True))
-                            
-                            attachment_paths.append(file_path)
-                            print(f"[FILE] Saved attachment: {unique_filename}")
+                            payload = part.get_payload(decode=True)
+                            if len(payload) > min(max_attachment_bytes, remaining):
+                                print(f"[WARN] Skipping attachment {filename}: over the size limit")
+                                continue
+                            remaining -= len(payload)
+                            attachment_paths.append(save_attachment(claim_id, filename, payload))
                             
                         except Exception as e:
                             print(f"[ERROR] Error saving attachment {filename}: {e}")
@@ -210,121 +371,603 @@ class MailMonitor:
         
         return email_content
     
-    def fetch_new_mails_to_db(self, stored_count, current_count):
-        """Fetch new mails and add to mail_jobs database table"""
-        try:
-            new_mail_count = current_count - stored_count
-            print(f"[EMAIL] Processing {new_mail_count} new mails")
-            
-            # ... existing code to get new_mail_ids ...
-            status, email_ids = self.mail_connection.search(None, "ALL")
+    def parse_headers(self, msg):
+        """Subject, sender and a new claim ID for a message (headers only are enough)"""
+        subject_header = msg.get("Subject", "No Subject")
+        subject, _ = decode_header(subject_header)[0]
+        subject = subject.decode('utf-8', errors='ignore') if isinstance(subject, bytes) else str(subject)
+        
+        from_header = msg.get("From", "Unknown Sender")
+        sender, _ = decode_header(from_header)[0]
+        sender = sender.decode('utf-8', errors='ignore') if isinstance(sender, bytes) else str(sender)
+        sender_email = email.utils.parseaddr(sender)[1]
+        
+        unique_id = str(uuid.uuid4()).replace('-', '').upper()[:8]
+        date_str = datetime.now().strftime("%Y%m%d")
+        claim_id = f"CLAIM_{unique_id}_{date_str}"
+        
+        message_id = str(msg.get("Message-ID") or '').strip()
+        job = {
+            'claim_id': claim_id, 'sender_email': sender_email, 'subject': subject,
+            'message_id': message_id, 'date': str(msg.get("Date") or '')
+        }
+        # Mails without a Message-ID get a body-based key once the body is known
+        job['message_key'] = message_key(job) if message_id else None
+        return job
+    
+    def fetch_structure_batch(self, uids):
+        """
+        Fetch headers and BODYSTRUCTURE (no bodies) for several messages in one
+        round trip. Returns {uid: parsed FETCH fields}.
+        """
+        uid_set = ",".join(str(uid) for uid in uids)
+        with IMAP_REQUEST_SECONDS.time(command='fetch_structure'):
+            status, data = self.mail_connection.uid('FETCH', uid_set, "(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])")
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH {uid_set} failed")
+        return parse_fetch_response(data)
+    
+    def fetch_sections(self, wanted):
+        """
+        Fetch selected body parts, {uid: [section, ...]} -> {(uid, section): raw bytes}.
+        Messages wanting the same section share one UID FETCH.
+        """
+        by_section = {}
+        for uid, sections in wanted.items():
+            for section in sections:
+                by_section.setdefault(section, []).append(uid)
+        
+        bodies = {}
+        for section, uids in by_section.items():
+            uid_set = ",".join(str(uid) for uid in uids)
+            with IMAP_REQUEST_SECONDS.time(command='fetch_body'):
+                status, data = self.mail_connection.uid('FETCH', uid_set, f"(UID BODY.PEEK[{section}])")
             if status != 'OK':
-                print("[ERROR] Failed to search emails")
-                return False
-            
-            email_id_list = email_ids[0].split() if email_ids[0] else []
-            new_mail_ids = email_id_list[-new_mail_count:] if new_mail_count > 0 else []
-            
-            jobs_added = 0
-            for email_id_bytes in new_mail_ids:
-                email_id_str = email_id_bytes.decode('utf-8')
+                raise imaplib.IMAP4.error(f"UID FETCH {uid_set} BODY[{section}] failed")
+            for uid, fields in parse_fetch_response(data).items():
+                body = find_section(fields, section)
+                if body is not None:
+                    bodies[(uid, section)] = body
+        return bodies
+    
+    def fetch_full_message(self, uid):
+        """Download a whole message, for the rare structure this monitor cannot read"""
+        with IMAP_REQUEST_SECONDS.time(command='fetch'):
+            status, data = self.mail_connection.uid('FETCH', str(uid), "(UID RFC822)")
+        if status != 'OK' or not data or not isinstance(data[0], tuple):
+            return None
+        return email.message_from_bytes(data[0][1])
+    
+    def build_batch_jobs(self, uids, uid_validity, headers_only=False, claim_ids=None):
+        """
+        Turn a batch of new UIDs into mail_jobs rows. Only headers, BODYSTRUCTURE,
+        the plain-text body and small attachments are downloaded; larger
+        attachments are recorded in the job's attachment_manifest instead.
+        With `headers_only` nothing beyond headers and BODYSTRUCTURE is downloaded
+        (content is None). `claim_ids` ({uid: claim_id}) completes jobs queued that way.
+        """
+        structures = self.fetch_structure_batch(uids)
+        
+        # UIDs missing from the response were expunged after the SEARCH
+        jobs = []
+        full_messages = []
+        wanted = {}
+        for uid in uids:
+            if uid not in structures:
+                continue
+            try:
+                fields = structures[uid]
+                job = self.parse_headers(email.message_from_bytes(find_section(fields, 'HEADER') or b''))
+                job.update({'uid': uid, 'uid_validity': uid_validity, 'attachment_paths': [], 'attachment_manifest': []})
+                if claim_ids:
+                    job['claim_id'] = claim_ids[uid]
+                try:
+                    parts = list_parts(fields['BODYSTRUCTURE'])
+                except Exception as e:
+                    # The fallback holds the whole message in memory, so it is bounded by the per-message limit
+                    if int(fields.get('RFC822.SIZE') or 0) > get_attachment_limits()[1]:
+                        print(f"[WARN] Unreadable BODYSTRUCTURE for UID {uid} ({e}) and too large to download whole")
+                    else:
+                        print(f"[WARN] Unreadable BODYSTRUCTURE for UID {uid} ({e}); downloading the whole message")
+                        full_messages.append(job)
+                    jobs.append(job)
+                    continue
                 
+                job['text_part'] = next(
+                    (p for p in parts if p['content_type'] == 'text/plain' and p['disposition'] != 'attachment'),
+                    None
+                )
+                job['attachment_manifest'] = [
+                    {key: p[key] for key in ('section', 'filename', 'content_type', 'encoding', 'size')}
+                    for p in parts
+                    if p['disposition'] == 'attachment' and p['filename']
+                ]
+                for item in apply_size_limits(job['attachment_manifest']):
+                    print(f"[WARN] Skipping attachment {item['filename']} of UID {uid}: over the size limit")
+                wanted[uid] = [job['text_part']['section']] if job['text_part'] else []
+                wanted[uid] += [
+                    a['section'] for a in job['attachment_manifest']
+                    if not a.get('skipped') and a['size'] <= self.eager_attachment_bytes
+                ]
+                jobs.append(job)
+            except Exception as e:
+                # Unparseable mail: skip it rather than block the mailbox
+                MAIL_ERRORS.inc(source=self.source_name)
+                print(f"[ERROR] Error processing email UID {uid} from {self.source_name}: {e}")
+        
+        # Mails already queued (e.g. seen again after a crash before the checkpoint
+        # moved) are dropped before any body is downloaded
+        queued = set()
+        if not claim_ids:
+            queued = self.find_queued_keys([job['message_key'] for job in jobs if job['message_key']])
+        if queued:
+            duplicates = [job for job in jobs if job['message_key'] in queued]
+            MAIL_DUPLICATES.inc(len(duplicates), source=self.source_name)
+            for job in duplicates:
+                print(f"[SKIP] UID {job['uid']} is already queued (Message-ID {job['message_id']})")
+                wanted.pop(job['uid'], None)
+            jobs = [job for job in jobs if job['message_key'] not in queued]
+            full_messages = [job for job in full_messages if job['message_key'] not in queued]
+        
+        if headers_only:
+            wanted, full_messages = {}, []
+        bodies = self.fetch_sections(wanted)
+        
+        for job in jobs:
+            text_part = job.pop('text_part', None)
+            if headers_only:
+                job['content'] = None
+                continue
+            raw_text = bodies.get((job['uid'], text_part['section'])) if text_part else None
+            job['content'] = "No content found"
+            if raw_text is not None:
                 try:
-                    # ... existing code to fetch email and parse details ...
-                    status, data = self.mail_connection.fetch(email_id_str, "(RFC822)")
-                    if status != 'OK':
-                        continue
-                    
-                    raw_email = data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-                    
-                    subject_header = msg.get("Subject", "No Subject")
-                    subject, _ = decode_header(subject_header)[0]
-                    subject = subject.decode('utf-8', errors='ignore') if isinstance(subject, bytes) else str(subject)
-                    
-                    from_header = msg.get("From", "Unknown Sender")
-                    sender, _ = decode_header(from_header)[0]
-                    sender = sender.decode('utf-8', errors='ignore') if isinstance(sender, bytes) else str(sender)
-                    sender_email = email.utils.parseaddr(sender)[1]
-                    
-                    unique_id = str(uuid.uuid4()).replace('-', '').upper()[:8]
-                    date_str = datetime.now().strftime("%Y%m%d")
-                    claim_id = f"CLAIM_{unique_id}_{date_str}"
-                    
-                    email_content = self.extract_email_content(msg)
-                    attachment_paths = self.process_email_attachments(msg, claim_id)
-                    
-                    # --- NEW DATABASE INSERT LOGIC ---
-                    with self.db_connection.cursor() as cursor:
-                        insert_query = """
-                        INSERT INTO mail_jobs 
-                        (claim_id, sender_email, subject, content, local_attachment_paths, status, created_at)
-                        VALUES (%s, %s, %s, %s, %s, 'PENDING', %s)
-                        """
-                        cursor.execute(insert_query, (
-                            claim_id,
-                            sender_email,
-                            subject,
-                            email_content,
-                            json.dumps(attachment_paths), # Store paths as JSON string
-                            datetime.now()
-                        ))
-                        self.db_connection.commit()
-                        jobs_added += 1
-                        print(f"[QUEUE] Added job to DB for {sender_email}. Claim ID: {claim_id}")
-
+                    text = decode_part(raw_text, text_part['encoding'])
+                    try:
+                        job['content'] = text.decode(text_part['charset'], errors='ignore')
+                    except LookupError:
+                        job['content'] = text.decode('utf-8', errors='ignore')
                 except Exception as e:
-                    print(f"[ERROR] Error processing email {email_id_str}: {e}")
+                    print(f"[WARN] Could not decode the body of UID {job['uid']}: {e}")
+        
+        for job in full_messages:
+            msg = self.fetch_full_message(job['uid'])
+            if msg is not None:
+                job['content'] = self.extract_email_content(msg)
+                job['attachment_paths'] = self.process_email_attachments(msg, job['claim_id'])
+        
+        # Write the small attachments in parallel
+        downloads = [
+            (job, item, bodies[(job['uid'], item['section'])])
+            for job in jobs
+            for item in job['attachment_manifest']
+            if (job['uid'], item['section']) in bodies
+        ]
+        paths = self.attachment_writers.map(lambda download: self.save_downloaded_attachment(*download), downloads)
+        for (job, item, _), path in zip(downloads, paths):
+            if path:
+                item['path'] = path
+                job['attachment_paths'].append(path)
+        
+        for job in jobs:
+            if not job['message_key']:
+                job['message_key'] = message_key({**job, 'content': job['content'] or ''})
+            # Disk the attachments take (or will take once the worker downloads them)
+            job['attachment_bytes'] = sum(
+                os.path.getsize(path) for path in job['attachment_paths'] if os.path.exists(path)
+            ) + sum(
+                estimated_size(item) for item in job['attachment_manifest']
+                if not item.get('path') and not item.get('skipped')
+            )
+        
+        deferred = sum(
+            1 for job in jobs for item in job['attachment_manifest']
+            if not item.get('path') and not item.get('skipped')
+        )
+        if deferred and not headers_only:
+            print(f"[FILE] Deferred {deferred} large attachments to the worker")
+        return jobs
+    
+    def save_downloaded_attachment(self, job, item, raw):
+        """Decode and save one fetched attachment part. Returns the path, or None (the worker retries it)."""
+        try:
+            return save_attachment(job['claim_id'], item['filename'], decode_part(raw, item['encoding']))
+        except Exception as e:
+            print(f"[ERROR] Error saving attachment {item['filename']}: {e}")
+            return None
+    
+    def insert_jobs(self, jobs, status='PENDING'):
+        """
+        Insert a batch of parsed mails into mail_jobs in one transaction and return
+        the jobs actually inserted. Mails whose message_key is already queued are
+        left alone by the unique index.
+        """
+        now = datetime.now()
+        rows = [
+            (
+                job['claim_id'],
+                job['message_key'],
+                job['sender_email'],
+                job['subject'],
+                job['content'],
+                json.dumps(job['attachment_paths']), # Store paths as JSON string
+                json.dumps(job['attachment_manifest']) if job['attachment_manifest'] else None,
+                job['attachment_bytes'],
+                self.source_name,
+                self.mailbox,
+                job['uid_validity'],
+                job['uid'],
+                status,
+                now
+            )
+            for job in jobs
+        ]
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='insert_jobs'):
+                cursor.executemany("""
+                    INSERT INTO mail_jobs 
+                    (claim_id, message_key, sender_email, subject, content, local_attachment_paths,
+                     attachment_manifest, attachment_bytes, source_name, source_mailbox, source_uid_validity, source_uid,
+                     status, created_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE id = id
+                """, rows)
+                # Affected-row counts cannot tell inserts from duplicates, so look the keys up
+                cursor.execute(
+                    f"SELECT message_key, claim_id FROM mail_jobs WHERE message_key IN ({', '.join(['%s'] * len(jobs))})",
+                    [job['message_key'] for job in jobs]
+                )
+                queued_claims = dict(cursor.fetchall())
+            self.db_connection.commit()
+            return [job for job in jobs if queued_claims.get(job['message_key']) == job['claim_id']]
+        except Error:
+            self.db_connection.rollback()
+            raise
+    
+    def find_queued_keys(self, keys):
+        """The message_keys already in mail_jobs. Empty on a database error; the unique index still applies."""
+        if not keys:
+            return set()
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='find_duplicates'):
+                cursor.execute(
+                    f"SELECT message_key FROM mail_jobs WHERE message_key IN ({', '.join(['%s'] * len(keys))})",
+                    keys
+                )
+                return {row[0] for row in cursor.fetchall()}
+        except Error as e:
+            print(f"[WARN] Could not check for duplicate mails: {e}")
+            return set()
+    
+    def ingest_batch(self, batch_uids, uid_validity):
+        """Fetch one batch of UIDs and insert its jobs. Returns the number of jobs added, or None on error."""
+        headers_only = self.check_backpressure()
+        try:
+            jobs = self.build_batch_jobs(batch_uids, uid_validity, headers_only=headers_only)
+        except Exception as e:
+            print(f"[ERROR] Error fetching emails {batch_uids[0]}-{batch_uids[-1]} from {self.source_name}, retrying next poll: {e}")
+            return None
+        
+        inserted = []
+        if jobs:
+            try:
+                inserted = self.insert_jobs(jobs, 'HEADERS_ONLY' if headers_only else 'PENDING')
+            except Error as e:
+                # Database trouble: keep this batch for the next poll and drop its attachment references
+                MAIL_ERRORS.inc(len(jobs), source=self.source_name)
+                print(f"[ERROR] Database error inserting {len(jobs)} jobs, retrying next poll: {e}")
+                for job in jobs:
+                    release_claim(job['claim_id'], job['attachment_paths'])
+                return None
             
-            print(f"[OK] Added {jobs_added} new jobs to mail_jobs table")
-            return True
+            inserted_claims = {job['claim_id'] for job in inserted}
+            for job in jobs:
+                if job['claim_id'] not in inserted_claims:
+                    # Raced with another source or an earlier run; the queued copy wins
+                    MAIL_DUPLICATES.inc(source=self.source_name)
+                    print(f"[SKIP] UID {job['uid']} is already queued; dropping duplicate {job['claim_id']}")
+                    release_claim(job['claim_id'], job['attachment_paths'])
+            
+            MAILS_INGESTED.inc(len(inserted), source=self.source_name)
+            self.jobs_added_since_poll += len(inserted)
+            if headers_only:
+                MAILS_HEADERS_ONLY.inc(len(inserted), source=self.source_name)
+                self.has_headers_only = self.has_headers_only or bool(inserted)
+            elif inserted:
+                # Wake idle workers instead of waiting for their next poll
+                notify_workers()
+            for job in inserted:
+                print(f"[QUEUE] Added {'header-only ' if headers_only else ''}job to DB for {job['sender_email']}. Claim ID: {job['claim_id']}")
+        return len(inserted)
+    
+    def check_backpressure(self):
+        """
+        True while the workers are too far behind for full downloads: the 'PENDING'
+        jobs or their attachment bytes are past MAIL_BACKPRESSURE_PENDING_*.
+        """
+        if not self.backpressure_pending_jobs and not self.backpressure_pending_bytes:
+            return False
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='queue_pressure'):
+                cursor.execute("""
+                    SELECT COUNT(*), COALESCE(SUM(attachment_bytes), 0)
+                    FROM mail_jobs WHERE status = 'PENDING'
+                """)
+                pending_jobs, pending_bytes = cursor.fetchone()
+            self.db_connection.commit() # Next check reads a fresh snapshot
+        except Error as e:
+            print(f"[WARN] Could not read queue depth, keeping backpressure {'on' if self.backpressure else 'off'}: {e}")
+            return self.backpressure
+        
+        # Hysteresis: once on, stay on until the queue has drained below the resume ratio
+        factor = self.backpressure_resume_ratio if self.backpressure else 1
+        over = bool(
+            (self.backpressure_pending_jobs and pending_jobs >= self.backpressure_pending_jobs * factor)
+            or (self.backpressure_pending_bytes and pending_bytes >= self.backpressure_pending_bytes * factor)
+        )
+        if over != self.backpressure:
+            state = "on: queuing headers only" if over else "off: resuming full downloads"
+            print(f"[WARN] Backpressure {state} for {self.source_name} ({pending_jobs} pending jobs, {pending_bytes} attachment bytes)")
+        self.backpressure = over
+        BACKPRESSURE.set(int(over), source=self.source_name)
+        return over
+    
+    def hydrate_headers_only_jobs(self, uid_validity):
+        """
+        Complete this source's 'HEADERS_ONLY' jobs (body, small attachments) and
+        release them to the workers as 'PENDING', a batch per scheduler turn,
+        for as long as the queue stays below the backpressure thresholds. Jobs
+        queued under an older UIDVALIDITY cannot be fetched any more; they are
+        marked 'FAILED' and sent to human_fulfillment.
+        """
+        while not self.check_backpressure():
+            try:
+                with self.db_connection.cursor(dictionary=True) as cursor, DB_QUERY_SECONDS.time(query='find_headers_only'):
+                    cursor.execute("""
+                        SELECT id, claim_id, source_uid_validity, source_uid FROM mail_jobs
+                        WHERE status = 'HEADERS_ONLY' AND source_name = %s
+                        ORDER BY id LIMIT %s
+                    """, (self.source_name, self.fetch_batch_size))
+                    rows = cursor.fetchall()
+                self.db_connection.commit()
+            except Error as e:
+                print(f"[ERROR] Could not read header-only jobs: {e}")
+                return
+            if not rows:
+                self.has_headers_only = False
+                return
+            
+            # Rows from before a UIDVALIDITY change point at messages that no longer exist
+            claim_ids = {row['source_uid']: row['claim_id'] for row in rows if row['source_uid_validity'] == uid_validity}
+            stale = [row for row in rows if row['source_uid_validity'] != uid_validity]
+            try:
+                with self.scheduler.turn():
+                    jobs = self.build_batch_jobs(sorted(claim_ids), uid_validity, claim_ids=claim_ids) if claim_ids else []
+            except Exception as e:
+                print(f"[ERROR] Error completing header-only jobs from {self.source_name}, retrying next check: {e}")
+                return
+            
+            by_claim = {job['claim_id']: job for job in jobs}
+            updates = []
+            for row in rows:
+                if row['source_uid_validity'] != uid_validity:
+                    continue
+                job = by_claim.get(row['claim_id'])
+                if job is None:
+                    print(f"[WARN] Message for {row['claim_id']} is gone from {self.source_name}; releasing it with headers only")
+                    job = {'content': "No content found", 'attachment_paths': [], 'attachment_manifest': [], 'attachment_bytes': 0}
+                updates.append((
+                    job['content'],
+                    json.dumps(job['attachment_paths']),
+                    json.dumps(job['attachment_manifest']) if job['attachment_manifest'] else None,
+                    job['attachment_bytes'],
+                    row['id']
+                ))
+            try:
+                with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='hydrate_jobs'):
+                    cursor.executemany("""
+                        UPDATE mail_jobs
+                        SET content = %s, local_attachment_paths = %s, attachment_manifest = %s,
+                            attachment_bytes = %s, status = 'PENDING'
+                        WHERE id = %s AND status = 'HEADERS_ONLY'
+                    """, updates)
+                    if stale:
+                        self.fail_stale_headers_only_jobs(cursor, stale, uid_validity)
+                self.db_connection.commit()
+            except Error as e:
+                self.db_connection.rollback()
+                print(f"[ERROR] Could not release header-only jobs, retrying next check: {e}")
+                for job in jobs:
+                    release_claim(job['claim_id'], job['attachment_paths'])
+                return
             
+            if stale:
+                print(f"[WARN] {len(stale)} header-only jobs from {self.source_name} predate a UIDVALIDITY change; sent to human_fulfillment")
+            if updates:
+                MAILS_HYDRATED.inc(len(updates), source=self.source_name)
+                print(f"[QUEUE] Released {len(updates)} header-only jobs from {self.source_name} to the workers")
+                notify_workers()
+    
+    def fail_stale_headers_only_jobs(self, cursor, rows, uid_validity):
+        """Mark header-only jobs whose UIDVALIDITY is out of date 'FAILED' and log them to human_fulfillment."""
+        now = datetime.now()
+        for row in rows:
+            error_message = (
+                f"Mailbox UIDVALIDITY changed ({row['source_uid_validity']} -> {uid_validity}) before the "
+                f"message (UID {row['source_uid']}) was downloaded; it can no longer be fetched from {self.source_name}"
+            )
+            cursor.execute("""
+                UPDATE mail_jobs
+                SET status = 'FAILED', error_message = %s, last_processed_at = %s
+                WHERE id = %s AND status = 'HEADERS_ONLY'
+            """, (error_message, now, row['id']))
+            if not cursor.rowcount:
+                continue
+            cursor.execute("""
+                INSERT INTO human_fulfillment
+                (failed_job_id, claim_id, sender_email, error_message, full_job_data, status, created_at)
+                SELECT id, claim_id, sender_email, %s,
+                       JSON_OBJECT('id', id, 'claim_id', claim_id, 'sender_email', sender_email,
+                                   'subject', subject, 'source_name', source_name,
+                                   'source_uid_validity', source_uid_validity, 'source_uid', source_uid,
+                                   'created_at', created_at),
+                       'NEEDS_REVIEW', %s
+                FROM mail_jobs WHERE id = %s
+            """, (error_message, now, row['id']))
+    
+    def fetch_new_mails_to_db(self, last_uid, uid_validity):
+        """
+        Fetch mails with a UID above `last_uid` and add them to the mail_jobs table,
+        MAIL_FETCH_BATCH_SIZE messages per batch and per INSERT, one batch per
+        scheduler turn.
+        Returns the highest UID handled, which becomes the next checkpoint, or None
+        if the UID search failed. Stops early on an IMAP or database error so the
+        remaining mails are retried on the next poll.
+        """
+        try:
+            # Only UIDs above the checkpoint; "n:*" always includes the highest UID, so filter
+            with IMAP_REQUEST_SECONDS.time(command='search'):
+                status, email_ids = self.mail_connection.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+            if status != 'OK':
+                print("[ERROR] Failed to search emails")
+                return None
+            
+            new_uids = sorted(int(uid) for uid in (email_ids[0] or b'').split() if int(uid) > last_uid)
+            print(f"[EMAIL] Processing {len(new_uids)} new mails from {self.source_name}")
         except Exception as e:
             print(f"[ERROR] Error fetching new mails: {e}")
-            return False
+            return None
+        
+        jobs_added = 0
+        handled_uid = last_uid
+        for start in range(0, len(new_uids), self.fetch_batch_size):
+            batch_uids = new_uids[start:start + self.fetch_batch_size]
+            with self.scheduler.turn():
+                added = self.ingest_batch(batch_uids, uid_validity)
+            if added is None:
+                break
+            jobs_added += added
+            handled_uid = batch_uids[-1]
+        
+        print(f"[OK] Added {jobs_added} new jobs from {self.source_name} to mail_jobs table")
+        return handled_uid
+    
+    def idle_wait(self, timeout):
+        """
+        Block in IMAP IDLE until the server reports new mail (EXISTS) or `timeout`
+        seconds pass. Returns True if new mail was signalled.
+        Raises imaplib.IMAP4.abort if the connection drops.
+        """
+        conn = self.mail_connection
+        sock = conn.sock
+        tag = conn._new_tag()
+        conn.send(tag + b' IDLE\r\n')
+        
+        # Read the socket directly: imaplib's buffered reader would hide lines
+        # that arrive together from select()
+        pending = b''
+        idling = False
+        done_sent = False
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        while True:
+            while b'\r\n' in pending:
+                line, pending = pending.split(b'\r\n', 1)
+                if line.startswith(tag):
+                    if not idling:
+                        raise imaplib.IMAP4.error(f"IDLE rejected: {line.decode(errors='ignore')}")
+                    return new_mail
+                if line.startswith(b'+'):
+                    idling = True
+                # Ignore flag changes and expunges; only new messages end the wait
+                elif line.startswith(b'* ') and line.upper().endswith(b'EXISTS'):
+                    new_mail = True
+            
+            if idling and not done_sent and (new_mail or time.monotonic() >= deadline):
+                conn.send(b'DONE\r\n')
+                done_sent = True
+            
+            waiting_for_mail = idling and not done_sent
+            wait_seconds = max(0, deadline - time.monotonic()) if waiting_for_mail else 60
+            # TLS may already hold decrypted bytes that select() cannot see
+            if not (hasattr(sock, 'pending') and sock.pending()):
+                readable, _, _ = select.select([sock], [], [], wait_seconds)
+                if not readable:
+                    if waiting_for_mail:
+                        continue
+                    raise imaplib.IMAP4.abort("No response from server during IDLE")
+            
+            data = sock.recv(4096)
+            if not data:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            pending += data
+    
+    def wait_for_new_mail(self):
+        """Wait until the next check: pushed by IDLE when available, otherwise a fixed poll interval."""
+        # Header-only jobs are completed on the next check, so do not idle for long
+        if self.monitor_mode == 'idle' and self.idle_supported and not self.has_headers_only:
+            print(f"[WAIT] Waiting in IMAP IDLE (up to {self.idle_timeout_seconds} seconds)...")
+            try:
+                if self.idle_wait(self.idle_timeout_seconds):
+                    print("[PUSH] Server signalled new mail")
+                return
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                print(f"[WARN] {e}; falling back to polling")
+                self.idle_supported = False
+        
+        print(f"[WAIT] Waiting {self.poll_seconds} seconds before next check...")
+        time.sleep(self.poll_seconds)
     
     # --- REMOVED process_email_queue ---
     # (This logic is now in worker.py)
     
     def monitor_mails(self):
-        """Main monitoring loop (Producer)"""
-        print("[START] Starting Mail Monitor (Producer)")
+        """Main monitoring loop (Producer) for this monitor's mail source"""
+        print(f"[START] Starting Mail Monitor (Producer) for {self.source_name}")
         print("="*70)
         
-        # Connect to database and mail server
-        if not self.connect_to_database():
-            return False
-        
-        if not self.connect_to_mail_server():
-            return False
-        
         try:
+            # Connect to database and mail server
+            if not self.connect_to_database():
+                return False
+            
+            if not self.connect_to_mail_server():
+                return False
+            
             while True:
-                print(f"\n[CHECK] Checking for new mails at {datetime.now()}")
+                print(f"\n[CHECK] Checking {self.source_name} for new mails at {datetime.now()}")
                 
-                # Get current mail count from server
-                current_mail_count = self.get_current_mail_count()
+                # Get UIDVALIDITY/UIDNEXT from server
+                mailbox = self.get_mailbox_state()
                 
-                # Get stored mail count from database
-                stored_mail_count, last_connection_time = self.get_stored_mail_details()
+                # Get the sync checkpoint from database
+                stored = self.get_stored_mail_details()
                 
-                print(f"[DATA] Comparison - Stored: {stored_mail_count}, Current: {current_mail_count}")
+                if mailbox is None:
+                    print("[WARN] Could not read mailbox state, will retry")
                 
-                # Check if this is the first run (database is empty)
-                if last_connection_time is None:
-                    print("[NEW] First run detected - initializing mail count without processing existing emails")
-                    self.update_mail_details(current_mail_count)
-                    print(f"[OK] Initialized database with current mail count: {current_mail_count}")
+                # First run, or the checkpoint predates UID tracking
+                elif stored is None or stored['uid_validity'] is None:
+                    print("[NEW] No UID checkpoint - starting from the current UIDNEXT without processing existing emails")
+                    self.update_mail_details(mailbox['mail_count'], mailbox['uid_validity'], mailbox['uid_next'] - 1)
                     print("[EMAIL] Will start monitoring for new emails from next check onwards")
+                
+                # The mailbox was rebuilt and every UID changed; reprocessing it all would duplicate claims
+                elif stored['uid_validity'] != mailbox['uid_validity']:
+                    print(f"[WARN] UIDVALIDITY changed ({stored['uid_validity']} -> {mailbox['uid_validity']}); resetting checkpoint to UIDNEXT")
+                    self.update_mail_details(mailbox['mail_count'], mailbox['uid_validity'], mailbox['uid_next'] - 1)
                     
                 # Check if there are new mails
-                elif current_mail_count > stored_mail_count:
-                    print(f"[NEW] Found {current_mail_count - stored_mail_count} new mails!")
+                elif mailbox['uid_next'] - 1 > stored['last_uid']:
+                    print(f"[NEW] New mail above UID {stored['last_uid']}!")
                     
                     # Fetch new mails and add to DB queue
-                    if self.fetch_new_mails_to_db(stored_mail_count, current_mail_count):
-                        # Update database with new count
-                        self.update_mail_details(current_mail_count)
+                    handled_uid = self.fetch_new_mails_to_db(stored['last_uid'], mailbox['uid_validity'])
+                    if handled_uid is not None and handled_uid > stored['last_uid']:
+                        # Move the checkpoint past the mails handled
+                        self.update_mail_details(mailbox['mail_count'], mailbox['uid_validity'], handled_uid)
                         
                         # --- REMOVED call to process_email_queue ---
                         print(f"[PRODUCER] New jobs added to database. Worker will process them.")
@@ -332,8 +975,19 @@ class MailMonitor:
                 else:
                     print("[EMAIL] No new mails found")
                 
-                print("[WAIT] Waiting 30 seconds before next check...")
-                time.sleep(30)
+                if mailbox is not None:
+                    if self.has_headers_only:
+                        self.hydrate_headers_only_jobs(mailbox['uid_validity'])
+                    self.record_poll(mailbox['mail_count'])
+                
+                try:
+                    self.wait_for_new_mail()
+                except (imaplib.IMAP4.abort, OSError) as e:
+                    # Long-lived IDLE connections get dropped; reconnect and carry on
+                    print(f"[WARN] Mail server connection lost: {e}. Reconnecting...")
+                    time.sleep(5)
+                    while not self.connect_to_mail_server():
+                        time.sleep(self.poll_seconds)
                 
         except KeyboardInterrupt:
             print("\n[STOP] Mail monitoring stopped by user")
@@ -353,8 +1007,64 @@ class MailMonitor:
             if self.db_connection and self.db_connection.is_connected():
                 self.db_connection.close()
             
-            print("[CLOSE] All connections closed")
+            # The supervisor starts a new monitor (and pool) on restart
+            self.attachment_writers.shutdown(wait=False)
+            print(f"[CLOSE] All connections closed for {self.source_name}")
+
+def supervise_mail_source(source, scheduler):
+    """
+    Run a MailMonitor for `source`, starting a fresh one (new connections) whenever
+    its loop stops or crashes, with exponential backoff between restarts.
+    Returns only when the loop was stopped by the user.
+    """
+    min_delay = float(os.getenv("MAIL_SOURCE_RESTART_MIN_SECONDS", 5))
+    max_delay = float(os.getenv("MAIL_SOURCE_RESTART_MAX_SECONDS", 300))
+    delay = min_delay
+    while True:
+        started = time.monotonic()
+        try:
+            if MailMonitor(source, scheduler).monitor_mails():
+                return True
+            print(f"[ERROR] Mail source {source['name']} stopped")
+        except Exception as e:
+            print(f"[ERROR] Mail source {source['name']} crashed: {e}")
+        
+        # A loop that ran for a while was healthy; start the backoff over
+        if time.monotonic() - started > max_delay:
+            delay = min_delay
+        SOURCE_RESTARTS.inc(source=source['name'])
+        print(f"[RETRY] Restarting mail source {source['name']} in {delay:.0f}s")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def run_mail_monitors():
+    """Run one supervised MailMonitor per mail source (MAIL_SOURCES), each on its own thread and connections."""
+    start_metrics_server('MONITOR_METRICS_PORT', 9102)
+    sources = get_mail_sources()
+    scheduler = IngestScheduler(int(os.getenv("MAIL_INGEST_CONCURRENCY", 2)))
+    if len(sources) == 1:
+        return supervise_mail_source(sources[0], scheduler)
+    
+    print(f"[START] Monitoring {len(sources)} mail sources: {', '.join(source['name'] for source in sources)}")
+    threads = []
+    for source in sources:
+        thread = threading.Thread(
+            target=supervise_mail_source, args=(source, scheduler),
+            name=f"mail-source-{source['name']}", daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    
+    try:
+        # Source loops restart themselves; a dead thread means the supervisor itself failed
+        while all(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\n[STOP] Mail monitoring stopped by user")
+        return True
+    dead = [thread.name for thread in threads if not thread.is_alive()]
+    print(f"[CRITICAL] Mail source threads stopped: {', '.join(dead)}; exiting")
+    sys.exit(1)
 
 if __name__ == "__main__":
-    monitor = MailMonitor()
-    monitor.monitor_mails()
+    run_mail_monitors()
@@ -0,0 +1,246 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, suitable for HTTP, DB and LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Thread-safe in-process histogram with optional labels."""
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _label_values(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def observe(self, value, **labels):
+        key = self._label_values(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = {'count': 0, 'sum': 0.0, 'bucket_counts': [0] * len(self.buckets)}
+                self.series[key] = series
+            series['count'] += 1
+            series['sum'] += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['bucket_counts'][i] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent inside the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Copy of all series: {label values: {'count', 'sum', 'bucket_counts'}}."""
+        with self.lock:
+            return {
+                key: {'count': s['count'], 'sum': s['sum'], 'bucket_counts': list(s['bucket_counts'])}
+                for key, s in self.series.items()
+            }
+
+
+class Counter:
+    """Thread-safe monotonically increasing counter with optional labels."""
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class Gauge(Counter):
+    """Value that can go up and down. `set_function` makes it computed at scrape time."""
+
+    def __init__(self, name, description, label_names=()):
+        super().__init__(name, description, label_names)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Compute the (unlabelled) value by calling `function` on every scrape."""
+        self.function = function
+
+    def snapshot(self):
+        if self.function:
+            return {(): self.function()}
+        return super().snapshot()
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(cls, name, description, label_names, **kwargs):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, description, label_names, **kwargs)
+        return _registry[name]
+
+
+def histogram(name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+    """Get or create the process-wide histogram called `name`."""
+    return _get_or_create(Histogram, name, description, label_names, buckets=buckets)
+
+
+def counter(name, description, label_names=()):
+    """Get or create the process-wide counter called `name`."""
+    return _get_or_create(Counter, name, description, label_names)
+
+
+def gauge(name, description, label_names=()):
+    """Get or create the process-wide gauge called `name`."""
+    return _get_or_create(Gauge, name, description, label_names)
+
+
+# --- Prometheus text exposition ---
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = [
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render_prometheus():
+    """Render every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+
+    lines = []
+    for metric in metrics:
+        if isinstance(metric, Histogram):
+            metric_type = 'histogram'
+        elif isinstance(metric, Gauge):
+            metric_type = 'gauge'
+        else:
+            metric_type = 'counter'
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric_type}")
+
+        try:
+            snapshot = metric.snapshot()
+        except Exception as e:
+            print(f"[ERROR] Could not collect metric {metric.name}: {e}")
+            continue
+
+        for label_values, value in snapshot.items():
+            if metric_type == 'histogram':
+                for bound, count in zip(metric.buckets, value['bucket_counts']):
+                    labels = _format_labels(metric.label_names, label_values, [('le', bound)])
+                    lines.append(f"{metric.name}_bucket{labels} {count}")
+                labels = _format_labels(metric.label_names, label_values, [('le', '+Inf')])
+                lines.append(f"{metric.name}_bucket{labels} {value['count']}")
+                labels = _format_labels(metric.label_names, label_values)
+                lines.append(f"{metric.name}_sum{labels} {value['sum']}")
+                lines.append(f"{metric.name}_count{labels} {value['count']}")
+            else:
+                labels = _format_labels(metric.label_names, label_values)
+                lines.append(f"{metric.name}{labels} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep scrapes out of app.log
+
+
+def start_metrics_server(port_env, default_port):
+    """
+    Serve /metrics on a background thread for a non-HTTP process (worker,
+    monitor, janitor). The port comes from `port_env`; 0 disables the server.
+    """
+    port = int(os.getenv(port_env, default_port))
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    except OSError as e:
+        print(f"[WARN] Metrics server not started on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"[OK] Metrics available at http://localhost:{port}/metrics")
+    return server
+
+
+def instrument_fastapi_app(app, service):
+    """Add request latency metrics and a /metrics route to a FastAPI app."""
+    from fastapi import Request
+    from fastapi.responses import Response
+
+    requests_seconds = histogram(
+        'api_request_seconds',
+        'Latency of requests handled by this API',
+        label_names=('service', 'route', 'method', 'status')
+    )
+
+    @app.middleware("http")
+    async def record_request_latency(request: Request, call_next):
+        start = time.perf_counter()
+        status = '500'
+        try:
+            response = await call_next(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            route = request.scope.get('route')
+            requests_seconds.observe(
+                time.perf_counter() - start,
+                service=service,
+                route=getattr(route, 'path', 'unmatched'),
+                method=request.method,
+                status=status
+            )
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics_endpoint():
+        return Response(content=render_prometheus(), media_type=CONTENT_TYPE)
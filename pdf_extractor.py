@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import uuid
+from dotenv import load_dotenv
+from pypdf import PdfReader
+from attachment_store import attachment_digest, derived_folder
+from metrics import counter, histogram
+
+load_dotenv()
+
+PDF_EXTRACTIONS = counter(
+    'pdf_extractions_total',
+    'PDF text extractions by result (extracted, truncated, empty, cached, encrypted, error)',
+    label_names=('result',)
+)
+PDF_PAGES_READ = counter('pdf_pages_read_total', 'PDF pages whose text was extracted')
+PDF_EXTRACT_SECONDS = histogram(
+    'pdf_extract_seconds',
+    'Time to extract the text of one PDF',
+    label_names=('cache',)
+)
+
+# Rough size of a token in characters, used for the text budgets
+CHARS_PER_TOKEN = 4
+
+
+def is_pdf(path):
+    return path.lower().endswith('.pdf')
+
+
+class PdfText:
+    """Text extracted from a PDF: `text`, `pages_read` of `page_count`, and whether it was `truncated`."""
+
+    def __init__(self, text, pages_read, page_count, truncated):
+        self.text = text
+        self.pages_read = pages_read
+        self.page_count = page_count
+        self.truncated = truncated
+
+
+class PdfTextExtractor:
+    """
+    Extracts PDF text for the LLM one page at a time, stopping once the file's
+    token budget (PDF_TEXT_MAX_TOKENS_PER_FILE) or PDF_TEXT_MAX_PAGES is reached.
+    The file is read through an open handle, so pypdf does not load it whole.
+    Results are cached next to the stored attachment, per content hash and budget.
+    """
+
+    def __init__(self):
+        self.max_tokens = int(os.getenv('PDF_TEXT_MAX_TOKENS_PER_FILE', 2000))
+        self.max_pages = int(os.getenv('PDF_TEXT_MAX_PAGES', 20))
+
+    def _cache_path(self, digest):
+        return os.path.join(derived_folder(digest), f"text-{self.max_tokens}-{self.max_pages}.json")
+
+    def _cached(self, digest):
+        try:
+            with open(self._cache_path(digest), 'r', encoding='utf-8') as f:
+                return PdfText(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _store(self, digest, pdf_text):
+        cache_path = self._cache_path(digest)
+        partial_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(partial_path, 'w', encoding='utf-8') as f:
+                json.dump(vars(pdf_text), f)
+            os.replace(partial_path, cache_path)
+        except OSError as e:
+            print(f"[WARN] Could not cache PDF text {digest[:12]}: {e}")
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def _read_pages(self, path):
+        max_chars = self.max_tokens * CHARS_PER_TOKEN
+        parts, length, pages_read = [], 0, 0
+        with open(path, 'rb') as f:
+            reader = PdfReader(f)
+            if reader.is_encrypted and not reader.decrypt(''):
+                raise PermissionError("PDF is password protected")
+            page_count = len(reader.pages)
+            for page in reader.pages:
+                if pages_read >= self.max_pages or length >= max_chars:
+                    break
+                text = (page.extract_text() or '').strip()
+                pages_read += 1
+                if text:
+                    parts.append(text)
+                    length += len(text) + 1
+        text = '\n'.join(parts)
+        truncated = pages_read < page_count or len(text) > max_chars
+        return PdfText(text[:max_chars], pages_read, page_count, truncated)
+
+    def extract(self, path):
+        """The text of the PDF at `path` as a PdfText, or None if it cannot be read."""
+        start = time.perf_counter()
+        filename = os.path.basename(path)
+        digest = attachment_digest(path)
+        cached = self._cached(digest)
+        if cached:
+            PDF_EXTRACTIONS.inc(result='cached')
+            PDF_EXTRACT_SECONDS.observe(time.perf_counter() - start, cache='hit')
+            return cached
+
+        try:
+            pdf_text = self._read_pages(path)
+        except PermissionError:
+            print(f"[WARN] Skipping text of {filename}: the PDF is password protected")
+            PDF_EXTRACTIONS.inc(result='encrypted')
+            return None
+        except Exception as e:
+            print(f"[WARN] Could not extract text from {filename}: {e}")
+            PDF_EXTRACTIONS.inc(result='error')
+            return None
+
+        # Scanned PDFs have no text layer; cache that too so they are not re-parsed
+        self._store(digest, pdf_text)
+        elapsed = time.perf_counter() - start
+        if not pdf_text.text:
+            result = 'empty'
+        else:
+            result = 'truncated' if pdf_text.truncated else 'extracted'
+        PDF_EXTRACTIONS.inc(result=result)
+        PDF_PAGES_READ.inc(pdf_text.pages_read)
+        PDF_EXTRACT_SECONDS.observe(elapsed, cache='miss')
+        print(
+            f"[PDF] Extracted {len(pdf_text.text)} chars from {filename} "
+            f"({pdf_text.pages_read}/{pdf_text.page_count} pages, {elapsed * 1000:.0f} ms)"
+        )
+        return pdf_text
@@ -0,0 +1,96 @@
+import queue
+import threading
+
+
+class StageFailure(Exception):
+    """
+    Raised by a stage handler. The message keeps the "STAGE_<NAME>_FAILED: ..."
+    format used in mail_jobs.error_message and the human_fulfillment table.
+    """
+
+    def __init__(self, error_code, message):
+        self.error_code = error_code
+        super().__init__(f"{error_code}: {message}")
+
+    @property
+    def stage(self):
+        """Pipeline stage encoded in the error code, e.g. 'LLM_ASSESSMENT'."""
+        if self.error_code.startswith('STAGE_') and self.error_code.endswith('_FAILED'):
+            return self.error_code[len('STAGE_'):-len('_FAILED')]
+        return None
+
+
+class Stage:
+    """A named pipeline step with its own bounded input queue and thread pool."""
+
+    def __init__(self, name, handler, concurrency=1, queue_size=10):
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+
+
+class PipelineEngine:
+    """
+    Runs work items through a set of stages. Each handler takes the item's
+    context dict and returns the name of the next stage, or None when the item
+    is finished. Stages only hand items forward, so full queues apply
+    backpressure upstream without deadlocking.
+    """
+
+    def __init__(self, stages, on_error, on_transition=None, before_stage=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.first_stage = stages[0].name
+        self.on_error = on_error
+        self.on_transition = on_transition
+        self.before_stage = before_stage
+        self.threads = []
+
+    def start(self):
+        """Start the worker threads for every stage."""
+        for stage in self.stages.values():
+            for i in range(stage.concurrency):
+                thread = threading.Thread(
+                    target=self._run_stage,
+                    args=(stage,),
+                    name=f"stage-{stage.name}-{i}",
+                    daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+            print(f"[PIPELINE] Stage '{stage.name}': {stage.concurrency} threads, queue size {stage.queue.maxsize}")
+
+    def submit(self, context, stage_name=None):
+        """
+        Enqueue a new item at the first stage, or at `stage_name` when resuming.
+        Blocks while that stage is full.
+        """
+        self._enqueue(stage_name or self.first_stage, context)
+
+    def queue_depths(self):
+        """Current number of items waiting in each stage's queue."""
+        return {name: stage.queue.qsize() for name, stage in self.stages.items()}
+
+    def _enqueue(self, stage_name, context):
+        if stage_name not in self.stages:
+            raise ValueError(f"Unknown pipeline stage: {stage_name}")
+        if self.on_transition:
+            self.on_transition(context, stage_name)
+        self.stages[stage_name].queue.put(context)
+
+    def _run_stage(self, stage):
+        while True:
+            context = stage.queue.get()
+            try:
+                if self.before_stage:
+                    self.before_stage()
+                next_stage = stage.handler(context)
+                if next_stage:
+                    self._enqueue(next_stage, context)
+            except Exception as e:
+                try:
+                    self.on_error(context, e)
+                except Exception as handler_error:
+                    print(f"[CRITICAL] Pipeline error handler failed in stage '{stage.name}': {handler_error}")
+            finally:
+                stage.queue.task_done()
@@ -0,0 +1,122 @@
+import os
+import re
+import random
+from dotenv import load_dotenv
+from metrics import counter
+
+load_dotenv()
+
+PRESCREEN_DECISIONS = counter(
+    'prescreen_decisions_total',
+    'Claims checked by the pre-screen, by outcome (decided, shadowed, sent_to_llm)',
+    label_names=('outcome',)
+)
+PRESCREEN_RULE_HITS = counter(
+    'prescreen_rule_hits_total',
+    'Pre-screen rules that matched a claim',
+    label_names=('rule',)
+)
+PRESCREEN_SHADOW_RESULTS = counter(
+    'prescreen_shadow_results_total',
+    'Pre-screen decisions also sent to the LLM, by whether the LLM agreed',
+    label_names=('result',)
+)
+
+# Money as customers write it (also used by FulfillmentProcessor.identify_satisfied_requirements)
+MONETARY_PATTERNS = [re.compile(pattern) for pattern in (
+    r'\$\s*[\d,]+',  # $2500, $2,500
+    r'rs\.?\s*[\d,]+',  # Rs 25000, Rs. 2,50,000
+    r'inr\s*[\d,]+',  # INR 25000
+    r'usd\s*[\d,]+',  # USD 2500
+    r'amount:?\s*[\d,]+',  # amount: 25000
+    r'cost:?\s*[\d,]+',  # cost: 25000
+    r'claim:?\s*[\d,]+',  # claim: 25000
+    r'damage:?\s*[\d,]+',  # damage: 25000
+    r'total:?\s*[\d,]+',  # total: 25000
+    r'[\d,]{3,}',  # Any number with 3+ digits (with commas)
+)]
+STATUS_PATTERN = re.compile(r'FULFILLMENT_STATUS:\s*(COMPLETED|PENDING)')
+
+# Missing-item wording; kept clear of the keyword lists identify_satisfied_requirements
+# matches, so the other requirements are still reported as satisfied
+MISSING_AMOUNT = "- Specific claim amount in currency format (e.g., $5,000 or Rs 2,50,000)"
+MISSING_DOCUMENTS = "- Supporting documents such as receipts, photos or official reports"
+MISSING_REASON = "- Reason: a description of what happened and when"
+
+# Rules that make PENDING certain on their own; 'short_body' only adds a missing item
+DECIDING_RULES = ('no_attachments', 'no_amount')
+
+
+def has_monetary_amount(text):
+    text = (text or '').lower()
+    return any(pattern.search(text) for pattern in MONETARY_PATTERNS)
+
+
+class PrescreenDecision:
+    """A claim decided without the LLM: the matched `rules` and an `llm_response` in the LLM's format."""
+
+    def __init__(self, rules, missing_items):
+        self.rules = rules
+        self.llm_response = (
+            "FULFILLMENT_STATUS: PENDING\n"
+            "MISSING_ITEMS: " + "\n".join(missing_items) + "\n\n"
+            f"DECIDED_BY: prescreen ({', '.join(rules)})"
+        )
+
+
+class PrescreenEngine:
+    """
+    Decides clear-cut PENDING claims (no attachments, or no amount in a claim
+    whose subject and body are all there is to read) locally, so only the
+    ambiguous ones are sent to the LLM. An amount may be in an invoice or photo,
+    so claims with attachments are never decided on 'no_amount'. A fraction
+    (PRESCREEN_SHADOW_RATE) of decided claims still go to the LLM to measure
+    agreement.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('PRESCREEN_ENABLED', 'true').lower() == 'true'
+        self.rules = {rule.strip() for rule in os.getenv('PRESCREEN_RULES', ','.join(DECIDING_RULES)).split(',') if rule.strip()}
+        self.min_words = int(os.getenv('PRESCREEN_MIN_WORDS', 5))
+        self.shadow_rate = float(os.getenv('PRESCREEN_SHADOW_RATE', 0.05))
+
+    def evaluate(self, email_data):
+        """A PrescreenDecision for a clear-cut claim, or None if the LLM has to decide."""
+        if not self.enabled:
+            return None
+        content = email_data.get('content') or ''
+        text = f"{email_data.get('subject') or ''}\n{content}"
+
+        has_attachments = bool(email_data.get('attachment_paths'))
+
+        matched, missing_items = [], []
+        if 'no_amount' in self.rules and not has_attachments and not has_monetary_amount(text):
+            matched.append('no_amount')
+            missing_items.append(MISSING_AMOUNT)
+        if 'no_attachments' in self.rules and not has_attachments:
+            matched.append('no_attachments')
+            missing_items.append(MISSING_DOCUMENTS)
+
+        if not matched:
+            PRESCREEN_DECISIONS.inc(outcome='sent_to_llm')
+            return None
+        if len(content.split()) < self.min_words:
+            matched.append('short_body')
+            missing_items.insert(0, MISSING_REASON)
+        for rule in matched:
+            PRESCREEN_RULE_HITS.inc(rule=rule)
+        return PrescreenDecision(matched, missing_items)
+
+    def should_shadow(self):
+        """Whether this decision should also go to the LLM; counts the outcome."""
+        shadow = random.random() < self.shadow_rate
+        PRESCREEN_DECISIONS.inc(outcome='shadowed' if shadow else 'decided')
+        return shadow
+
+    def record_shadow(self, decision, llm_response):
+        """Compare a decision with the LLM's status for the same claim."""
+        match = STATUS_PATTERN.search(llm_response or '')
+        agreed = (match.group(1) if match else 'PENDING') == 'PENDING'
+        PRESCREEN_SHADOW_RESULTS.inc(result='agree' if agreed else 'disagree')
+        if not agreed:
+            print(f"[PRESCREEN] LLM disagreed with rules {', '.join(decision.rules)}: it returned COMPLETED")
@@ -0,0 +1,103 @@
+import os
+import time
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROMPTS_FOLDER = os.path.join(os.path.dirname(__file__), 'prompts')
+
+# Templates the pipeline cannot run without; checked when the registry is created
+REQUIRED_TEMPLATES = (
+    'fulfillment_system_prompt.txt',
+    'fulfillment_pending_email.txt',
+    'user_not_found_email.txt',
+)
+
+
+class PromptTemplate:
+    """
+    A prompt file parsed once: `subject` (from a leading "Subject: " line, else None),
+    `body`, and `version` (a short hash of the text, changes on every edit).
+    """
+
+    def __init__(self, text, mtime):
+        self.text = text
+        self.mtime = mtime
+        self.version = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        self.subject = None
+        self.body = text
+
+        lines = text.split('\n')
+        if lines[0].startswith('Subject: '):
+            self.subject = lines[0][len('Subject: '):]
+            # Body starts after the subject line and the blank line following it
+            content_start = 2 if len(lines) > 1 and lines[1] == '' else 1
+            self.body = '\n'.join(lines[content_start:])
+
+
+class PromptRegistry:
+    """
+    Prompt templates from the prompts folder, parsed once and cached. A file is
+    re-read only when its mtime changes, checked at most every
+    PROMPT_RELOAD_SECONDS (0 = on every use).
+    """
+
+    def __init__(self, folder=PROMPTS_FOLDER, required=REQUIRED_TEMPLATES):
+        self.folder = folder
+        self.reload_seconds = float(os.getenv('PROMPT_RELOAD_SECONDS', 5))
+        self.templates = {}
+        self.checked_at = {}
+        self.lock = threading.Lock()
+
+        # Fail fast: a missing template would otherwise only show up mid-claim
+        missing = [name for name in required if not os.path.isfile(os.path.join(folder, name))]
+        if missing:
+            raise FileNotFoundError(f"Missing prompt templates in {folder}: {', '.join(missing)}")
+        for name in required:
+            self.get(name)
+        print(f"[OK] Loaded {len(required)} prompt templates")
+
+    def _load(self, name, mtime):
+        with open(os.path.join(self.folder, name), 'r', encoding='utf-8') as f:
+            return PromptTemplate(f.read().strip(), mtime)
+
+    def get(self, name):
+        """The parsed template `name`. Raises OSError if it has never been readable."""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.templates.get(name)
+            if cached is not None and now - self.checked_at[name] < self.reload_seconds:
+                return cached
+            self.checked_at[name] = now
+
+            try:
+                mtime = os.stat(os.path.join(self.folder, name)).st_mtime
+                if cached is not None and cached.mtime == mtime:
+                    return cached
+                template = self._load(name, mtime)
+            except OSError as e:
+                if cached is None:
+                    raise
+                # Keep serving the last good version while the file is being replaced
+                print(f"[WARN] Could not reload prompt {name}, keeping the cached version: {e}")
+                return cached
+
+            if cached is not None:
+                print(f"[OK] Reloaded prompt template {name}")
+            self.templates[name] = template
+            return template
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_prompt_registry():
+    """The process-wide PromptRegistry (created, and validated, on first use)."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry()
+        return _registry
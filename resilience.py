@@ -0,0 +1,146 @@
+import os
+import time
+import random
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Downstream dependencies guarded by a circuit breaker
+DEPENDENCY_BEDROCK = 'bedrock'
+DEPENDENCY_S3 = 's3'
+DEPENDENCY_USER_VALIDATOR = 'user_validator'
+DEPENDENCY_FULFILLMENT_API = 'fulfillment_api'
+DEPENDENCY_MAIL_SERVICE = 'mail_service'
+DEPENDENCY_IMAP = 'imap'
+
+DEPENDENCIES = [
+    DEPENDENCY_BEDROCK,
+    DEPENDENCY_S3,
+    DEPENDENCY_USER_VALIDATOR,
+    DEPENDENCY_FULFILLMENT_API,
+    DEPENDENCY_MAIL_SERVICE,
+    DEPENDENCY_IMAP,
+]
+
+# 4xx responses that are worth retrying; any other 4xx means the request itself is wrong
+RETRYABLE_CLIENT_STATUSES = (408, 429)
+
+
+def is_rejected(status_code):
+    """Whether an HTTP status means the service refused the request, so a retry cannot help."""
+    return 400 <= status_code < 500 and status_code not in RETRYABLE_CLIENT_STATUSES
+
+
+class NonRetryableError(Exception):
+    """A dependency answered but rejected the request; the job fails without retries."""
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+    def __init__(self, dependency, retry_at):
+        self.dependency = dependency
+        self.retry_at = retry_at
+        super().__init__(f"Circuit for {dependency} is open; not calling it until {time.ctime(retry_at)}")
+
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker. After `failure_threshold`
+    consecutive failures the circuit opens and calls fail fast for
+    `reset_timeout` seconds; then a single trial call is let through.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def retry_at(self):
+        """Wall-clock time at which the next trial call is allowed."""
+        return self.opened_at + self.reset_timeout
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() >= self.retry_at():
+                # Let one trial call through
+                self.state = self.HALF_OPEN
+                print(f"[CIRCUIT] {self.name} half-open, sending a trial call")
+                return
+            raise CircuitOpenError(self.name, self.retry_at())
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print(f"[CIRCUIT] {self.name} closed again")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"[CIRCUIT] {self.name} opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """Call `func` through the breaker. Raises CircuitOpenError while open."""
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except NonRetryableError:
+            # The dependency answered, so a rejected request is no sign it is down
+            self.record_success()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+def build_circuit_breakers():
+    """One breaker per downstream dependency, configured from the environment."""
+    failure_threshold = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+    reset_timeout = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+    return {
+        name: CircuitBreaker(name, failure_threshold, reset_timeout)
+        for name in DEPENDENCIES
+    }
+
+
+class RetryPolicy:
+    """
+    Per-stage retry budgets with exponential backoff and jitter.
+    Budgets are keyed by pipeline stage name (e.g. 'LLM_ASSESSMENT') and can be
+    overridden with RETRY_BUDGET_<STAGE>.
+    """
+
+    def __init__(self, default_budgets, base_delay=None, max_delay=None):
+        self.budgets = {
+            stage: int(os.getenv(f'RETRY_BUDGET_{stage}', budget))
+            for stage, budget in default_budgets.items()
+        }
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('RETRY_BASE_DELAY_SECONDS', 10))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('RETRY_MAX_DELAY_SECONDS', 900))
+
+    def should_retry(self, stage, retries_so_far):
+        return stage is not None and retries_so_far < self.budgets.get(stage, 0)
+
+    def backoff_seconds(self, retries_so_far):
+        """Exponential backoff with equal jitter: half fixed, half random."""
+        delay = min(self.max_delay, self.base_delay * (2 ** retries_so_far))
+        return delay / 2 + random.uniform(0, delay / 2)
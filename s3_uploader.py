@@ -1,12 +1,25 @@
 import os
 import boto3
+from botocore.exceptions import ClientError
 import json
 import uuid
 from datetime import datetime
 from dotenv import load_dotenv
+from metrics import counter
+from attachment_store import attachment_digest
 
 load_dotenv()
 
+S3_UPLOADED_BYTES = counter(
+    's3_uploaded_bytes_total',
+    'Bytes uploaded to S3',
+    label_names=('kind',)
+)
+S3_UPLOADS_SKIPPED = counter(
+    's3_uploads_skipped_total',
+    'Attachment uploads skipped because the same content is already in S3'
+)
+
 class S3Uploader:
     def __init__(self):
         self.config = {
@@ -16,6 +29,8 @@ class S3Uploader:
             'url_expiry': int(os.getenv('S3_URL_EXPIRY_SECONDS', 3600))
         }
         self.s3_client = None
+        # Content digests known to be in the bucket already
+        self.uploaded_digests = set()
         
     def authenticate_aws_session(self, aws_credentials=None):
         try:
@@ -81,12 +96,14 @@ class S3Uploader:
         try:
             s3_key = f"{self.config['s3_prefix']}/{user_email}/claims/{claim_id}/mail_content.txt"
             
+            body = mail_content.encode('utf-8')
             self.s3_client.put_object(
                 Bucket=self.config['bucket_name'],
                 Key=s3_key,
-                Body=mail_content.encode('utf-8'),
+                Body=body,
                 ContentType='text/plain'
             )
+            S3_UPLOADED_BYTES.inc(len(body), kind='mail_content')
             
             signed_url = self.s3_client.generate_presigned_url(
                 'get_object',
@@ -104,7 +121,11 @@ class S3Uploader:
             return None
 
     def upload_attachment(self, user_email, claim_id, attachment_path):
-        """Upload single attachment to S3 and return signed URL"""
+        """
+        Upload single attachment to S3 and return signed URL. Attachments are
+        stored once per content under <prefix>/attachments/<sha256>, so a file
+        resent with a later claim is not uploaded again.
+        """
         if not self.s3_client:
             print("[ERROR] S3 client not initialized. Please authenticate first.")
             return None
@@ -115,7 +136,8 @@ class S3Uploader:
                 return None
                 
             filename = os.path.basename(attachment_path)
-            s3_key = f"{self.config['s3_prefix']}/{user_email}/claims/{claim_id}/attachments/{filename}"
+            digest = attachment_digest(attachment_path)
+            s3_key = f"{self.config['s3_prefix']}/attachments/{digest}"
             
             # Get file info
             file_size = os.path.getsize(attachment_path)
@@ -134,31 +156,42 @@ class S3Uploader:
             }
             content_type = content_type_map.get(file_ext, 'application/octet-stream')
             
-            # Upload attachment
-            self.s3_client.upload_file(
-                attachment_path, 
-                self.config['bucket_name'], 
-                s3_key,
-                ExtraArgs={
-                    'ContentType': content_type,
-                    'Metadata': {
-                        'claim_id': claim_id,
-                        'user_email': user_email,
-                        'original_filename': filename,
-                        'file_size': str(file_size),
-                        'upload_timestamp': datetime.now().isoformat()
+            if self.is_uploaded(digest, s3_key):
+                S3_UPLOADS_SKIPPED.inc()
+                print(f"[OK] Attachment already in S3: {filename} ({digest[:12]})")
+            else:
+                # Upload attachment
+                self.s3_client.upload_file(
+                    attachment_path, 
+                    self.config['bucket_name'], 
+                    s3_key,
+                    ExtraArgs={
+                        'ContentType': content_type,
+                        'Metadata': {
+                            'claim_id': claim_id,
+                            'user_email': user_email,
+                            'original_filename': filename,
+                            'file_size': str(file_size),
+                            'sha256': digest,
+                            'upload_timestamp': datetime.now().isoformat()
+                        }
                     }
-                }
-            )
+                )
+                self.uploaded_digests.add(digest)
+                S3_UPLOADED_BYTES.inc(file_size, kind='attachment')
+                print(f"[OK] Attachment uploaded: {filename} ({file_size} bytes)")
             
-            # Generate signed URL
+            # Generate signed URL; the download keeps this claim's filename
             signed_url = self.s3_client.generate_presigned_url(
                 'get_object',
-                Params={'Bucket': self.config['bucket_name'], 'Key': s3_key},
+                Params={
+                    'Bucket': self.config['bucket_name'],
+                    'Key': s3_key,
+                    'ResponseContentDisposition': f'attachment; filename="{filename}"'
+                },
                 ExpiresIn=self.config['url_expiry']
             )
             
-            print(f"[OK] Attachment uploaded: {filename} ({file_size} bytes)")
             return {
                 'url': signed_url,
                 's3_key': s3_key,
@@ -166,6 +199,7 @@ class S3Uploader:
                 'filename': filename,
                 'file_size': file_size,
                 'content_type': content_type,
+                'sha256': digest,
                 'expires_in': self.config['url_expiry']
             }
             
@@ -173,6 +207,19 @@ class S3Uploader:
             print(f"[ERROR] Error uploading attachment {attachment_path}: {e}")
             return None
 
+    def is_uploaded(self, digest, s3_key):
+        """True if the content is already in the bucket."""
+        if digest in self.uploaded_digests:
+            return True
+        try:
+            self.s3_client.head_object(Bucket=self.config['bucket_name'], Key=s3_key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        self.uploaded_digests.add(digest)
+        return True
+
     def upload_attachments(self, user_email, claim_id, attachment_paths):
         """Upload multiple attachments to S3 and return list of signed URLs"""
         if not attachment_paths:
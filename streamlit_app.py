@@ -8,6 +8,8 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 import time
+from http_client import get_service_client
+from job_stats import get_stage_percentiles
 
 # --- Page Configuration ---
 # This must be the first Streamlit command
@@ -270,17 +272,17 @@ def get_kpi_metrics(_connection):
         
     try:
         with _connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT COUNT(*) as count FROM mail_jobs")
-            metrics['total_jobs_in_pipe'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM human_fulfillment WHERE status = 'NEEDS_REVIEW'")
-            metrics['pending_review'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM mail_jobs WHERE status = 'PENDING'")
-            metrics['pending_processing'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM mail_jobs WHERE status = 'PROCESSED_SUCCESS'")
-            metrics['processed_success'] = cursor.fetchone()['count']
+            # One pass over mail_jobs for all job counts
+            cursor.execute("""
+                SELECT COUNT(*) AS total_jobs_in_pipe,
+                       COALESCE(SUM(status IN ('PENDING', 'HEADERS_ONLY')), 0) AS pending_processing,
+                       COALESCE(SUM(status = 'PROCESSED_SUCCESS'), 0) AS processed_success,
+                       (SELECT COUNT(*) FROM human_fulfillment WHERE status = 'NEEDS_REVIEW') AS pending_review
+                FROM mail_jobs
+            """)
+            row = cursor.fetchone()
+            for key in metrics:
+                metrics[key] = int(row[key])
             
         return metrics
     except Exception as e:
@@ -317,6 +319,40 @@ def mark_job_resolved(_connection, job_id):
         _connection.rollback()
         return False
 
+def requeue_failed_job(_connection, human_job_id, failed_job_id):
+    """
+    Send a failed job back to the worker queue. The worker resumes from its last
+    checkpoint, with fresh per-stage retry budgets and no pending backoff. Unless
+    the fulfillment record was already saved, the LLM assessment is dropped so
+    the claim is assessed again.
+    """
+    try:
+        with _connection.cursor() as cursor:
+            query = """
+                UPDATE mail_jobs
+                SET status = 'PENDING', error_message = NULL, worker_id = NULL,
+                    lease_expires_at = NULL, attempt_count = 0, next_attempt_at = NULL,
+                    checkpoint = IF(
+                        JSON_CONTAINS_PATH(checkpoint, 'one', '$.fulfillment_id'),
+                        JSON_REMOVE(checkpoint, '$.retries'),
+                        JSON_REMOVE(checkpoint, '$.retries', '$.llm_response', '$.parsed_result', '$.s3_result')
+                    )
+                WHERE id = %s AND status = 'FAILED'
+            """
+            cursor.execute(query, (failed_job_id,))
+            if cursor.rowcount == 0:
+                _connection.rollback()
+                st.warning(f"Job {failed_job_id} is not in FAILED state and was not requeued.")
+                return False
+            cursor.execute("UPDATE human_fulfillment SET status = 'RESOLVED' WHERE id = %s", (human_job_id,))
+            _connection.commit()
+        st.cache_data.clear() # Clear cache to refresh
+        return True
+    except Exception as e:
+        st.error(f"Failed to requeue job: {e}")
+        _connection.rollback()
+        return False
+
 @st.cache_data(ttl=30) # Cache for 30 seconds
 def fetch_fulfillments(_connection, status_filter):
     if not _connection or not _connection.is_connected():
@@ -359,15 +395,13 @@ def fetch_users(_connection):
 def add_user_to_database(email, policy_type, policy_date):
     """Add new user to database via API"""
     try:
-        user_validator_url = os.getenv('FASTAPI_BASE_URL', 'http://localhost:8000')
-        
         user_data = {
             "mail_id": email,
             "policy_type": policy_type,
             "policy_issued_date": policy_date.strftime('%Y-%m-%d')
         }
         
-        response = requests.post(f"{user_validator_url}/user", json=user_data, timeout=10)
+        response = get_service_client('user_validator').post("/user", json=user_data)
         
         if response.status_code == 201:
             # st.cache_data.clear() # REMOVED - will be handled by the main page
@@ -384,10 +418,10 @@ def add_user_to_database(email, policy_type, policy_date):
         return False, f"Error adding user: {str(e)}"
 
 @st.cache_data(ttl=10)
-def check_api_health(url):
+def check_api_health(service_name):
     """Check if API is online"""
     try:
-        response = requests.get(url, timeout=3)
+        response = get_service_client(service_name).get("/", timeout=3)
         if response.status_code == 200:
             return "Online", response.json().get('status', 'OK')
         return "Offline", f"Status Code {response.status_code}"
@@ -430,18 +464,51 @@ def fetch_worker_status(_connection):
 
 @st.cache_data(ttl=10)
 def fetch_monitor_status(_connection):
-    """Fetch last mail check status"""
+    """Fetch last mail check status (the least recently checked mail source)"""
     try:
         with _connection.cursor(dictionary=True) as cursor:
-            query = "SELECT last_connection_time FROM last_mail_details ORDER BY id DESC LIMIT 1"
+            query = "SELECT MIN(last_connection_time) AS last_connection_time, COUNT(*) AS sources FROM mail_checkpoints"
             cursor.execute(query)
             result = cursor.fetchone()
             if result and result['last_connection_time']:
-                return "Active", result['last_connection_time'].strftime('%Y-%m-%d %H:%M:%S')
+                last_check = result['last_connection_time'].strftime('%Y-%m-%d %H:%M:%S')
+                if result['sources'] > 1:
+                    last_check += f" (oldest of {result['sources']} sources)"
+                return "Active", last_check
             return "Unknown", "No mail checks logged"
     except Exception as e:
         return "Unknown", str(e)
 
+@st.cache_data(ttl=10)
+def fetch_stage_breakdown(_connection):
+    """Count in-flight (FLYING) jobs by the pipeline stage they are currently in"""
+    try:
+        with _connection.cursor(dictionary=True) as cursor:
+            query = """
+                SELECT COALESCE(current_stage, 'CLAIMED') AS stage,
+                       COUNT(*) AS jobs,
+                       MIN(stage_updated_at) AS oldest_entered_at
+                FROM mail_jobs
+                WHERE status = 'FLYING'
+                GROUP BY current_stage
+                ORDER BY jobs DESC
+            """
+            cursor.execute(query)
+            results = cursor.fetchall()
+            return pd.DataFrame(results) if results else pd.DataFrame()
+    except Exception as e:
+        st.error(f"Error fetching pipeline stages: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60)
+def fetch_stage_latency(_connection, since_hours):
+    """p50/p95/p99 seconds per processing stage"""
+    try:
+        return pd.DataFrame(get_stage_percentiles(_connection, since_hours=since_hours))
+    except Exception as e:
+        st.error(f"Error fetching stage latency: {e}")
+        return pd.DataFrame()
+
 # --- Page Navigation ---
 
 st.sidebar.title("Navigation")
@@ -523,6 +590,20 @@ if page == "Overview":
         </div>
         """, unsafe_allow_html=True)
 
+    # --- Pipeline Stages ---
+    st.markdown("""
+    <div class="section-header">
+        <h2 class="section-title">🧩 Jobs In Flight by Stage</h2>
+    </div>
+    """, unsafe_allow_html=True)
+
+    stages_df = fetch_stage_breakdown(connection)
+    if stages_df.empty:
+        st.info("No jobs are currently being processed.")
+    else:
+        st.bar_chart(stages_df.set_index('stage')['jobs'])
+        st.dataframe(stages_df, use_container_width=True, hide_index=True)
+
     # --- Instructions ---
     st.markdown("""
     <div class="section-header">
@@ -633,6 +714,12 @@ elif page == "Human Fulfillment (Failures)":
                         if mark_job_resolved(connection, row['id']):
                             st.success(f"Job {row['id']} marked as resolved.")
                             st.rerun()
+                    
+                    # Completed stages (e.g. the LLM assessment) are checkpointed and are not repeated
+                    if st.button(f"Retry from Checkpoint (ID: {row['id']})"):
+                        if requeue_failed_job(connection, row['id'], row['failed_job_id']):
+                            st.success(f"Job {row['failed_job_id']} sent back to the worker queue.")
+                            st.rerun()
 
 elif page == "Processed Claims (Archive)":
     st.title("📋 Processed Claims Archive")
@@ -779,13 +866,13 @@ elif page == "System Status":
     """, unsafe_allow_html=True)
 
     services = [
-        {"name": "User Validator API", "url": os.getenv('FASTAPI_BASE_URL', 'http://localhost:8000') + "/", "port": 8000, "icon": "👤"},
-        {"name": "Mail Service API", "url": os.getenv('MAIL_SERVICE_URL', 'http://localhost:8001') + "/", "port": 8001, "icon": "📧"},
-        {"name": "Fulfillment API", "url": os.getenv('FULFILLMENT_API_URL', 'http://localhost:8002') + "/", "port": 8002, "icon": "📋"}
+        {"name": "User Validator API", "client": "user_validator", "url": os.getenv('FASTAPI_BASE_URL', 'http://localhost:8000') + "/", "port": 8000, "icon": "👤"},
+        {"name": "Mail Service API", "client": "mail_service", "url": os.getenv('MAIL_SERVICE_URL', 'http://localhost:8001') + "/", "port": 8001, "icon": "📧"},
+        {"name": "Fulfillment API", "client": "fulfillment_api", "url": os.getenv('FULFILLMENT_API_URL', 'http://localhost:8002') + "/", "port": 8002, "icon": "📋"}
     ]
 
     for service in services:
-        status, message = check_api_health(service['url'])
+        status, message = check_api_health(service['client'])
         status_color = "#d4edda" if status == "Online" else "#f8d7da"
         status_text = f"🟢 {status}" if status == "Online" else f"🔴 {status}"
         
@@ -852,3 +939,17 @@ elif page == "System Status":
         </div>
     </div>
     """, unsafe_allow_html=True)
+
+    # --- Stage Latency ---
+    st.markdown("""
+    <div class="section-header">
+        <h2 class="section-title">⏱️ Stage Latency (seconds)</h2>
+    </div>
+    """, unsafe_allow_html=True)
+
+    since_hours = st.selectbox("Window", [1, 24, 168], index=1, format_func=lambda h: f"Last {h} hours")
+    latency_df = fetch_stage_latency(connection, since_hours)
+    if latency_df.empty:
+        st.info("No stage timings recorded in this window yet.")
+    else:
+        st.dataframe(latency_df, use_container_width=True, hide_index=True)
@@ -4,10 +4,14 @@ from mysql.connector import Error
 from datetime import datetime
 from dotenv import load_dotenv
 import time
+from metrics import counter, histogram, start_metrics_server
 
 # Load environment variables from .env file
 load_dotenv()
 
+JANITOR_JOBS = counter('janitor_jobs_total', 'Jobs recovered by the janitor', label_names=('action',))
+JANITOR_RUN_SECONDS = histogram('janitor_run_seconds', 'Duration of each janitor pass')
+
 def connect_to_database():
     """Connect to MySQL database using mysql.connector."""
     try:
@@ -24,9 +28,69 @@ def connect_to_database():
         print(f"[ERROR] Database connection failed: {e}")
         return None
 
+def reclaim_expired_leases(connection, max_attempts):
+    """
+    Return 'FLYING' jobs whose lease has expired (their worker stopped sending
+    heartbeats) to 'PENDING'. Jobs that have used up their attempts are failed
+    and sent to the human_fulfillment table instead.
+    Returns (reclaimed, failed).
+    """
+    with connection.cursor(dictionary=True) as cursor:
+        cursor.execute("""
+            SELECT id, attempt_count FROM mail_jobs
+            WHERE status = 'FLYING' AND lease_expires_at < NOW()
+            FOR UPDATE SKIP LOCKED
+        """)
+        expired = cursor.fetchall()
+        if not expired:
+            connection.commit()
+            return 0, 0
+        
+        retry_ids = [job['id'] for job in expired if job['attempt_count'] < max_attempts]
+        exhausted_ids = [job['id'] for job in expired if job['attempt_count'] >= max_attempts]
+        
+        if retry_ids:
+            placeholders = ", ".join(["%s"] * len(retry_ids))
+            cursor.execute(f"""
+                UPDATE mail_jobs
+                SET status = 'PENDING',
+                    worker_id = NULL,
+                    lease_expires_at = NULL,
+                    error_message = 'Reclaimed by Janitor (lease expired)',
+                    last_processed_at = %s
+                WHERE id IN ({placeholders})
+            """, (datetime.now(), *retry_ids))
+        
+        if exhausted_ids:
+            placeholders = ", ".join(["%s"] * len(exhausted_ids))
+            error_message = f"Lease expired after {max_attempts} attempts"
+            cursor.execute(f"""
+                INSERT INTO human_fulfillment
+                (failed_job_id, claim_id, sender_email, error_message, full_job_data, status, created_at)
+                SELECT id, claim_id, sender_email, %s,
+                       JSON_OBJECT('id', id, 'claim_id', claim_id, 'sender_email', sender_email,
+                                   'subject', subject, 'worker_id', worker_id,
+                                   'attempt_count', attempt_count, 'created_at', created_at),
+                       'NEEDS_REVIEW', %s
+                FROM mail_jobs WHERE id IN ({placeholders})
+            """, (error_message, datetime.now(), *exhausted_ids))
+            cursor.execute(f"""
+                UPDATE mail_jobs
+                SET status = 'FAILED',
+                    worker_id = NULL,
+                    lease_expires_at = NULL,
+                    error_message = %s,
+                    last_processed_at = %s
+                WHERE id IN ({placeholders})
+            """, (error_message, datetime.now(), *exhausted_ids))
+        
+        connection.commit()
+        return len(retry_ids), len(exhausted_ids)
+
 def reset_stuck_jobs():
     """
-    Resets jobs that have been in the 'FLYING' state for too long
+    Reclaims jobs whose worker lease has expired, and resets jobs without a
+    lease (claimed before leases existed) that have been 'FLYING' for too long
     (e.g., > 300 seconds) back to 'PENDING'.
     """
     connection = connect_to_database()
@@ -38,10 +102,20 @@ def reset_stuck_jobs():
     
     # Get timeout from env or default to 300 seconds (5 minutes)
     timeout_seconds = int(os.getenv('JOB_TIMEOUT_SECONDS', 300))
+    max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
     
+    start = time.perf_counter()
     try:
+        reclaimed, failed = reclaim_expired_leases(connection, max_attempts)
+        JANITOR_JOBS.inc(reclaimed, action='reclaimed')
+        JANITOR_JOBS.inc(failed, action='failed')
+        if reclaimed > 0:
+            print(f"[OK] Reclaimed {reclaimed} jobs with expired leases.")
+        if failed > 0:
+            print(f"[FAIL] {failed} jobs exceeded {max_attempts} attempts and were sent to human_fulfillment.")
+        
         with connection.cursor(dictionary=True) as cursor:
-            # Find jobs that are 'FLYING' and older than the timeout
+            # Find unleased jobs that are 'FLYING' and older than the timeout
             query = """
                 UPDATE mail_jobs
                 SET 
@@ -50,29 +124,34 @@ def reset_stuck_jobs():
                     last_processed_at = %s
                 WHERE 
                     status = 'FLYING' 
+                    AND lease_expires_at IS NULL
                     AND last_processed_at < NOW() - INTERVAL %s SECOND
             """
             cursor.execute(query, (datetime.now(), timeout_seconds))
             affected_rows = cursor.rowcount
             
             connection.commit()
+            JANITOR_JOBS.inc(affected_rows, action='reset')
             
             if affected_rows > 0:
                 print(f"[OK] Found and reset {affected_rows} stuck 'FLYING' jobs.")
-            else:
+            elif reclaimed == 0 and failed == 0:
                 print("[OK] No stuck jobs found.")
                 
     except Error as e:
         print(f"[ERROR] Error during janitor run: {e}")
         connection.rollback()
     finally:
+        JANITOR_RUN_SECONDS.observe(time.perf_counter() - start)
         if connection.is_connected():
             connection.close()
             print("[JANITOR] Cleanup finished. Connection closed.")
 
 if __name__ == "__main__":
+    # Leases expire quickly, so the janitor runs often (default every 15 seconds)
+    interval_seconds = int(os.getenv('JANITOR_INTERVAL_SECONDS', 15))
+    start_metrics_server('JANITOR_METRICS_PORT', 9103)
     while True:
         reset_stuck_jobs()
-        # Run the janitor every 5 minutes
-        print("[WAIT] Janitor sleeping for 300 seconds...")
-        time.sleep(300)
+        print(f"[WAIT] Janitor sleeping for {interval_seconds} seconds...")
+        time.sleep(interval_seconds)
@@ -0,0 +1,40 @@
+import unittest
+
+from resilience import CircuitBreaker, NonRetryableError, is_rejected
+
+
+def rejected():
+    raise NonRetryableError("422 - invalid claim")
+
+
+def unavailable():
+    raise Exception("503 - service unavailable")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_rejected_requests_do_not_open_the_circuit(self):
+        breaker = CircuitBreaker('fulfillment_api', failure_threshold=2)
+        for _ in range(3):
+            with self.assertRaises(NonRetryableError):
+                breaker.call(rejected)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_failures_open_the_circuit(self):
+        breaker = CircuitBreaker('fulfillment_api', failure_threshold=2)
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                breaker.call(unavailable)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_only_unfixable_client_errors_are_rejections(self):
+        self.assertTrue(is_rejected(400))
+        self.assertTrue(is_rejected(422))
+        self.assertFalse(is_rejected(408))
+        self.assertFalse(is_rejected(429))
+        self.assertFalse(is_rejected(503))
+
+
+if __name__ == '__main__':
+    unittest.main()
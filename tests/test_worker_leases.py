@@ -0,0 +1,92 @@
+import threading
+import unittest
+from unittest import mock
+
+from worker import MailWorker, LeaseLostError
+
+
+class FakeCursor:
+    def __init__(self, executed, rowcount, row=None):
+        self.executed = executed
+        self.rowcount = rowcount
+        self.row = row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def fetchone(self):
+        return self.row
+
+
+def make_worker(in_flight):
+    """A MailWorker with a fake DB connection and no background threads."""
+    worker = MailWorker.__new__(MailWorker)
+    worker._local = threading.local()
+    worker.worker_id = 'test-worker'
+    worker.lease_seconds = 60
+    worker.in_flight = set(in_flight)
+    worker.executed = []
+    connection = mock.Mock()
+    connection.cursor.side_effect = lambda *args, **kwargs: FakeCursor(worker.executed, len(worker.in_flight))
+    worker.db_connection = connection
+    return worker
+
+
+class RenewLeasesTest(unittest.TestCase):
+
+    def test_renews_only_jobs_in_flight(self):
+        worker = make_worker({1, 2})
+        self.assertEqual(worker.renew_leases(), 2)
+        query, params = worker.executed[-1]
+        self.assertIn('id IN', query)
+        self.assertEqual(sorted(params[2:]), [1, 2])
+
+    def test_abandoned_job_lease_runs_out(self):
+        worker = make_worker({1, 2})
+        worker.abandon_job({'id': 2}, Exception('DB gone'))
+        worker.renew_leases()
+        _, params = worker.executed[-1]
+        # Job 2 is no longer renewed, so its lease expires and the janitor reclaims it
+        self.assertEqual(list(params[2:]), [1])
+
+    def test_nothing_to_renew_skips_the_query(self):
+        worker = make_worker({3})
+        worker.abandon_job({'id': 3}, Exception('DB gone'))
+        self.assertEqual(worker.renew_leases(), 0)
+        self.assertEqual(worker.executed, [])
+
+
+class LostLeaseTest(unittest.TestCase):
+
+    def make_ctx(self):
+        return {'job': {'id': 4}, 'checkpoint': {}, 'stage_timings': {}}
+
+    def test_checkpoint_reports_lost_lease(self):
+        worker = make_worker(set())
+        self.assertFalse(worker.save_checkpoint(self.make_ctx(), llm_response='x'))
+        with self.assertRaises(LeaseLostError):
+            worker.checkpoint_or_stop(self.make_ctx(), llm_response='x')
+
+    def test_unchanged_checkpoint_keeps_lease(self):
+        worker = make_worker(set())
+        worker.db_connection.cursor.side_effect = lambda *args, **kwargs: FakeCursor(worker.executed, 0, (1,))
+        self.assertTrue(worker.save_checkpoint(self.make_ctx(), llm_response='x'))
+
+    def test_lost_lease_is_not_a_failure(self):
+        worker = make_worker({4})
+        worker.reschedule_job = mock.Mock()
+        worker.handle_job_failure = mock.Mock()
+        worker.route_job_error(self.make_ctx(), LeaseLostError('lease lost'))
+        worker.reschedule_job.assert_not_called()
+        worker.handle_job_failure.assert_not_called()
+        self.assertEqual(worker.in_flight, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,157 @@
 import os
+import socket
+import uuid
 import mysql.connector
 from mysql.connector import Error
 import time
 import json
+import random
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 from fulfillment_processor import FulfillmentProcessor
+from job_notifier import JobWakeupListener
+from http_client import get_service_client
+from imap_client import AttachmentFetcher, AttachmentTooLarge
+from attachment_store import get_attachment_limits, estimated_size, open_attachment
+from assessment_cache import AssessmentCache
+from prescreen import PrescreenEngine
+from image_preprocessor import is_image
+from pdf_extractor import is_pdf
+from metrics import counter, gauge, histogram, start_metrics_server
+from pipeline import PipelineEngine, Stage, StageFailure
+from resilience import (
+    RetryPolicy, CircuitOpenError, NonRetryableError, build_circuit_breakers, is_rejected,
+    DEPENDENCY_BEDROCK, DEPENDENCY_S3, DEPENDENCY_USER_VALIDATOR,
+    DEPENDENCY_FULFILLMENT_API, DEPENDENCY_MAIL_SERVICE, DEPENDENCY_IMAP
+)
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Pipeline stages, in order. Also stored in mail_jobs.current_stage.
+STAGE_USER_VALIDATION = 'USER_VALIDATION'
+STAGE_ATTACHMENT_FETCH = 'ATTACHMENT_FETCH'
+STAGE_ATTACHMENT_PREPROCESS = 'ATTACHMENT_PREPROCESS'
+STAGE_LLM_ASSESSMENT = 'LLM_ASSESSMENT'
+STAGE_LLM_PARSE = 'LLM_PARSE'
+STAGE_S3_UPLOAD = 'S3_UPLOAD'
+STAGE_FULFILLMENT_API = 'FULFILLMENT_API'
+STAGE_MAIL_SERVICE = 'MAIL_SERVICE'
+STAGE_FINALIZE = 'FINALIZE'
+
+# Default threads per stage in pipeline mode (override with PIPELINE_<STAGE>_CONCURRENCY)
+DEFAULT_STAGE_CONCURRENCY = {
+    STAGE_USER_VALIDATION: 2,
+    STAGE_ATTACHMENT_FETCH: 2,
+    STAGE_ATTACHMENT_PREPROCESS: 2,
+    STAGE_LLM_ASSESSMENT: 4,
+    STAGE_LLM_PARSE: 1,
+    STAGE_S3_UPLOAD: 2,
+    STAGE_FULFILLMENT_API: 2,
+    STAGE_MAIL_SERVICE: 2,
+    STAGE_FINALIZE: 1,
+}
+
+# Automatic retries per stage before a job goes to human_fulfillment
+# (override with RETRY_BUDGET_<STAGE>). Parsing and preprocessing are deterministic, so they are not retried.
+DEFAULT_RETRY_BUDGETS = {
+    STAGE_USER_VALIDATION: 3,
+    STAGE_ATTACHMENT_FETCH: 3,
+    STAGE_ATTACHMENT_PREPROCESS: 0,
+    STAGE_LLM_ASSESSMENT: 3,
+    STAGE_LLM_PARSE: 0,
+    STAGE_S3_UPLOAD: 3,
+    STAGE_FULFILLMENT_API: 3,
+    STAGE_MAIL_SERVICE: 3,
+    STAGE_FINALIZE: 0,
+}
+
+JOBS_CLAIMED = counter('worker_jobs_claimed_total', 'Jobs leased from mail_jobs by this worker')
+JOBS_FINISHED = counter('worker_jobs_finished_total', 'Jobs this worker moved to a final status', label_names=('status',))
+JOBS_RESCHEDULED = counter('worker_jobs_rescheduled_total', 'Jobs put back to PENDING for a later retry', label_names=('stage', 'reason'))
+STAGE_RUNS = counter('worker_stage_runs_total', 'Stage executions by outcome', label_names=('stage', 'outcome'))
+STAGE_SECONDS = histogram('worker_stage_seconds', 'Run time of each pipeline stage', label_names=('stage',))
+JOBS_IN_FLIGHT = gauge('worker_jobs_in_flight', 'Jobs currently leased by this worker, including buffered claims')
+QUEUE_DEPTH = gauge('mail_jobs_queue_depth', 'mail_jobs rows waiting or being processed', label_names=('status',))
+PIPELINE_QUEUE_DEPTH = gauge('worker_pipeline_queue_depth', 'Jobs waiting in each stage queue (pipeline mode)', label_names=('stage',))
+DB_QUERY_SECONDS = histogram('db_query_seconds', 'Latency of MySQL queries', label_names=('query',))
+
+class LeaseLostError(Exception):
+    """A job's lease was taken over (janitor or another worker) while this worker ran it."""
+
+
 class MailWorker:
     def __init__(self):
         """Initialize the worker, database connection, and fulfillment processor."""
         print("[START] Initializing Mail Worker (Consumer)")
+        # Each processing slot (thread) keeps its own DB connection
+        self._local = threading.local()
         self.db_connection = self.connect_to_database()
         self.fulfillment_processor = FulfillmentProcessor()
+        # Downloads attachments the monitor deferred (see mail_jobs.attachment_manifest)
+        self.attachment_fetcher = AttachmentFetcher()
+        # LLM responses for inputs already assessed (see llm_assessment_cache)
+        self.assessment_cache = AssessmentCache()
+        # Rules that settle obviously incomplete claims without the LLM
+        self.prescreen = PrescreenEngine()
+        
+        # Job ownership: leases are renewed by a heartbeat thread while this process lives
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = int(os.getenv('JOB_LEASE_SECONDS', 60))
+        self.heartbeat_seconds = float(os.getenv('JOB_HEARTBEAT_SECONDS', self.lease_seconds / 3))
         
-        # API endpoints
-        self.fastapi_base_url = os.getenv('FASTAPI_BASE_URL', 'http://localhost:8000')
-        self.mail_service_url = os.getenv('MAIL_SERVICE_URL', 'http://localhost:8001')
+        # Transient failures are retried with backoff; dependencies that keep
+        # failing are short-circuited until they recover
+        self.retry_policy = RetryPolicy(DEFAULT_RETRY_BUDGETS)
+        self.breakers = build_circuit_breakers()
+        
+        # 'slots' runs whole jobs per thread; 'pipeline' gives each stage its own pool
+        self.mode = os.getenv('WORKER_MODE', 'slots').lower()
+        
+        # Number of claims kept in flight by this worker process (slots mode)
+        self.concurrency = max(1, int(os.getenv('WORKER_CONCURRENCY', 1)))
+        
+        # Jobs are leased from mail_jobs in batches and handed out from a local buffer
+        self.claim_batch_size = max(1, int(os.getenv('WORKER_CLAIM_BATCH_SIZE', self.concurrency)))
+        self.job_buffer = deque()
+        self.buffer_lock = threading.Lock()
+        
+        # IDs of jobs leased by this process, for the in-flight gauge
+        self.in_flight = set()
+        self.pipeline = None
+        JOBS_IN_FLIGHT.set_function(lambda: len(self.in_flight))
+        
+        # Idle slots sleep until the monitor signals new jobs, polling with
+        # exponential backoff in case a signal is missed
+        self.poll_min_seconds = float(os.getenv('WORKER_POLL_MIN_SECONDS', 0.5))
+        self.poll_max_seconds = float(os.getenv('WORKER_POLL_MAX_SECONDS', 30))
+        self.wakeup_listener = JobWakeupListener()
+        if not self.wakeup_listener.start():
+            self.wakeup_listener = None
+        
+        # API clients (pooled keep-alive connections shared by all slots)
+        self.user_validator_client = get_service_client('user_validator')
+        self.mail_service_client = get_service_client('mail_service')
         self.human_verifier_email = os.getenv('HUMAN_VERIFICATION_EMAIL_ID')
         
         if not self.human_verifier_email:
             print("[WARN] HUMAN_VERIFICATION_EMAIL_ID not set. Error notifications will not be sent.")
 
+    @property
+    def db_connection(self):
+        """DB connection owned by the current processing slot (connected on first use by the slot)."""
+        if getattr(self._local, 'db_connection', None) is None:
+            self._local.db_connection = self.connect_to_database()
+        return self._local.db_connection
+
+    @db_connection.setter
+    def db_connection(self, connection):
+        self._local.db_connection = connection
+
     def connect_to_database(self):
         # ... (all existing connect_to_database code is unchanged) ...
         """Connect to MySQL database using mysql.connector."""
@@ -45,59 +171,156 @@ class MailWorker:
             print(f"[ERROR] Worker database connection failed: {e}")
             return None
 
-    def get_next_pending_job(self):
-        # ... (all existing get_next_pending_job code is unchanged) ...
-        """Get the next 'PENDING' job from the queue and lock it."""
+    def claim_pending_jobs(self, limit):
+        """Lease up to `limit` 'PENDING' jobs in a single transaction."""
         if not self.db_connection or not self.db_connection.is_connected():
             self.db_connection = self.connect_to_database()
             if not self.db_connection:
-                return None
+                return []
 
         try:
-            with self.db_connection.cursor(dictionary=True) as cursor:
-                # Lock the next PENDING row so no other worker can grab it
+            with self.db_connection.cursor(dictionary=True) as cursor, DB_QUERY_SECONDS.time(query='claim_jobs'):
+                # Lock the next PENDING rows so no other worker can grab them
                 cursor.execute("""
                     SELECT * FROM mail_jobs 
                     WHERE status = 'PENDING' 
+                      AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())
                     ORDER BY created_at ASC 
-                    LIMIT 1 
+                    LIMIT %s 
                     FOR UPDATE SKIP LOCKED
-                """)
-                job = cursor.fetchone()
+                """, (limit,))
+                jobs = cursor.fetchall()
                 
-                if job:
-                    # Immediately update status to 'FLYING' to "check it out"
-                    cursor.execute("""
+                if jobs:
+                    # Check all of them out to 'FLYING' with one multi-row UPDATE
+                    job_ids = [job['id'] for job in jobs]
+                    placeholders = ", ".join(["%s"] * len(job_ids))
+                    # Lease them to this worker; the heartbeat keeps the lease alive
+                    cursor.execute(f"""
                         UPDATE mail_jobs 
-                        SET status = 'FLYING', last_processed_at = %s 
-                        WHERE id = %s
-                    """, (datetime.now(), job['id']))
-                    self.db_connection.commit()
-                    return job
+                        SET status = 'FLYING', last_processed_at = %s,
+                            worker_id = %s,
+                            lease_expires_at = NOW() + INTERVAL %s SECOND,
+                            attempt_count = attempt_count + 1
+                        WHERE id IN ({placeholders})
+                    """, (datetime.now(), self.worker_id, self.lease_seconds, *job_ids))
                 
                 self.db_connection.commit() # Release any locks
-                return None
+                
+                claimed_at = datetime.now()
+                for job in jobs:
+                    job['claimed_at'] = claimed_at
+                    self.in_flight.add(job['id'])
+                JOBS_CLAIMED.inc(len(jobs))
+                return jobs
                 
         except Error as e:
-            print(f"[ERROR] Error getting next job: {e}")
+            print(f"[ERROR] Error claiming jobs: {e}")
             self.db_connection.rollback()
+            return []
+
+    def get_next_pending_job(self):
+        """Get the next claimed job, refilling the local buffer from the queue when empty."""
+        with self.buffer_lock:
+            if not self.job_buffer:
+                jobs = self.claim_pending_jobs(self.claim_batch_size)
+                if len(jobs) > 1:
+                    print(f"[QUEUE] Claimed a batch of {len(jobs)} jobs")
+                self.job_buffer.extend(jobs)
+            
+            if self.job_buffer:
+                return self.job_buffer.popleft()
             return None
 
-    def update_job_status(self, job_id, status, error_message=None):
-        # ... (all existing update_job_status code is unchanged) ...
-        """Update the status of a job in the mail_jobs table."""
+    def update_job_status(self, job_id, status, error_message=None, stage_timings=None):
+        """
+        Set the final status of a job this worker holds the lease for and release the lease.
+        Returns False if the update failed or the lease was lost to another worker.
+        """
+        self.in_flight.discard(job_id)
         try:
-            with self.db_connection.cursor() as cursor:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='update_status'):
                 cursor.execute("""
                     UPDATE mail_jobs 
-                    SET status = %s, error_message = %s, last_processed_at = %s
-                    WHERE id = %s
-                """, (status, error_message, datetime.now(), job_id))
+                    SET status = %s, error_message = %s, last_processed_at = %s,
+                        lease_expires_at = NULL,
+                        stage_timings = COALESCE(%s, stage_timings)
+                    WHERE id = %s AND worker_id = %s AND status = 'FLYING'
+                """, (status, error_message, datetime.now(),
+                      json.dumps(stage_timings) if stage_timings else None,
+                      job_id, self.worker_id))
+                updated = cursor.rowcount
             self.db_connection.commit()
+            if not updated:
+                print(f"[WARN] Lease for job {job_id} was lost; status {status} not recorded")
+                return False
+            JOBS_FINISHED.inc(status=status)
             print(f"[JOB] Updated job {job_id} to status: {status}")
+            return True
         except Error as e:
             print(f"[ERROR] Error updating job status for {job_id}: {e}")
             self.db_connection.rollback()
+            return False
+
+    def renew_leases(self):
+        """
+        Extend the lease on the jobs this worker is still working on (`in_flight`).
+        Jobs it dropped, e.g. after failing to record their status, are left to
+        expire so stuck_job_resolver.py can reclaim them.
+        """
+        job_ids = list(self.in_flight.copy())
+        if not job_ids:
+            return 0
+        placeholders = ", ".join(["%s"] * len(job_ids))
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='renew_leases'):
+                cursor.execute(f"""
+                    UPDATE mail_jobs 
+                    SET lease_expires_at = NOW() + INTERVAL %s SECOND
+                    WHERE worker_id = %s AND status = 'FLYING' AND id IN ({placeholders})
+                """, (self.lease_seconds, self.worker_id, *job_ids))
+                renewed = cursor.rowcount
+            self.db_connection.commit()
+            return renewed
+        except Error as e:
+            print(f"[ERROR] Error renewing job leases: {e}")
+            self.db_connection.rollback()
+            return 0
+
+    def refresh_queue_metrics(self):
+        """Update the queue depth gauges from mail_jobs and the pipeline stage queues."""
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='queue_depth'):
+                cursor.execute("""
+                    SELECT status, COUNT(*) FROM mail_jobs
+                    WHERE status IN ('HEADERS_ONLY', 'PENDING', 'FLYING')
+                    GROUP BY status
+                """)
+                counts = dict(cursor.fetchall())
+            self.db_connection.commit()
+            for status in ('HEADERS_ONLY', 'PENDING', 'FLYING'):
+                QUEUE_DEPTH.set(counts.get(status, 0), status=status)
+        except Error as e:
+            print(f"[WARN] Could not read queue depth: {e}")
+            self.db_connection.rollback()
+        
+        if self.pipeline:
+            for stage, depth in self.pipeline.queue_depths().items():
+                PIPELINE_QUEUE_DEPTH.set(depth, stage=stage)
+
+    def run_heartbeat(self):
+        """Background loop that renews this worker's job leases and refreshes queue metrics."""
+        self.db_connection = self.connect_to_database()
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            self.ensure_db_connection()
+            if self.db_connection:
+                self.renew_leases()
+                self.refresh_queue_metrics()
+
+    def start_heartbeat(self):
+        threading.Thread(target=self.run_heartbeat, name="lease-heartbeat", daemon=True).start()
+        print(f"[OK] Worker {self.worker_id} renewing {self.lease_seconds}s leases every {self.heartbeat_seconds}s")
 
     def add_to_human_fulfillment(self, job, error_message):
         # ... (all existing add_to_human_fulfillment code is unchanged) ...
@@ -135,29 +358,34 @@ class MailWorker:
                 "subject": subject,
                 "mail_content": content
             }
-            response = requests.post(
-                f"{self.mail_service_url}/send-mail",
-                json=mail_request,
-                timeout=30
-            )
+            response = self.mail_service_client.post("/send-mail", json=mail_request)
             return response.status_code == 200
         except requests.exceptions.RequestException as e:
             print(f"[ERROR] Error calling mail service: {e}")
             return False
 
     def check_user_registration(self, email_address):
-        # ... (all existing check_user_registration code is unchanged) ...
-        """Check if user is registered using user_validator API."""
+        """
+        Check if user is registered using user_validator API.
+        Raises Exception if the API is unreachable or errors (5xx, 408, 429), so
+        an outage is retried instead of rejecting the customer. Other 4xx answers
+        (e.g. 400 for a malformed address) mean the sender is not registered.
+        """
         try:
-            response = requests.get(f"{self.fastapi_base_url}/user/{email_address}", timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success') == True:
-                    return True, data.get('data', {})
-            return False, None
+            response = self.user_validator_client.get(f"/user/{email_address}", endpoint="/user/{user_email}")
         except requests.exceptions.RequestException as e:
-            print(f"[ERROR] Error calling user registration API: {e}")
+            raise Exception(f"Error calling user registration API: {e}")
+        
+        if is_rejected(response.status_code):
+            print(f"[WARN] User registration API rejected {email_address} ({response.status_code}): {response.text}")
             return False, None
+        if response.status_code != 200:
+            raise Exception(f"User registration API failed with status {response.status_code}: {response.text}")
+        
+        data = response.json()
+        if data.get('success') == True:
+            return True, data.get('data', {})
+        return False, None
 
     def send_unregistered_user_email(self, job):
         # ... (all existing send_unregistered_user_email code is unchanged) ...
@@ -167,188 +395,670 @@ class MailWorker:
         
         # Try to load from template (example of using processor's helper)
         try:
-            template = self.fulfillment_processor.load_prompt_file('user_not_found_email.txt')
-            if template:
-                lines = template.split('\n')
-                subject = lines[0].replace('Subject: ', '')
-                content_start = 2 if len(lines) > 1 and lines[1] == '' else 1
-                content = '\n'.join(lines[content_start:])
-                content = content.format(claim_id=job['claim_id'], user_email=job['sender_email'])
+            template = self.fulfillment_processor.prompts.get('user_not_found_email.txt')
+            subject = template.subject or subject
+            content = template.body.format(claim_id=job['claim_id'], user_email=job['sender_email'])
         except Exception:
             pass # Fallback to default content
 
         return self.send_email(job['sender_email'], subject, content)
 
-    def run_worker(self):
-        """Main worker loop to process jobs from the queue."""
-        print("[RUN] Mail Worker is running... Checking for jobs.")
+    def update_job_stage(self, job_id, stage):
+        """Record the pipeline stage a job has entered, for the dashboard."""
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='update_stage'):
+                cursor.execute("""
+                    UPDATE mail_jobs 
+                    SET current_stage = %s, stage_updated_at = %s
+                    WHERE id = %s
+                """, (stage, datetime.now(), job_id))
+            self.db_connection.commit()
+        except Error as e:
+            print(f"[ERROR] Error updating stage for job {job_id}: {e}")
+            self.db_connection.rollback()
+
+    def build_job_context(self, job):
+        """Re-create the email_data dict for the processor and wrap it in a stage context."""
+        try:
+            attachment_paths = json.loads(job['local_attachment_paths']) if job['local_attachment_paths'] else []
+        except json.JSONDecodeError:
+            attachment_paths = []
+
+        email_data = {
+            'email_id': job['id'], # Use job ID for reference
+            'sender_email': job['sender_email'],
+            'subject': job['subject'],
+            'content': job['content'],
+            'claim_id': job['claim_id'],
+            'attachment_paths': attachment_paths,
+            'attachment_count': len(attachment_paths),
+            'timestamp': job['created_at']
+        }
+        ctx = {'job': job, 'email_data': email_data, 'checkpoint': {}, 'stage_timings': {}, 'attachment_manifest': []}
         
-        while True:
-            job = None
+        # Attachments recorded at ingestion, possibly not downloaded yet
+        if job.get('attachment_manifest'):
             try:
-                # -----------------------------------------------------------------
-                # STAGE 0: GET JOB
-                # -----------------------------------------------------------------
-                job = self.get_next_pending_job()
-                
-                if not job:
-                    # No jobs found, wait
-                    time.sleep(5)
-                    continue
+                ctx['attachment_manifest'] = json.loads(job['attachment_manifest'])
+            except (TypeError, json.JSONDecodeError):
+                print(f"[WARN] Ignoring unreadable attachment manifest for job {job['id']}")
+        
+        # Seconds per stage, accumulated across attempts; queue_wait is the time
+        # from ingestion to the first claim
+        if job.get('stage_timings'):
+            try:
+                ctx['stage_timings'] = json.loads(job['stage_timings'])
+            except (TypeError, json.JSONDecodeError):
+                pass
+        if 'queue_wait' not in ctx['stage_timings'] and job.get('claimed_at') and job.get('created_at'):
+            ctx['stage_timings']['queue_wait'] = round((job['claimed_at'] - job['created_at']).total_seconds(), 3)
+        
+        # Restore outputs of stages completed by an earlier attempt
+        if job.get('checkpoint'):
+            try:
+                ctx['checkpoint'] = json.loads(job['checkpoint'])
+                ctx.update(ctx['checkpoint'])
+            except (TypeError, json.JSONDecodeError):
+                print(f"[WARN] Ignoring unreadable checkpoint for job {job['id']}")
+        if 'attachment_paths' in ctx['checkpoint']:
+            email_data['attachment_paths'] = ctx['checkpoint']['attachment_paths']
+            email_data['attachment_count'] = len(email_data['attachment_paths'])
+        return ctx
 
-                print("\n" + "="*60)
-                print(f"[PROCESS] Processing Job ID: {job['id']} | Claim ID: {job['claim_id']}")
-                print("="*60)
-
-                # --- 1. Re-create the email_data dict for the processor ---
-                try:
-                    attachment_paths = json.loads(job['local_attachment_paths']) if job['local_attachment_paths'] else []
-                except json.JSONDecodeError:
-                    attachment_paths = []
-
-                email_data = {
-                    'email_id': job['id'], # Use job ID for reference
-                    'sender_email': job['sender_email'],
-                    'subject': job['subject'],
-                    'content': job['content'],
-                    'claim_id': job['claim_id'],
-                    'attachment_paths': attachment_paths,
-                    'attachment_count': len(attachment_paths),
-                    'timestamp': job['created_at']
-                }
+    def save_checkpoint(self, ctx, **outputs):
+        """
+        Persist stage outputs so a retry can resume instead of recomputing them.
+        Returns False if this worker no longer holds the job's lease.
+        """
+        ctx.update(outputs)
+        ctx['checkpoint'].update(outputs)
+        job_id = ctx['job']['id']
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='save_checkpoint'):
+                cursor.execute("""
+                    UPDATE mail_jobs 
+                    SET checkpoint = %s
+                    WHERE id = %s AND worker_id = %s AND status = 'FLYING'
+                """, (json.dumps(ctx['checkpoint'], default=str), job_id, self.worker_id))
+                updated = cursor.rowcount > 0
+                if not updated:
+                    # MySQL reports changed rows, so an unchanged checkpoint also gives 0
+                    cursor.execute("""
+                        SELECT 1 FROM mail_jobs
+                        WHERE id = %s AND worker_id = %s AND status = 'FLYING'
+                    """, (job_id, self.worker_id))
+                    updated = cursor.fetchone() is not None
+            self.db_connection.commit()
+            return updated
+        except Error as e:
+            # The stage itself succeeded; a retry would only redo it
+            print(f"[WARN] Could not checkpoint job {job_id}: {e}")
+            self.db_connection.rollback()
+            return True
 
-                # -----------------------------------------------------------------
-                # STAGE 1: USER VALIDATION
-                # -----------------------------------------------------------------
-                is_registered, user_data = self.check_user_registration(email_data['sender_email'])
-                
-                if not is_registered:
-                    print(f"[REJECT] User {email_data['sender_email']} not registered.")
-                    self.send_unregistered_user_email(job)
-                    self.update_job_status(job['id'], 'REJECTED')
-                    continue
+    def checkpoint_or_stop(self, ctx, **outputs):
+        """save_checkpoint, stopping the job with LeaseLostError if its lease has gone elsewhere."""
+        if not self.save_checkpoint(ctx, **outputs):
+            raise LeaseLostError(f"Job {ctx['job']['id']} lease lost; another worker or the janitor owns it now")
 
-                print(f"[OK] User {email_data['sender_email']} is registered. Starting fulfillment.")
-                
-                # -----------------------------------------------------------------
-                # STAGE 2: LLM ASSESSMENT
-                # -----------------------------------------------------------------
-                try:
-                    llm_response = self.fulfillment_processor.assess_fulfillment_with_llm(email_data)
-                    if not llm_response:
-                        raise Exception("LLM returned no response")
-                except Exception as e:
-                    raise Exception(f"STAGE_LLM_ASSESSMENT_FAILED: {e}")
+    def get_resume_stage(self, ctx):
+        """First stage whose output is not yet checkpointed."""
+        checkpoint = ctx['checkpoint']
+        if 'llm_response' not in checkpoint:
+            if 'attachment_paths' in checkpoint:
+                return STAGE_ATTACHMENT_PREPROCESS
+            return STAGE_USER_VALIDATION
+        if 'parsed_result' not in checkpoint:
+            return STAGE_LLM_PARSE
+        
+        if checkpoint['parsed_result']['status'] == "COMPLETED":
+            if 's3_result' not in checkpoint:
+                return STAGE_S3_UPLOAD
+            if 'fulfillment_id' not in checkpoint:
+                return STAGE_FULFILLMENT_API
+            return STAGE_FINALIZE
+        
+        if 'fulfillment_id' not in checkpoint:
+            return STAGE_FULFILLMENT_API
+        if not checkpoint.get('mail_sent'):
+            return STAGE_MAIL_SERVICE
+        return STAGE_FINALIZE
 
-                # -----------------------------------------------------------------
-                # STAGE 3: PARSE LLM RESPONSE
-                # -----------------------------------------------------------------
-                try:
-                    parsed_result = self.fulfillment_processor.parse_fulfillment_response(llm_response, email_data)
-                    if not parsed_result:
-                        raise Exception("Failed to parse LLM response")
-                except Exception as e:
-                    raise Exception(f"STAGE_LLM_PARSE_FAILED: {e}")
+    # -----------------------------------------------------------------
+    # STAGE HANDLERS
+    # Each handler takes the job context and returns the next stage name,
+    # or None when the job is finished. Failures raise StageFailure;
+    # a lost lease raises LeaseLostError.
+    # -----------------------------------------------------------------
 
-                status = parsed_result['status']
+    def stage_validate_user(self, ctx):
+        """STAGE 1: USER VALIDATION"""
+        job, email_data = ctx['job'], ctx['email_data']
+        try:
+            is_registered, user_data = self.breakers[DEPENDENCY_USER_VALIDATOR].call(
+                self.check_user_registration, email_data['sender_email']
+            )
+        except Exception as e:
+            raise StageFailure("STAGE_USER_VALIDATION_FAILED", e) from e
 
-                # -----------------------------------------------------------------
-                # STAGE 4: FULFILLMENT (COMPLETED or PENDING)
-                # -----------------------------------------------------------------
-                if status == "COMPLETED":
-                    
-                    s3_result = None # Initialize s3_result
-                    # --- STAGE 4a (COMPLETED): S3 UPLOAD ---
-                    try:
-                        s3_result = self.fulfillment_processor.upload_to_s3_for_completed_fulfillment(email_data)
-                        if not s3_result:
-                            # We will allow this to fail "gracefully" for now, but log it
-                            print("[WARN] S3 upload failed, but proceeding to save fulfillment record.")
-                            # You could also raise an exception here if S3 is mandatory
-                            # raise Exception("S3 Uploader returned no result")
-                    except Exception as e:
-                        # Raise a specific error for the safety net
-                        raise Exception(f"STAGE_S3_UPLOAD_FAILED: {e}")
-
-                    # --- STAGE 4b (COMPLETED): SAVE TO API ---
-                    try:
-                        fulfillment_id = self.fulfillment_processor.save_to_fulfillment_table(email_data, "completed", s3_result=s3_result)
-                        if not fulfillment_id:
-                            raise Exception("Fulfillment API call failed")
-                        
-                        # Clean up local files AFTER successful API save
-                        self.fulfillment_processor.cleanup_local_files_after_s3_upload(email_data)
+        if not is_registered:
+            print(f"[REJECT] User {email_data['sender_email']} not registered.")
+            self.send_unregistered_user_email(job)
+            self.update_job_status(job['id'], 'REJECTED', stage_timings=ctx['stage_timings'])
+            return None
 
-                    except Exception as e:
-                        raise Exception(f"STAGE_FULFILLMENT_API_FAILED: {e}")
+        print(f"[OK] User {email_data['sender_email']} is registered. Starting fulfillment.")
+        return STAGE_ATTACHMENT_FETCH
 
-                elif status == "PENDING":
-                    
-                    missing_items = parsed_result['missing_items']
-                    email_content = parsed_result['email_content']
+    def download_attachment(self, job, item, max_bytes):
+        """
+        Stream one deferred attachment part from the mailbox to disk, decoding as it
+        arrives. Returns (path, size), or (None, 0) if the part is over `max_bytes`.
+        """
+        try:
+            with open_attachment(job['claim_id'], item['filename']) as out:
+                size = self.attachment_fetcher.stream_part(
+                    job['source_name'], job['source_mailbox'], job['source_uid_validity'], job['source_uid'],
+                    item['section'], item['encoding'], out, max_bytes
+                )
+            return out.path, size
+        except AttachmentTooLarge as e:
+            # Not a dependency failure, so it must not reach the circuit breaker
+            print(f"[WARN] Skipping attachment {item['filename']} for {job['claim_id']}: {e}")
+            return None, 0
 
-                    # --- STAGE 4c (PENDING): SAVE TO API ---
-                    try:
-                        fulfillment_id = self.fulfillment_processor.save_to_fulfillment_table(email_data, "pending", missing_items)
-                        if not fulfillment_id:
-                            raise Exception("Fulfillment API call failed for PENDING")
-                    except Exception as e:
-                        raise Exception(f"STAGE_FULFILLMENT_API_FAILED: {e}")
+    def stage_fetch_attachments(self, ctx):
+        """STAGE 1b: DOWNLOAD ATTACHMENTS the monitor deferred, now that the claim will be assessed"""
+        job, email_data = ctx['job'], ctx['email_data']
+        pending = [item for item in ctx['attachment_manifest'] if not item.get('path') and not item.get('skipped')]
+        if pending:
+            max_attachment_bytes, max_message_bytes = get_attachment_limits()
+            remaining = max_message_bytes - sum(
+                os.path.getsize(path) for path in email_data['attachment_paths'] if os.path.exists(path)
+            )
+            try:
+                for item in pending:
+                    max_bytes = min(max_attachment_bytes, remaining)
+                    if estimated_size(item) > max_bytes:
+                        item['skipped'] = 'size_limit'
+                        print(f"[WARN] Skipping attachment {item['filename']} for {job['claim_id']}: over the size limit")
+                        continue
+                    item['path'], size = self.breakers[DEPENDENCY_IMAP].call(self.download_attachment, job, item, max_bytes)
+                    if item['path']:
+                        remaining -= size
+                        print(f"[FILE] Downloaded deferred attachment {item['filename']} for {job['claim_id']}")
+                    else:
+                        item['skipped'] = 'size_limit'
+            except Exception as e:
+                raise StageFailure("STAGE_ATTACHMENT_FETCH_FAILED", e) from e
+            
+            # Keep already-downloaded (or pre-manifest) files and add the new ones
+            attachment_paths = list(email_data['attachment_paths'])
+            attachment_paths += [item['path'] for item in pending if item.get('path') and item['path'] not in attachment_paths]
+            email_data['attachment_paths'] = attachment_paths
+            email_data['attachment_count'] = len(attachment_paths)
+            self.record_attachment_paths(job['id'], attachment_paths)
+        
+        self.checkpoint_or_stop(ctx, attachment_paths=email_data['attachment_paths'])
+        return STAGE_ATTACHMENT_PREPROCESS
 
-                    # --- STAGE 4d (PENDING): SEND MAIL ---
-                    try:
-                        email_sent = self.fulfillment_processor.send_mail_via_service(
-                            to_email=email_data['sender_email'],
-                            subject="Insurance Claim - Additional Information Required",
-                            content=email_content
-                        )
-                        if not email_sent:
-                            raise Exception("Mail Service API call returned False")
-                    except Exception as e:
-                        raise Exception(f"STAGE_MAIL_SERVICE_FAILED: {e}")
-                
-                # --- STAGE 5: FINAL SUCCESS ---
-                # If we get here, all steps for this path passed
-                # We use a clear success status. 'COMPLETED' means the job is done,
-                # whether it was a COMPLETED or PENDING_CUSTOMER fulfillment.
-                self.update_job_status(job['id'], 'PROCESSED_SUCCESS')
-                print(f"[OK] All stages passed for Job ID: {job['id']} (Final Status: {status})")
+    def stage_preprocess_attachments(self, ctx):
+        """STAGE 1c: PREPARE ATTACHMENTS for the LLM (downscaled images, PDF text), cached per content hash"""
+        for path in ctx['email_data']['attachment_paths']:
+            try:
+                if is_image(path):
+                    self.fulfillment_processor.image_preprocessor.prepare(path)
+                elif is_pdf(path) and os.path.exists(path):
+                    self.fulfillment_processor.pdf_extractor.extract(path)
+            except Exception as e:
+                # The LLM stage prepares it again or skips it; not worth failing the claim here
+                print(f"[WARN] Could not prepare {os.path.basename(path)} for {ctx['job']['claim_id']}: {e}")
+        return STAGE_LLM_ASSESSMENT
+
+    def record_attachment_paths(self, job_id, attachment_paths):
+        """Store the final local attachment paths on the job, for the dashboard and reviewers."""
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='update_attachments'):
+                cursor.execute("""
+                    UPDATE mail_jobs 
+                    SET local_attachment_paths = %s
+                    WHERE id = %s AND worker_id = %s AND status = 'FLYING'
+                """, (json.dumps(attachment_paths), job_id, self.worker_id))
+            self.db_connection.commit()
+        except Error as e:
+            print(f"[WARN] Could not record attachment paths for job {job_id}: {e}")
+            self.db_connection.rollback()
+
+    def stage_llm_assessment(self, ctx):
+        """STAGE 2: LLM ASSESSMENT"""
+        email_data = ctx['email_data']
+        # Clear-cut PENDING claims are decided by rules; a sample still goes to the LLM
+        decision = self.prescreen.evaluate(email_data)
+        if decision and not self.prescreen.should_shadow():
+            print(f"[PRESCREEN] Claim {email_data['claim_id']} is PENDING ({', '.join(decision.rules)}), skipping the LLM")
+            self.checkpoint_or_stop(ctx, llm_response=decision.llm_response)
+            return STAGE_LLM_PARSE
+
+        # Identical content, attachments, prompt and model: reuse the earlier answer
+        cache_key, prompt_version = self.fulfillment_processor.assessment_cache_key(email_data)
+        llm_response = self.assessment_cache.get(self.db_connection, cache_key)
+        if llm_response:
+            print(f"[CACHE] Reusing LLM assessment for claim {email_data['claim_id']}")
+        else:
+            try:
+                llm_response = self.breakers[DEPENDENCY_BEDROCK].call(
+                    self.fulfillment_processor.assess_fulfillment_with_llm, email_data
+                )
+                if not llm_response:
+                    raise Exception("LLM returned no response")
+            except Exception as e:
+                if decision is None:
+                    raise StageFailure("STAGE_LLM_ASSESSMENT_FAILED", e) from e
+                # Shadow call only: the rules' answer stands
+                print(f"[WARN] Shadow LLM call failed for {email_data['claim_id']}, using the pre-screen decision: {e}")
+                self.checkpoint_or_stop(ctx, llm_response=decision.llm_response)
+                return STAGE_LLM_PARSE
+
+            self.assessment_cache.put(
+                self.db_connection, cache_key, self.fulfillment_processor.model_id, prompt_version, llm_response
+            )
+
+        if decision:
+            # The sampled claim paid for the LLM call, so its more specific answer is used
+            self.prescreen.record_shadow(decision, llm_response)
+
+        self.checkpoint_or_stop(ctx, llm_response=llm_response)
+        return STAGE_LLM_PARSE
+
+    def stage_llm_parse(self, ctx):
+        """STAGE 3: PARSE LLM RESPONSE"""
+        try:
+            parsed_result = self.fulfillment_processor.parse_fulfillment_response(ctx['llm_response'], ctx['email_data'])
+            if not parsed_result:
+                raise Exception("Failed to parse LLM response")
+        except Exception as e:
+            # Do not hand the same response to a retry or a requeued job
+            cache_key, _ = self.fulfillment_processor.assessment_cache_key(ctx['email_data'])
+            self.assessment_cache.discard(self.db_connection, cache_key)
+            raise StageFailure("STAGE_LLM_PARSE_FAILED", e) from e
+
+        self.checkpoint_or_stop(ctx, parsed_result=parsed_result)
+        # STAGE 4: FULFILLMENT (COMPLETED or PENDING)
+        if parsed_result['status'] == "COMPLETED":
+            return STAGE_S3_UPLOAD
+        return STAGE_FULFILLMENT_API
+
+    def stage_s3_upload(self, ctx):
+        """STAGE 4a (COMPLETED): S3 UPLOAD"""
+        s3_result = None
+        try:
+            s3_result = self.breakers[DEPENDENCY_S3].call(
+                self.fulfillment_processor.upload_to_s3_for_completed_fulfillment, ctx['email_data']
+            )
+            if not s3_result:
+                # We will allow this to fail "gracefully" for now, but log it
+                print("[WARN] S3 upload failed, but proceeding to save fulfillment record.")
+                # You could also raise an exception here if S3 is mandatory
+                # raise Exception("S3 Uploader returned no result")
+        except Exception as e:
+            # Raise a specific error for the safety net
+            raise StageFailure("STAGE_S3_UPLOAD_FAILED", e) from e
 
+        self.checkpoint_or_stop(ctx, s3_result=s3_result)
+        return STAGE_FULFILLMENT_API
+
+    def stage_fulfillment_api(self, ctx):
+        """STAGE 4b/4c: SAVE TO API"""
+        email_data, parsed_result = ctx['email_data'], ctx['parsed_result']
+
+        if parsed_result['status'] == "COMPLETED":
+            try:
+                fulfillment_id = self.breakers[DEPENDENCY_FULFILLMENT_API].call(
+                    self.fulfillment_processor.save_to_fulfillment_table, email_data, "completed", s3_result=ctx.get('s3_result')
+                )
+                if not fulfillment_id:
+                    raise Exception("Fulfillment API call failed")
+
+                # Clean up local files AFTER successful API save
+                self.fulfillment_processor.cleanup_local_files_after_s3_upload(email_data)
+
+            except Exception as e:
+                raise StageFailure("STAGE_FULFILLMENT_API_FAILED", e) from e
+
+            self.checkpoint_or_stop(ctx, fulfillment_id=fulfillment_id)
+            return STAGE_FINALIZE
+
+        try:
+            fulfillment_id = self.breakers[DEPENDENCY_FULFILLMENT_API].call(
+                self.fulfillment_processor.save_to_fulfillment_table, email_data, "pending", parsed_result['missing_items']
+            )
+            if not fulfillment_id:
+                raise Exception("Fulfillment API call failed for PENDING")
+        except Exception as e:
+            raise StageFailure("STAGE_FULFILLMENT_API_FAILED", e) from e
+
+        self.checkpoint_or_stop(ctx, fulfillment_id=fulfillment_id)
+        return STAGE_MAIL_SERVICE
+
+    def stage_mail_service(self, ctx):
+        """STAGE 4d (PENDING): SEND MAIL"""
+        try:
+            email_sent = self.breakers[DEPENDENCY_MAIL_SERVICE].call(
+                self.fulfillment_processor.send_mail_via_service,
+                to_email=ctx['email_data']['sender_email'],
+                subject="Insurance Claim - Additional Information Required",
+                content=ctx['parsed_result']['email_content']
+            )
+            if not email_sent:
+                raise Exception("Mail Service API call returned False")
+        except Exception as e:
+            raise StageFailure("STAGE_MAIL_SERVICE_FAILED", e) from e
+
+        self.checkpoint_or_stop(ctx, mail_sent=True)
+        return STAGE_FINALIZE
+
+    def stage_finalize(self, ctx):
+        """STAGE 5: FINAL SUCCESS"""
+        # If we get here, all steps for this path passed
+        # We use a clear success status. 'COMPLETED' means the job is done,
+        # whether it was a COMPLETED or PENDING_CUSTOMER fulfillment.
+        job = ctx['job']
+        self.update_job_status(job['id'], 'PROCESSED_SUCCESS', stage_timings=ctx['stage_timings'])
+        print(f"[OK] All stages passed for Job ID: {job['id']} (Final Status: {ctx['parsed_result']['status']})")
+        return None
+
+    def timed_stage(self, name, handler):
+        """Wrap a stage handler so its monotonic run time is added to ctx['stage_timings']."""
+        def run(ctx):
+            start = time.monotonic()
+            outcome = 'error'
+            try:
+                next_stage = handler(ctx)
+                outcome = 'ok'
+                return next_stage
+            finally:
+                elapsed = time.monotonic() - start
+                timings = ctx['stage_timings']
+                timings[name] = round(timings.get(name, 0) + elapsed, 3)
+                STAGE_RUNS.inc(stage=name, outcome=outcome)
+                STAGE_SECONDS.observe(elapsed, stage=name)
+        return run
+
+    def get_stage_handlers(self):
+        """Map of stage name -> timed handler, in pipeline order."""
+        handlers = {
+            STAGE_USER_VALIDATION: self.stage_validate_user,
+            STAGE_ATTACHMENT_FETCH: self.stage_fetch_attachments,
+            STAGE_ATTACHMENT_PREPROCESS: self.stage_preprocess_attachments,
+            STAGE_LLM_ASSESSMENT: self.stage_llm_assessment,
+            STAGE_LLM_PARSE: self.stage_llm_parse,
+            STAGE_S3_UPLOAD: self.stage_s3_upload,
+            STAGE_FULFILLMENT_API: self.stage_fulfillment_api,
+            STAGE_MAIL_SERVICE: self.stage_mail_service,
+            STAGE_FINALIZE: self.stage_finalize,
+        }
+        return {name: self.timed_stage(name, handler) for name, handler in handlers.items()}
+
+    def process_job(self, ctx):
+        """Run every processing stage for a claimed job in sequence. Raises Exception on failure."""
+        job = ctx['job']
+        print("\n" + "="*60)
+        print(f"[PROCESS] Processing Job ID: {job['id']} | Claim ID: {job['claim_id']}")
+        print("="*60)
+
+        handlers = self.get_stage_handlers()
+        stage = self.get_resume_stage(ctx)
+        if stage != STAGE_USER_VALIDATION:
+            print(f"[RESUME] Job {job['id']} resuming from checkpoint at stage {stage}")
+        while stage:
+            self.update_job_stage(job['id'], stage)
+            stage = handlers[stage](ctx)
+
+    def reschedule_job(self, ctx, error_message, delay_seconds):
+        """Put a job back to PENDING, not claimable before `delay_seconds` from now."""
+        job = ctx['job']
+        self.in_flight.discard(job['id'])
+        try:
+            with self.db_connection.cursor() as cursor, DB_QUERY_SECONDS.time(query='reschedule'):
+                cursor.execute("""
+                    UPDATE mail_jobs 
+                    SET status = 'PENDING', error_message = %s, last_processed_at = %s,
+                        next_attempt_at = NOW() + INTERVAL %s SECOND,
+                        checkpoint = %s, stage_timings = %s,
+                        worker_id = NULL, lease_expires_at = NULL, attempt_count = 0
+                    WHERE id = %s AND worker_id = %s AND status = 'FLYING'
+                """, (error_message, datetime.now(), int(delay_seconds),
+                      json.dumps(ctx['checkpoint'], default=str), json.dumps(ctx['stage_timings']),
+                      job['id'], self.worker_id))
+                updated = cursor.rowcount
+            self.db_connection.commit()
+            return updated > 0
+        except Error as e:
+            print(f"[ERROR] Error rescheduling job {job['id']}: {e}")
+            self.db_connection.rollback()
+            return False
+
+    def abandon_job(self, job, error):
+        """
+        Last resort when even the error handling failed: drop the job from
+        in_flight. renew_leases only extends in-flight jobs, so its lease runs
+        out and stuck_job_resolver.py reclaims it.
+        """
+        self.in_flight.discard(job['id'])
+        print(f"[CRITICAL] Could not record the failure of job {job['id']}, leaving it to the janitor: {error}")
+
+    def handle_job_error(self, ctx, error):
+        """Route a failed job (see route_job_error); never raises, so a bad job cannot kill its thread."""
+        try:
+            self.route_job_error(ctx, error)
+        except Exception as handler_error:
+            self.abandon_job(ctx['job'], handler_error)
+
+    def route_job_error(self, ctx, error):
+        """
+        Decide what happens to a job whose stage raised: reschedule it while the
+        stage has retry budget left (or its dependency's circuit is open),
+        otherwise, or when the dependency rejected the request, hand it to the
+        human_fulfillment safety net.
+        """
+        job = ctx['job']
+        if isinstance(error, LeaseLostError):
+            # Not a failure: the job is being handled elsewhere, so neither retry nor escalate it
+            self.in_flight.discard(job['id'])
+            print(f"[WARN] Stopped processing: {error}")
+            return
+
+        error_message = str(error)
+        stage = getattr(error, 'stage', None)
+        cause = error.__cause__
+        
+        if isinstance(cause, CircuitOpenError):
+            # The dependency is known to be down: wait for it without using retry budget
+            # Spread the deferred jobs out so they do not all hit the trial call
+            delay = max(1, cause.retry_at - time.time()) + random.uniform(0, 5)
+            if self.reschedule_job(ctx, error_message, delay):
+                JOBS_RESCHEDULED.inc(stage=stage, reason='circuit_open')
+                print(f"[RETRY] Job {job['id']} deferred {delay:.0f}s: {cause.dependency} circuit is open")
+                return
+        
+        retries = ctx['checkpoint'].setdefault('retries', {})
+        retries_so_far = retries.get(stage, 0)
+        # A rejected request would be rejected again, so it goes straight to a human
+        if not isinstance(cause, NonRetryableError) and self.retry_policy.should_retry(stage, retries_so_far):
+            retries[stage] = retries_so_far + 1
+            delay = self.retry_policy.backoff_seconds(retries_so_far)
+            if self.reschedule_job(ctx, error_message, delay):
+                JOBS_RESCHEDULED.inc(stage=stage, reason='retry')
+                print(f"[RETRY] Job {job['id']} stage {stage} retry {retries[stage]}/{self.retry_policy.budgets[stage]} in {delay:.0f}s")
+                return
+        
+        print(f"[CRITICAL] Job {job['id']} failed. Error: {error_message}")
+        self.handle_job_failure(job, error_message, ctx['stage_timings'])
+
+    def handle_job_failure(self, job, error_message, stage_timings=None):
+        """Route a failed job to the human_fulfillment safety net."""
+        # Mark as FAILED to stop crash loop. If another worker now owns the
+        # job, leave the safety net to that worker.
+        if not self.update_job_status(job['id'], 'FAILED', error_message, stage_timings):
+            return
+        
+        # Log to human fulfillment table
+        self.add_to_human_fulfillment(job, error_message)
+        
+        # Notify human verifier
+        if self.human_verifier_email:
+            self.send_email(
+                self.human_verifier_email,
+                f"URGENT: Job Failed - {job['claim_id']}",
+                f"Job ID {job['id']} for Claim ID {job['claim_id']} failed with an unexpected error:\n\n{error_message}\n\nThe job has been logged to the human_fulfillment table for review."
+            )
+
+    def wait_for_jobs(self, seen_generation, delay):
+        """Sleep for up to `delay` seconds, returning early on a new-job signal."""
+        if self.wakeup_listener:
+            return self.wakeup_listener.wait(seen_generation, delay)
+        time.sleep(delay)
+        return False
+
+    def poll_for_job(self, idle_delay):
+        """
+        Claim the next job. If the queue is empty, wait for a signal or back off.
+        Returns (job or None, idle delay to use next time).
+        """
+        seen_generation = self.wakeup_listener.generation if self.wakeup_listener else 0
+        job = self.get_next_pending_job()
+        if job:
+            return job, self.poll_min_seconds
+        
+        # No jobs found, wait for a signal or back off
+        if self.wait_for_jobs(seen_generation, idle_delay):
+            return None, self.poll_min_seconds
+        return None, min(idle_delay * 2, self.poll_max_seconds)
+
+    def ensure_db_connection(self):
+        """Reconnect the current slot's database connection if it dropped."""
+        try:
+            if not self.db_connection.is_connected():
+                print("[DB] Reconnecting to database...")
+                self.db_connection = self.connect_to_database()
+        except Exception as db_e:
+            print(f"[CRITICAL] Database connection failed: {db_e}")
+            self.db_connection = self.connect_to_database()
+
+    def run_slot(self):
+        """Processing loop for a single slot. Each slot owns one DB connection."""
+        # Connect before taking jobs: another slot may already have buffered some for us
+        self.ensure_db_connection()
+        idle_delay = self.poll_min_seconds
+        while True:
+            job = None
+            ctx = None
+            try:
+                # -----------------------------------------------------------------
+                # STAGE 0: GET JOB
+                # -----------------------------------------------------------------
+                job, idle_delay = self.poll_for_job(idle_delay)
+                if not job:
+                    continue
+
+                ctx = self.build_job_context(job)
+                self.process_job(ctx)
 
             except Exception as e:
                 # -----------------------------------------------------------------
                 # CATCH-ALL SAFETY NET
                 # 'e' will now contain our specific error message, e.g., "STAGE_S3_UPLOAD_FAILED: ..."
                 # -----------------------------------------------------------------
+                if ctx:
+                    self.handle_job_error(ctx, e)
+                else:
+                    print(f"[CRITICAL] Job {job['id'] if job else 'N/A'} failed. Error: {e}")
+                    if job:
+                        try:
+                            self.handle_job_failure(job, str(e))
+                        except Exception as handler_error:
+                            self.abandon_job(job, handler_error)
+                    
+                    # Wait a moment before retrying to prevent rapid-fire DB errors
+                    time.sleep(2)
+            
+            finally:
+                # This block ensures our database connection is stable
+                self.ensure_db_connection()
+
+    def build_pipeline(self):
+        """Create the staged pipeline with per-stage queue sizes and thread counts."""
+        queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', 10))
+        stages = [
+            Stage(
+                name,
+                handler,
+                concurrency=int(os.getenv(f'PIPELINE_{name}_CONCURRENCY', DEFAULT_STAGE_CONCURRENCY[name])),
+                queue_size=queue_size
+            )
+            for name, handler in self.get_stage_handlers().items()
+        ]
+        return PipelineEngine(
+            stages,
+            on_error=self.handle_job_error,
+            on_transition=lambda ctx, stage: self.update_job_stage(ctx['job']['id'], stage),
+            before_stage=self.ensure_db_connection
+        )
+
+    def run_pipeline(self):
+        """Feed claimed jobs into the staged pipeline. Blocks while the first stage is full."""
+        pipeline = self.build_pipeline()
+        pipeline.start()
+        self.pipeline = pipeline
+        
+        idle_delay = self.poll_min_seconds
+        while True:
+            job = None
+            try:
+                job, idle_delay = self.poll_for_job(idle_delay)
+                if not job:
+                    continue
+
+                ctx = self.build_job_context(job)
+                stage = self.get_resume_stage(ctx)
+                print(f"[PROCESS] Job ID: {job['id']} | Claim ID: {job['claim_id']} entered the pipeline at {stage}")
+                pipeline.submit(ctx, stage)
+
+            except Exception as e:
                 error_message = str(e)
                 print(f"[CRITICAL] Job {job['id'] if job else 'N/A'} failed. Error: {error_message}")
-                
                 if job:
-                    # Log to human fulfillment table
-                    self.add_to_human_fulfillment(job, error_message)
-                    # Mark as FAILED to stop crash loop
-                    self.update_job_status(job['id'], 'FAILED', error_message)
-                    
-                    # Notify human verifier
-                    if self.human_verifier_email:
-                        self.send_email(
-                            self.human_verifier_email,
-                            f"URGENT: Job Failed - {job['claim_id']}",
-                            f"Job ID {job['id']} for Claim ID {job['claim_id']} failed with an unexpected error:\n\n{error_message}\n\nThe job has been logged to the human_fulfillment table for review."
-                        )
-                
-                # Wait a moment before retrying to prevent rapid-fire DB errors
+                    try:
+                        self.handle_job_failure(job, error_message)
+                    except Exception as handler_error:
+                        self.abandon_job(job, handler_error)
                 time.sleep(2)
             
             finally:
-                # This block ensures our database connection is stable
-                try:
-                    if not self.db_connection.is_connected():
-                        print("[DB] Reconnecting to database...")
-                        self.db_connection = self.connect_to_database()
-                except Exception as db_e:
-                    print(f"[CRITICAL] Database connection failed in finally block: {db_e}")
-                    self.db_connection = self.connect_to_database()
+                self.ensure_db_connection()
+
+    def run_worker(self):
+        """Main worker loop to process jobs from the queue."""
+        print("[RUN] Mail Worker is running... Checking for jobs.")
+        start_metrics_server('WORKER_METRICS_PORT', 9101)
+        self.start_heartbeat()
+        
+        if self.mode == 'pipeline':
+            print("[RUN] Running in pipeline mode")
+            self.run_pipeline()
+            return
+        
+        if self.concurrency == 1:
+            self.run_slot()
+            return
+        
+        # Keep N claims in flight: each slot is an independent claim/process loop
+        # on its own thread with its own DB connection (see db_connection).
+        print(f"[RUN] Running {self.concurrency} concurrent job slots")
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="worker-slot") as executor:
+            slots = [executor.submit(self.run_slot) for _ in range(self.concurrency)]
+            for slot in slots:
+                slot.result()
 
 
 if __name__ == "__main__":